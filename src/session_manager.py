@@ -29,6 +29,7 @@ import queue
 import logging
 import threading
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, List
 from dataclasses import dataclass, field
 from enum import Enum
@@ -166,6 +167,8 @@ class SessionManager:
         self.graphs_dir = graphs_dir
 
         self._sessions: Dict[str, Session] = {}
+        # IDs of pre-spawned sessions not yet handed out (see pre_warm)
+        self._warm_pool: List[str] = []
         self._lock = threading.RLock()
         self._cleanup_thread: Optional[threading.Thread] = None
         self._shutdown = False
@@ -218,6 +221,60 @@ class SessionManager:
         self._logger.info("Session manager started successfully")
         return True
 
+    def pre_warm(self, count: int) -> int:
+        """
+        Pre-spawn worker sessions so the first parallel requests skip Stata startup.
+
+        Workers are started concurrently and parked in a pool; create_session()
+        without an explicit ID hands them out before spawning new ones.
+
+        Args:
+            count: Number of sessions to pre-spawn (bounded by available slots)
+
+        Returns:
+            Number of sessions that initialized successfully
+        """
+        count = min(count, self.available_slots)
+        if count <= 0:
+            return 0
+
+        self._logger.info(f"Pre-warming {count} session(s)")
+        session_ids = [str(uuid.uuid4())[:8] for _ in range(count)]
+        with ThreadPoolExecutor(max_workers=count, thread_name_prefix="session-warmup") as pool:
+            warmed = sum(pool.map(self._warm_session, session_ids))
+
+        self._logger.info(f"Pre-warmed {warmed}/{count} session(s)")
+        return warmed
+
+    def _warm_session(self, session_id: str) -> bool:
+        """Spawn one session for the warm pool, unless the manager is shutting down"""
+        if self._shutdown:
+            return False
+        if not self._create_session_internal(session_id):
+            return False
+
+        with self._lock:
+            # stop() sets _shutdown before collecting sessions under the lock, so a session
+            # pooled here is either destroyed by stop() or seen as shut down below
+            if not self._shutdown:
+                self._warm_pool.append(session_id)
+                return True
+
+        # stop() ran while Stata was booting: don't leave the worker behind
+        self._logger.info(f"Discarding pre-warmed session {session_id}, manager stopped")
+        self.destroy_session(session_id, force=True)
+        return False
+
+    def _claim_warm_session(self) -> Optional[str]:
+        """Pop a ready pre-warmed session ID from the pool, or None if none is left"""
+        with self._lock:
+            while self._warm_pool:
+                session_id = self._warm_pool.pop(0)
+                session = self._sessions.get(session_id)
+                if session and session.state == SessionState.READY:
+                    return session_id
+        return None
+
     def stop(self):
         """Stop the session manager and destroy all sessions"""
         self._logger.info("Stopping session manager...")
@@ -262,6 +319,13 @@ class SessionManager:
             if session_id and session_id in self._sessions:
                 return {"success": True, "session_id": session_id, "error": ""}
 
+        # Hand out a pre-warmed session when the caller does not need a specific ID
+        if not session_id:
+            warm_session_id = self._claim_warm_session()
+            if warm_session_id:
+                self._logger.info(f"Using pre-warmed session {warm_session_id}")
+                return {"success": True, "session_id": warm_session_id, "error": ""}
+
         # Generate unique session ID if not provided
         if not session_id:
             session_id = str(uuid.uuid4())[:8]
@@ -387,6 +451,7 @@ class SessionManager:
 
         # Force terminate if still alive
         self._terminate_worker(session)
+        self._close_session_queues(session)
 
         # Remove from registry
         with self._lock:
@@ -482,13 +547,7 @@ class SessionManager:
                     failed_session = self._sessions.get(default_id)
                 if failed_session:
                     self._terminate_worker(failed_session)
-                    for q in [failed_session.command_queue, failed_session.result_queue]:
-                        if q is not None:
-                            try:
-                                q.close()
-                                q.join_thread()
-                            except Exception:
-                                pass
+                    self._close_session_queues(failed_session)
                 time.sleep(1.0)
 
         # Both attempts failed — remove the stale entry
@@ -516,6 +575,17 @@ class SessionManager:
         except Exception as e:
             self._logger.error(f"Error terminating worker: {e}")
 
+    def _close_session_queues(self, session: Session):
+        """Close a terminated worker's queues so their pipes and feeder threads are released now."""
+        for q in (session.command_queue, session.result_queue):
+            if q is None:
+                continue
+            try:
+                q.close()
+                q.join_thread()
+            except Exception:
+                pass
+
     def get_session(self, session_id: Optional[str] = None) -> Optional[Session]:
         """
         Get a session by ID, or the default session if no ID provided.
@@ -526,10 +596,11 @@ class SessionManager:
         Returns:
             Session object or None if not found
         """
-        with self._lock:
-            if session_id is None:
-                session_id = self.DEFAULT_SESSION_ID
-            return self._sessions.get(session_id)
+        if session_id is None:
+            session_id = self.DEFAULT_SESSION_ID
+        # No lock needed: a single dict lookup is atomic, and every writer
+        # replaces entries under self._lock, so readers never see a partial update
+        return self._sessions.get(session_id)
 
     def wait_for_ready(self, session: Session, timeout: float = 30.0) -> bool:
         """
@@ -616,9 +687,9 @@ class SessionManager:
         # If session is busy, auto-create a new session for parallel execution
         if session.state == SessionState.BUSY:
             self._logger.info(f"Session {session.session_id} is busy, creating new session for parallel execution")
-            new_session_id = str(uuid.uuid4())[:8]
-            create_result = self.create_session(new_session_id)
+            create_result = self.create_session()
             if create_result.get('success'):
+                new_session_id = create_result['session_id']
                 session = self.get_session(new_session_id)
                 if session is None:
                     return {
@@ -652,7 +723,9 @@ class SessionManager:
         session_id: Optional[str] = None,
         timeout: Optional[float] = None,
         log_file: Optional[str] = None,
-        working_dir: Optional[str] = None
+        working_dir: Optional[str] = None,
+        compact_filter: bool = False,
+        filter_command_echo: bool = False
     ) -> Dict[str, Any]:
         """
         Execute a .do file in a session.
@@ -664,6 +737,9 @@ class SessionManager:
             log_file: Optional path to log file for streaming support
             working_dir: Working directory to cd to before running (affects where outputs are saved).
                          If None, defaults to the .do file's directory.
+            compact_filter: Apply compact mode filtering to the output in the worker
+                            (sets extra["filtered"] in the result)
+            filter_command_echo: Also drop command echo lines when compact_filter is set
 
         Returns:
             Result dictionary with status, output, error, log_file
@@ -694,9 +770,9 @@ class SessionManager:
         # If session is busy, auto-create a new session for parallel execution
         if session.state == SessionState.BUSY:
             self._logger.info(f"Session {session.session_id} is busy, creating new session for parallel file execution")
-            new_session_id = str(uuid.uuid4())[:8]
-            create_result = self.create_session(new_session_id)
+            create_result = self.create_session()
             if create_result.get('success'):
+                new_session_id = create_result['session_id']
                 session = self.get_session(new_session_id)
                 if session is None:
                     return {
@@ -729,7 +805,9 @@ class SessionManager:
                 "file_path": file_path,
                 "timeout": timeout or self.command_timeout,
                 "log_file": log_file,
-                "working_dir": working_dir
+                "working_dir": working_dir,
+                "compact_filter": compact_filter,
+                "filter_command_echo": filter_command_echo
             },
             timeout or self.command_timeout
         )
@@ -965,10 +1043,11 @@ class SessionManager:
 
         with self._lock:
             sessions_to_check = list(self._sessions.items())
+            warm_pool = set(self._warm_pool)
 
         for session_id, session in sessions_to_check:
-            # Skip default session for timeout cleanup
-            if session.is_default:
+            # Skip default and still-pooled warm sessions for timeout cleanup
+            if session.is_default or session_id in warm_pool:
                 continue
 
             # Check for idle timeout
@@ -1000,13 +1079,40 @@ class SessionManager:
         with self._lock:
             sessions = list(self._sessions.values())
 
+        return self._stats_for(sessions)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        List active sessions and statistics from a single pass over the session table.
+
+        Returns:
+            Dictionary with "sessions" (as from list_sessions) and "stats" (as from get_stats)
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+
+        return {
+            "sessions": [
+                session.to_dict()
+                for session in sessions
+                if session.state not in (SessionState.DESTROYED, SessionState.DESTROYING)
+            ],
+            "stats": self._stats_for(sessions),
+        }
+
+    def _stats_for(self, sessions: List[Session]) -> Dict[str, Any]:
+        """Compute statistics from a copy of the session table taken under the lock"""
+        active_count = sum(
+            1 for s in sessions
+            if s.state in (SessionState.READY, SessionState.BUSY, SessionState.CREATING)
+        )
         return {
             "enabled": self.enabled,
             "total_sessions": len(sessions),
             "active_sessions": sum(1 for s in sessions if s.state == SessionState.READY),
             "busy_sessions": sum(1 for s in sessions if s.state == SessionState.BUSY),
             "max_sessions": self.max_sessions,
-            "available_slots": self.available_slots,
+            "available_slots": max(0, self.max_sessions - active_count),
             "session_timeout": self.session_timeout
         }
 
@@ -18,7 +18,15 @@ import subprocess
 import traceback
 import socket
 import asyncio
+import atexit
+import codecs
+import functools
+import glob
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import unquote
 import warnings
 import re
@@ -77,10 +85,10 @@ if platform.system() == 'Windows':
 
 try:
     from fastapi import FastAPI, Request, Response, Query
-    from fastapi.responses import StreamingResponse
+    from fastapi.responses import FileResponse, StreamingResponse
     from fastapi_mcp import FastApiMCP
     from pydantic import BaseModel, Field
-    from contextlib import asynccontextmanager
+    from contextlib import AsyncExitStack, asynccontextmanager
     import httpx
 except ImportError as e:
     print(f"ERROR: Required Python packages not found: {str(e)}")
@@ -146,14 +154,30 @@ max_output_tokens = 10000  # Maximum tokens (approx 4 chars each), 0 for unlimit
 multi_session_enabled = True  # Whether multi-session mode is enabled (default: True)
 multi_session_max_sessions = 100  # Maximum concurrent sessions
 multi_session_timeout = 3600  # Session idle timeout in seconds
+multi_session_warm_sessions = 2  # Worker sessions pre-spawned at startup
 session_manager = None  # Will be initialized if multi-session is enabled
+# Timeout for internal stata_session tool calls (list/destroy). destroy waits at most ~8s
+# for a worker to go away (5s graceful exit, then terminate/kill)
+_SESSION_TOOL_TIMEOUT = 10.0
 
 # Execution tracking for stop/cancel functionality
 import threading
-execution_registry = {}  # Map: execution_id -> {'thread': thread, 'start_time': time, 'cancelled': bool, 'file': file}
-execution_lock = threading.Lock()  # Protect concurrent access to execution_registry
+execution_registry = {}  # Map: execution_id -> _Execution
+execution_lock = threading.Lock()  # Serializes registering/unregistering executions (readers don't lock)
 current_execution_id = None  # Track the current execution ID
 
+
+class _Execution:
+    """A running do-file registered in execution_registry for stop/status lookups."""
+    __slots__ = ('thread', 'file', 'start_time_ns', 'cancelled')
+
+    def __init__(self, thread, file: str):
+        self.thread = thread
+        self.file = file
+        self.start_time_ns = time.monotonic_ns()
+        self.cancelled = False
+
+
 # Try to import pandas
 try:
     import pandas as pd
@@ -164,6 +188,28 @@ except ImportError:
     logging.warning("pandas not available, data transfer functionality will be limited")
     warnings.warn("pandas not available, data transfer functionality will be limited")
 
+# Try to import watchfiles (optional - lets log streaming react to file changes instead of polling)
+try:
+    import watchfiles
+    has_watchfiles = True
+except ImportError:
+    has_watchfiles = False
+    logging.debug("watchfiles not available, log streaming will poll the log file")
+
+# Try to import psutil (optional - finds processes on a port without running netstat/lsof)
+try:
+    import psutil
+    has_psutil = True
+except ImportError:
+    has_psutil = False
+
+# Try to import orjson (optional - faster JSON encoding for tool responses)
+try:
+    import orjson
+    has_orjson = True
+except ImportError:
+    has_orjson = False
+
 # Try to initialize Stata with the given path
 def try_init_stata(stata_path):
     """Try to initialize Stata with the given path"""
@@ -359,6 +405,16 @@ def try_init_stata(stata_path):
 # Lock file mechanism removed - VS Code/Cursor handles extension instances properly
 # If there are port conflicts, the server will fail to start cleanly
 
+def _split_do_file_path(file_path: str) -> tuple[str, str, str]:
+    """Return (absolute path, directory, base name without extension) for a .do file.
+
+    Computed once per request so endpoints do not repeat the abspath/basename/splitext work.
+    """
+    abs_file_path = os.path.abspath(file_path)
+    file_dir, file_name = os.path.split(abs_file_path)
+    return abs_file_path, file_dir, os.path.splitext(file_name)[0]
+
+
 def get_log_file_path(do_file_path, do_file_base, session_id=None):
     """Get the appropriate log file path based on user settings
 
@@ -424,6 +480,29 @@ def get_log_file_path(do_file_path, do_file_base, session_id=None):
             log_path = os.path.join(do_file_dir, f"{do_file_base}{session_suffix}_mcp.log")
             return os.path.abspath(log_path)
 
+def _stat_or_none(path):
+    """Return os.stat(path), or None if the file is missing or unreadable.
+
+    Lets polling loops check existence and size with a single syscall.
+    """
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def _truncate_file(path):
+    """Create or truncate path, creating its parent directory only when it is missing.
+
+    The directory normally exists already, so this usually costs a single open()
+    instead of the extra syscalls of an unconditional os.makedirs(..., exist_ok=True).
+    """
+    try:
+        open(path, 'w').close()
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+
 def resolve_do_file_path(file_path: str) -> tuple[Optional[str], list[str]]:
     """Resolve a .do file path to an absolute location, mirroring run_stata_file logic.
 
@@ -653,6 +732,44 @@ def join_stata_line_continuations(code: str) -> str:
     return "\n".join(joined_lines)
 
 
+# Pre-processed .do files, keyed by absolute source path:
+# ((mtime_ns, size), content digest, processed path). Re-running an unchanged file reuses
+# its processed copy; a stat match skips even reading the source, and the digest catches
+# touched-but-unchanged files. A copy that is replaced or evicted is deleted once no run
+# holds it any more (see release_preprocessed_do_file).
+_preprocessed_do_files: Dict[str, tuple] = {}
+_preprocessed_do_file_holds: Dict[str, int] = {}  # Processed path -> runs using it
+_retired_do_files: set = set()  # Replaced/evicted copies still held by a run
+_preprocessed_do_files_lock = threading.Lock()
+_PREPROCESS_CACHE_SIZE = 256
+
+
+def _retire_preprocessed_do_file(processed_file: str):
+    """Delete a processed copy that left the cache, or defer it until its last run ends.
+
+    Must be called with _preprocessed_do_files_lock held.
+    """
+    if _preprocessed_do_file_holds.get(processed_file):
+        _retired_do_files.add(processed_file)
+        return
+    try:
+        os.unlink(processed_file)
+    except OSError:
+        pass
+
+
+def _hold_preprocessed_do_file(key: str, entry: tuple) -> str:
+    """Move a cache entry to the most-recent end and count one more run using it.
+
+    Must be called with _preprocessed_do_files_lock held.
+    """
+    _preprocessed_do_files.pop(key, None)
+    _preprocessed_do_files[key] = entry
+    processed_file = entry[2]
+    _preprocessed_do_file_holds[processed_file] = _preprocessed_do_file_holds.get(processed_file, 0) + 1
+    return processed_file
+
+
 def preprocess_do_file_for_graphs(file_path: str) -> str:
     """Pre-process a .do file to auto-name graphs and handle line continuations.
 
@@ -660,89 +777,210 @@ def preprocess_do_file_for_graphs(file_path: str) -> str:
     1. Joins lines with /// continuation
     2. Auto-names graph commands that don't have names (avoiding conflicts with existing names)
 
+    The result is cached on the source's stat and content hash, so re-running an
+    unchanged file returns the same pre-processed file without rewriting it.
+    Callers must pass the returned path to release_preprocessed_do_file once the
+    run has finished with it.
+
     Args:
         file_path: Path to the .do file
 
     Returns:
         Path to the pre-processed temporary file
     """
+    st = _stat_or_none(file_path)
+    if st is None:
+        logging.error(f"Error pre-processing do file: cannot stat {file_path}")
+        return file_path  # Return original file on error
+
+    key = os.path.abspath(file_path)
+    stat_key = (st.st_mtime_ns, st.st_size)
+    with _preprocessed_do_files_lock:
+        cached = _preprocessed_do_files.get(key)
+        if cached is not None and cached[0] == stat_key and os.path.exists(cached[2]):
+            logging.debug(f"Reusing pre-processed file for unchanged {file_path}: {cached[2]}")
+            return _hold_preprocessed_do_file(key, cached)
+
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-            do_file_content = f.read()
+        with open(file_path, 'rb') as f:
+            source = f.read()
+    except OSError as e:
+        logging.error(f"Error pre-processing do file: {e}")
+        return file_path  # Return original file on error
 
-        # First, join lines with Stata line continuation (///) into single logical lines
-        raw_lines = do_file_content.splitlines()
-        joined_lines = []
-        current_line = ""
-        for raw_line in raw_lines:
-            stripped = raw_line.rstrip()
-            if stripped.endswith('///'):
-                current_line += stripped[:-3].rstrip() + " "
-            else:
-                current_line += raw_line
-                joined_lines.append(current_line)
-                current_line = ""
-        if current_line:
-            joined_lines.append(current_line)
+    digest = hashlib.blake2b(source, digest_size=16).digest()
+    with _preprocessed_do_files_lock:
+        cached = _preprocessed_do_files.get(key)
+        if cached is not None and cached[1] == digest and os.path.exists(cached[2]):
+            # Touched but not changed: remember the new stat so the next run skips the read
+            logging.debug(f"Reusing pre-processed file for unchanged {file_path}: {cached[2]}")
+            return _hold_preprocessed_do_file(key, (stat_key, digest, cached[2]))
+
+    processed_file = _preprocess_do_file_for_graphs(file_path, source)
+    if processed_file == file_path:
+        return processed_file  # Pre-processing failed, nothing to cache
+
+    with _preprocessed_do_files_lock:
+        previous = _preprocessed_do_files.get(key)
+        _hold_preprocessed_do_file(key, (stat_key, digest, processed_file))
+        if previous is not None and previous[2] != processed_file:
+            _retire_preprocessed_do_file(previous[2])
+        while len(_preprocessed_do_files) > _PREPROCESS_CACHE_SIZE:
+            evicted = _preprocessed_do_files.pop(next(iter(_preprocessed_do_files)))
+            _retire_preprocessed_do_file(evicted[2])
+    return processed_file
+
+
+def release_preprocessed_do_file(processed_file: str):
+    """Mark one run of a file returned by preprocess_do_file_for_graphs as finished.
+
+    A copy that has left the cache is deleted when its last run releases it. Paths
+    that were never held (e.g. the original file after a pre-processing error) are ignored.
+    """
+    with _preprocessed_do_files_lock:
+        holds = _preprocessed_do_file_holds.get(processed_file)
+        if holds is None:
+            return
+        if holds > 1:
+            _preprocessed_do_file_holds[processed_file] = holds - 1
+            return
+        del _preprocessed_do_file_holds[processed_file]
+        if processed_file in _retired_do_files:
+            _retired_do_files.discard(processed_file)
+            _retire_preprocessed_do_file(processed_file)
+
+
+def _run_with_preprocessed_do_file(processed_file: str, func, *args, **kwargs):
+    """Call func (blocking) and release processed_file afterwards, in the same thread.
+
+    Releasing in the worker thread rather than the awaiting coroutine keeps the file
+    alive until the run really ends, even if the request is cancelled meanwhile.
+    """
+    try:
+        return func(*args, **kwargs)
+    finally:
+        release_preprocessed_do_file(processed_file)
 
-        # Find all existing graph names like "graph1", "graph2", etc. to avoid conflicts
-        existing_graph_nums = set()
-        for line in joined_lines:
-            # Look for name(graphN, ...) or name(graphN)
-            name_matches = re.findall(r'\bname\s*\(\s*graph(\d+)', str(line), re.IGNORECASE)
-            for num_str in name_matches:
-                try:
-                    existing_graph_nums.add(int(num_str))
-                except ValueError:
-                    pass
 
-        # Start counter from the next available number after existing ones
-        graph_counter = max(existing_graph_nums) if existing_graph_nums else 0
+def preprocess_do_text_for_graphs(do_file_content: str) -> str:
+    """Join /// continuations and auto-name unnamed graph commands in do-file text.
+
+    In-memory counterpart of preprocess_do_file_for_graphs, for callers that
+    already hold the code and would otherwise write it out just to read it back.
 
-        # Process each line to auto-name graphs
-        modified_content = ""
+    Args:
+        do_file_content: Stata code
+
+    Returns:
+        The rewritten code, one newline-terminated line per logical line
+    """
+    # First, join lines with Stata line continuation (///) into single logical lines
+    joined_code = join_stata_line_continuations(do_file_content)
+    joined_lines = joined_code.split("\n") if joined_code or do_file_content else []
+
+    # Find all existing graph names like "graph1", "graph2", etc. to avoid conflicts
+    existing_graph_nums = set()
+    for line in joined_lines:
+        # Look for name(graphN, ...) or name(graphN)
+        name_matches = _GRAPH_NAME_NUMBER_RE.findall(str(line))
+        for num_str in name_matches:
+            try:
+                existing_graph_nums.add(int(num_str))
+            except ValueError:
+                pass
 
-        for line in joined_lines:
-            line = str(line) if line is not None else ""
+    # Start counter from the next available number after existing ones
+    graph_counter = max(existing_graph_nums) if existing_graph_nums else 0
 
-            # Check if this is a graph creation command that might need a name
-            graph_match = re.match(r'^(\s*)(scatter|histogram|twoway|kdensity|graph\s+(bar|box|dot|pie|matrix|hbar|hbox|combine))\s+(.*)$', line, re.IGNORECASE)
+    # Process each line to auto-name graphs
+    modified_lines = []
 
-            if graph_match:
-                indent = str(graph_match.group(1) or "")
-                graph_cmd = str(graph_match.group(2) or "")
-                rest_raw = graph_match.group(4) if graph_match.lastindex >= 4 else ""
-                rest = str(rest_raw) if rest_raw else ""
+    for line in joined_lines:
+        line = str(line) if line is not None else ""
 
-                # Check if it already has name() option
-                if not re.search(r'\bname\s*\(', rest, re.IGNORECASE):
-                    graph_counter += 1
-                    graph_name = f"graph{graph_counter}"
+        # Check if this is a graph creation command that might need a name
+        graph_match = _GRAPH_COMMAND_RE.match(line)
 
-                    if ',' in rest:
-                        rest = re.sub(r',', f', name({graph_name}, replace)', rest, 1)
-                    else:
-                        rest = rest.rstrip() + f', name({graph_name}, replace)'
+        if graph_match:
+            indent = str(graph_match.group(1) or "")
+            graph_cmd = str(graph_match.group(2) or "")
+            rest_raw = graph_match.group(4) if graph_match.lastindex >= 4 else ""
+            rest = str(rest_raw) if rest_raw else ""
 
-                    modified_content += f"{indent}{graph_cmd} {rest}\n"
-                    continue
+            # Check if it already has name() option
+            if not _NAME_OPTION_RE.search(rest):
+                graph_counter += 1
+                graph_name = f"graph{graph_counter}"
 
-            modified_content += f"{line}\n"
+                if ',' in rest:
+                    rest = rest.replace(',', f', name({graph_name}, replace)', 1)
+                else:
+                    rest = rest.rstrip() + f', name({graph_name}, replace)'
+
+                modified_lines.append(f"{indent}{graph_cmd} {rest}\n")
+                continue
+
+        modified_lines.append(f"{line}\n")
 
-        auto_named_count = graph_counter - (max(existing_graph_nums) if existing_graph_nums else 0)
-        if auto_named_count > 0:
-            logging.info(f"Pre-processed {auto_named_count} graph commands for auto-naming (starting from graph{(max(existing_graph_nums) if existing_graph_nums else 0) + 1})")
+    auto_named_count = graph_counter - (max(existing_graph_nums) if existing_graph_nums else 0)
+    if auto_named_count > 0:
+        logging.info(f"Pre-processed {auto_named_count} graph commands for auto-naming (starting from graph{(max(existing_graph_nums) if existing_graph_nums else 0) + 1})")
+
+    return "".join(modified_lines)
+
+
+def _preprocess_do_file_for_graphs(file_path: str, source: bytes) -> str:
+    """Uncached implementation of preprocess_do_file_for_graphs, given the file's bytes."""
+    try:
+        modified_content = preprocess_do_text_for_graphs(source.decode('utf-8', errors='replace'))
 
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(suffix='.do', delete=False, mode='w', encoding='utf-8') as temp_do:
+        # Save to a new private temporary file
+        temp_fd, temp_path = _temp_do_file()
+        with os.fdopen(temp_fd, 'w', encoding='utf-8') as temp_do:
             temp_do.write(modified_content)
-            return temp_do.name
+        return temp_path
 
     except Exception as e:
         logging.error(f"Error pre-processing do file: {e}")
         return file_path  # Return original file on error
 
 
+# Constant helper commands issued around executions for graph tracking
+GR_LIST_OFF = "qui _gr_list off"
+GR_LIST_ON = "qui _gr_list on"
+GR_LIST_LIST = "qui _gr_list list"
+
+
+@functools.lru_cache(maxsize=None)
+def _encode_stata_command(command: str):
+    """Return the PyStata-encoded form of a constant Stata command.
+
+    Only use this for fixed strings (e.g. GR_LIST_OFF) - the encoded bytes are
+    cached for the lifetime of the process. get_encode_str is only importable
+    once Stata has been initialized, so the import is deferred to first use.
+    """
+    from pystata.config import get_encode_str
+    return get_encode_str(command)
+
+
+# Guards command_history so a clear reports exactly the entries it removed
+_history_lock = threading.Lock()
+
+
+def _record_history(command_entry: str, result: str) -> None:
+    """Append an executed command and its result to the command history"""
+    with _history_lock:
+        command_history.append({"command": command_entry, "result": result})
+
+
+def _clear_history() -> int:
+    """Empty the command history in place and return how many entries it held"""
+    with _history_lock:
+        count = len(command_history)
+        command_history.clear()
+    return count
+
+
 # Function to run a Stata command
 def run_stata_command(
     command: str,
@@ -763,15 +1001,15 @@ def run_stata_command(
     We do NOT use inline=True because it calls _gr_list off at the end, clearing our graph list!
     This function is only called from /v1/tools endpoint which is excluded from MCP.
     """
-    global stata_available, has_stata, command_history
+    global stata_available, has_stata
     
     # Only log at debug level instead of info to reduce verbosity
     logging.debug(f"Running Stata command: {command}")
     
     # Clear history if requested
     if clear_history:
-        logging.info(f"Clearing command history (had {len(command_history)} items)")
-        command_history = []
+        count = _clear_history()
+        logging.info(f"Cleared command history (had {count} items)")
         # If it's just a clear request with no command, return empty
         if not command or command.strip() == '':
             logging.info("Clear history request completed")
@@ -817,14 +1055,14 @@ def run_stata_command(
         try:
             # Reset graph tracking BEFORE execution to only detect NEW graphs
             try:
-                from pystata.config import stlib, get_encode_str
+                from pystata.config import stlib
                 logging.debug("Resetting graph list for new command...")
-                stlib.StataSO_Execute(get_encode_str("qui _gr_list off"), False)
-                stlib.StataSO_Execute(get_encode_str("qui _gr_list on"), False)
+                stlib.StataSO_Execute(_encode_stata_command(GR_LIST_OFF), False)
+                stlib.StataSO_Execute(_encode_stata_command(GR_LIST_ON), False)
                 logging.debug("Graph list reset successfully")
             except Exception as e:
                 logging.warning(f"Could not reset graph listing: {str(e)}")
-                logging.debug(f"Graph listing reset error: {traceback.format_exc()}")
+                logging.debug("Graph listing reset error details", exc_info=True)
 
             # Initialize graphs list (will be populated if graphs are found)
             graphs_from_interactive = []
@@ -847,7 +1085,7 @@ def run_stata_command(
                     line = str(line) if line is not None else ""
 
                     # Check if this is a cls command
-                    if re.match(r'^\s*cls\s*$', line, re.IGNORECASE):
+                    if _CLS_COMMAND_RE.match(line):
                         processed_command += f"* COMMENTED OUT BY MCP: {line}\n"
                         cls_commands_found += 1
                     else:
@@ -998,24 +1236,15 @@ def run_stata_command(
                 # Use graphs captured in interactive mode (if any)
                 # These were already captured right after execution while still in memory
                 if graphs_from_interactive:
-                    graph_info = "\n\n" + "="*60 + "\n"
-                    graph_info += f"GRAPHS DETECTED: {len(graphs_from_interactive)} graph(s) created\n"
-                    graph_info += "="*60 + "\n"
-                    for graph in graphs_from_interactive:
-                        # Include command if available, using special format for JavaScript parsing
-                        if 'command' in graph and graph['command']:
-                            graph_info += f"  • {graph['name']}: {graph['path']} [CMD: {graph['command']}]\n"
-                        else:
-                            graph_info += f"  • {graph['name']}: {graph['path']}\n"
-                    result += graph_info
+                    result += _format_graph_summary(graphs_from_interactive)
                     logging.info(f"Added {len(graphs_from_interactive)} graphs to output (from interactive mode)")
                 else:
                     logging.debug("No graphs were captured in interactive mode")
 
                 # Disable graph listing after detection
                 try:
-                    from pystata.config import stlib, get_encode_str
-                    stlib.StataSO_Execute(get_encode_str("qui _gr_list off"), False)
+                    from pystata.config import stlib
+                    stlib.StataSO_Execute(_encode_stata_command(GR_LIST_OFF), False)
                     logging.debug("Disabled graph listing")
                 except Exception as e:
                     logging.warning(f"Could not disable graph listing: {str(e)}")
@@ -1035,7 +1264,7 @@ def run_stata_command(
             # Add to command history
             timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
             command_entry = f"[{timestamp}] {command}"
-            command_history.append({"command": command_entry, "result": error_msg})
+            _record_history(command_entry, error_msg)
             return error_msg
             
     else:
@@ -1044,9 +1273,24 @@ def run_stata_command(
         # Add to command history
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
         command_entry = f"[{timestamp}] {command}"
-        command_history.append({"command": command_entry, "result": error_msg})
+        _record_history(command_entry, error_msg)
         return error_msg
 
+# Graphs go to the temp directory when no extension path is configured
+_DEFAULT_GRAPHS_DIR = os.path.join(tempfile.gettempdir(), 'stata_mcp_graphs')
+
+
+@functools.lru_cache(maxsize=1)
+def _graphs_dir_for(ext_path: Optional[str]) -> str:
+    """Resolve the graphs directory for an extension path (computed once per path)."""
+    return os.path.join(ext_path, 'graphs') if ext_path else _DEFAULT_GRAPHS_DIR
+
+
+def _graphs_dir() -> str:
+    """Return the directory exported graphs are written to (extension path or temp)."""
+    return _graphs_dir_for(extension_path)
+
+
 def detect_and_export_graphs():
     """Detect and export any graphs created by Stata commands
 
@@ -1070,7 +1314,7 @@ def detect_and_export_graphs():
         logging.debug("Checking for graphs using _gr_list (low-level API)...")
 
         # Get the list (_gr_list should already be on from before command execution)
-        rc = stlib.StataSO_Execute(get_encode_str("qui _gr_list list"), False)
+        rc = stlib.StataSO_Execute(_encode_stata_command(GR_LIST_LIST), False)
         logging.debug(f"_gr_list list returned rc={rc}")
         gnamelist = sfi.Macro.getGlobal("r(_grlist)")
         logging.debug(f"r(_grlist) returned: '{gnamelist}' (type: {type(gnamelist)}, length: {len(gnamelist) if gnamelist else 0})")
@@ -1084,10 +1328,7 @@ def detect_and_export_graphs():
         logging.info(f"Found {len(graph_names)} graph(s): {graph_names}")
 
         # Create graphs directory in extension path or temp
-        if extension_path:
-            graphs_dir = os.path.join(extension_path, 'graphs')
-        else:
-            graphs_dir = os.path.join(tempfile.gettempdir(), 'stata_mcp_graphs')
+        graphs_dir = _graphs_dir()
 
         os.makedirs(graphs_dir, exist_ok=True)
         logging.debug(f"Exporting graphs to: {graphs_dir}")
@@ -1138,6 +1379,28 @@ def detect_and_export_graphs():
         logging.error(f"Error detecting graphs: {str(e)}")
         return []
 
+def _format_graph_summary(graphs, include_commands: bool = True) -> str:
+    """Format the GRAPHS DETECTED block appended to execution output.
+
+    The layout must match the VS Code extension's parseGraphsFromOutput.
+
+    Args:
+        graphs: List of graph dicts with 'name', 'path' and optionally 'command'
+        include_commands: Whether to append " [CMD: ...]" for graphs that have a command
+
+    Returns:
+        The summary text, starting with a blank line
+    """
+    parts = ["", "", "=" * 60, f"GRAPHS DETECTED: {len(graphs)} graph(s) created", "=" * 60]
+    for graph in graphs:
+        line = f"  • {graph['name']}: {graph['path']}"
+        if include_commands and graph.get('command'):
+            line += f" [CMD: {graph['command']}]"
+        parts.append(line)
+    parts.append("")
+    return "\n".join(parts)
+
+
 def display_graphs_interactive(graph_format='png', width=800, height=600):
     """Display graphs using PyStata's interactive approach (similar to Jupyter)
 
@@ -1172,7 +1435,7 @@ def display_graphs_interactive(graph_format='png', width=800, height=600):
         logging.debug(f"Interactive graph display: checking for graphs (format: {graph_format})...")
 
         # Get the list of graphs (_gr_list should already be on from before file execution)
-        rc = stlib.StataSO_Execute(get_encode_str("qui _gr_list list"), False)
+        rc = stlib.StataSO_Execute(_encode_stata_command(GR_LIST_LIST), False)
         logging.debug(f"_gr_list list returned rc={rc}")
         gnamelist = sfi.Macro.getGlobal("r(_grlist)")
         logging.debug(f"r(_grlist) returned: '{gnamelist}' (type: {type(gnamelist)}, length: {len(gnamelist) if gnamelist else 0})")
@@ -1186,10 +1449,7 @@ def display_graphs_interactive(graph_format='png', width=800, height=600):
         logging.info(f"Found {len(graph_names)} graph(s) in interactive mode: {graph_names}")
 
         # Create graphs directory
-        if extension_path:
-            graphs_dir = os.path.join(extension_path, 'graphs')
-        else:
-            graphs_dir = os.path.join(tempfile.gettempdir(), 'stata_mcp_graphs')
+        graphs_dir = _graphs_dir()
 
         os.makedirs(graphs_dir, exist_ok=True)
         logging.debug(f"Exporting graphs to: {graphs_dir}")
@@ -1259,7 +1519,7 @@ def display_graphs_interactive(graph_format='png', width=800, height=600):
 
     except Exception as e:
         logging.error(f"Error in interactive graph display: {str(e)}")
-        logging.debug(f"Interactive display error details: {traceback.format_exc()}")
+        logging.debug("Interactive display error details", exc_info=True)
         return []
 
 def run_stata_selection(
@@ -1296,11 +1556,202 @@ def run_stata_selection(
     else:
         return run_stata_command(processed_selection, auto_detect_graphs=auto_detect_graphs)
 
+# Rewritten and pre-processed do-files live in a private per-process directory
+# (mkdtemp: mode 0700, unpredictable name), one file per run or source version. The
+# directory and anything left in it are removed when the server exits.
+_temp_do_dir = None
+_temp_do_dir_lock = threading.Lock()
+
+
+def _temp_do_file() -> tuple:
+    """Create a private temp .do file inside the per-process temp directory.
+
+    Returns:
+        Tuple of (open file descriptor, temp file path)
+    """
+    global _temp_do_dir
+    with _temp_do_dir_lock:
+        if _temp_do_dir is None:
+            _temp_do_dir = tempfile.mkdtemp(prefix='stata_mcp_')
+    return tempfile.mkstemp(suffix='.do', prefix='stata_mcp_', dir=_temp_do_dir)
+
+
+@atexit.register
+def _cleanup_temp_do_files():
+    """Remove the private temp directory and the .do files created in it during this process."""
+    if _temp_do_dir is not None:
+        shutil.rmtree(_temp_do_dir, ignore_errors=True)
+
+
+# Patterns for the final log cleanup, applied to the whole log at once.
+# SMCL codes ({...}) never span lines, matching the old per-line stripping
+_SMCL_RE = re.compile(r'\{[^}\n]*\}')
+_TRAILING_WS_RE = re.compile(r'[^\S\n]+$', re.MULTILINE)
+_BLANK_RUN_RE = re.compile(r'\n{3,}')
+_LOG_HEADER_SEPARATOR = '-------------'
+
+
+def _skip_log_header(log_content: str) -> str:
+    """Return the log text after the Stata header separator line.
+
+    Only a separator within the first 20 lines (and first 4 KB) counts as the header;
+    otherwise the log is returned unchanged.
+    """
+    sep = log_content.find(_LOG_HEADER_SEPARATOR, 0, 4096)
+    if sep == -1 or log_content.count('\n', 0, sep) >= 20:
+        return log_content
+    line_end = log_content.find('\n', sep)
+    return log_content[line_end + 1:] if line_end != -1 else ""
+
+
+def _clean_log_output(log_content: str) -> str:
+    """Strip the Stata header, trailing whitespace, blank-line runs and SMCL codes.
+
+    Args:
+        log_content: Full text of a Stata log file
+
+    Returns:
+        The cleaned log body
+    """
+    body = _skip_log_header(log_content)
+
+    # Terminate the last line so a single trailing '\n' can be dropped at the end
+    if body and not body.endswith('\n'):
+        body += '\n'
+
+    # Clean up SMCL formatting if present
+    if '{' in body:
+        body = _SMCL_RE.sub('', body)
+
+    # Trim each line, drop leading blank lines and collapse runs of blank lines
+    body = _TRAILING_WS_RE.sub('', body).lstrip('\n')
+    return _BLANK_RUN_RE.sub('\n\n', body)[:-1]
+
+
+# Byte patterns for the do-file rewrite; every keyword is ASCII, so they can be
+# matched on the raw file bytes without decoding
+_LOG_COMMAND_BYTES_RE = re.compile(rb'^\s*(log\s+using|log\s+close|capture\s+log\s+close)', re.IGNORECASE)
+_CLS_COMMAND_BYTES_RE = re.compile(rb'^\s*cls\s*$', re.IGNORECASE)
+_GRAPH_COMMAND_BYTES_RE = re.compile(
+    rb'^\s*(scatter|histogram|twoway|kdensity|graph\s+(bar|box|dot|pie|matrix|hbar|hbox|combine))\s',
+    re.IGNORECASE,
+)
+
+# Line-level patterns for auto-naming graphs in do-files and selections
+_GRAPH_COMMAND_RE = re.compile(r'^(\s*)(scatter|histogram|twoway|kdensity|graph\s+(bar|box|dot|pie|matrix|hbar|hbox|combine))\s+(.*)$', re.IGNORECASE)
+_GRAPH_NAME_NUMBER_RE = re.compile(r'\bname\s*\(\s*graph(\d+)', re.IGNORECASE)
+_NAME_OPTION_RE = re.compile(r'\bname\s*\(', re.IGNORECASE)
+_CLS_COMMAND_RE = re.compile(r'^\s*cls\s*$', re.IGNORECASE)
+
+# Any line preprocess_do_file_for_graphs could auto-name, searched across a whole script
+_GRAPH_COMMAND_LINE_RE = re.compile(
+    r'^[ \t]*(scatter|histogram|twoway|kdensity|graph\s+(bar|box|dot|pie|matrix|hbar|hbox|combine))\s',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def _mcp_disabled_command_kind(line: bytes) -> Optional[str]:
+    """Classify a raw do-file line that MCP must comment out.
+
+    Returns:
+        'log' for log using/close commands, 'cls' for cls, otherwise None
+    """
+    if _LOG_COMMAND_BYTES_RE.match(line):
+        return 'log'
+    if _CLS_COMMAND_BYTES_RE.match(line):
+        return 'cls'
+    return None
+
+
+def _auto_name_graph_line(line: str, graph_counter: int) -> tuple[Optional[str], int]:
+    """Add a name(graphN, replace) option to an unnamed graph creation command.
+
+    Args:
+        line: A single (continuation-joined) do-file line
+        graph_counter: Number of graphs auto-named so far
+
+    Returns:
+        (rewritten_line, graph_counter). rewritten_line is None when the line is
+        not a graph creation command or already has a name() option.
+    """
+    # Match: scatter, histogram, twoway, kdensity, graph bar/box/dot/etc (but not graph export)
+    graph_match = _GRAPH_COMMAND_RE.match(line)
+    if not graph_match:
+        return None, graph_counter
+
+    indent = graph_match.group(1) or ""
+    graph_cmd = graph_match.group(2) or ""
+    rest = graph_match.group(4) or ""
+
+    # Check if it already has name() option
+    if _NAME_OPTION_RE.search(rest):
+        return None, graph_counter
+
+    graph_counter += 1
+    graph_name = f"graph{graph_counter}"
+
+    # Add name option - if there's a comma, add after it; otherwise add with comma
+    if ',' in rest:
+        rest = rest.replace(',', f', name({graph_name}, replace)', 1)
+    else:
+        rest = rest.rstrip() + f', name({graph_name}, replace)'
+
+    return f"{indent}{graph_cmd} {rest}", graph_counter
+
+
+def _build_do_command_windows(path: str) -> str:
+    """Build a Stata do command for a Windows path, escaping embedded quotes."""
+    escaped = path.replace('"', '\\"')
+    return f'do "{escaped}"'
+
+
+def _build_do_command_posix(path: str) -> str:
+    """Build a Stata do command for a macOS/Linux path (double quotes are most reliable)."""
+    return f'do "{path}"'
+
+
+# The platform never changes at runtime, so pick the builder once at import
+_build_do_command = (
+    _build_do_command_windows if platform.system() == "Windows" else _build_do_command_posix
+)
+
+
+def _interrupt_thread(thread, done: threading.Event, wait: float = 1.0) -> bool:
+    """Raise KeyboardInterrupt inside a thread and wait for it to exit.
+
+    Args:
+        thread: The thread to interrupt
+        done: Event the thread sets when it finishes
+        wait: Maximum seconds to wait for the thread to exit
+
+    Returns:
+        True if the thread finished within `wait` seconds. The wait returns as
+        soon as `done` is set rather than sleeping for the full interval.
+    """
+    import ctypes
+
+    thread_id = thread.ident
+    if thread_id is None:
+        return False
+
+    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id),
+        ctypes.py_object(KeyboardInterrupt)
+    )
+    if res == 1:
+        logging.warning("KeyboardInterrupt raised in thread")
+        return done.wait(timeout=wait)
+    if res > 1:
+        # More than one thread state was affected - undo the async exception
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), None)
+    return False
+
 def run_stata_file(
     file_path: str,
     timeout: int = 600,
     auto_name_graphs: bool = False,
-    working_dir: Optional[str] = None
+    working_dir: Optional[str] = None,
+    auto_detect_graphs: bool = False
 ) -> str:
     """Run a Stata .do file with improved handling for long-running processes.
 
@@ -1311,10 +1762,16 @@ def run_stata_file(
         working_dir: Working directory to cd to before running (None = defaults to .do file's directory).
                      This affects where outputs like graph export, save, etc. are written.
                      Log files are saved to the location configured in logFileLocation setting (separate from working dir).
+        auto_detect_graphs: Whether to reset graph tracking before execution and export graphs
+                            afterwards (default: False for MCP/LLM calls, which ignore graphs)
     """
+    global current_execution_id
+
     # Set timeout from parameter instead of hardcoding
     MAX_TIMEOUT = timeout
-    
+    exec_id = None  # Set once the execution is registered for cancellation support
+    execution = None
+
     try:
         original_path = file_path
 
@@ -1363,99 +1820,78 @@ def run_stata_file(
         custom_log_file = get_log_file_path(file_path, do_file_base)
         logging.info(f"Will save log to: {custom_log_file}")
         
-        # Read the do file content
-        do_file_content = ""
+        # Read the do file as raw bytes: most lines are copied through untouched, so
+        # there is no reason to decode and re-encode the whole file
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                do_file_content = f.read()
+            with open(file_path, 'rb') as f:
+                do_file_bytes = f.read()
 
             # Create a modified version with log commands commented out and auto-name graphs
-            modified_content = ""
             log_commands_found = 0
             graph_counter = 0
 
             # First, join lines with Stata line continuation (///) into single logical lines
             # This prevents options like legend(off) from being treated as separate commands
-            raw_lines = do_file_content.splitlines()
+            raw_lines = do_file_bytes.splitlines()
             joined_lines = []
-            current_line = ""
+            current_line = b""
             for raw_line in raw_lines:
                 # Check if line ends with /// (Stata line continuation)
                 stripped = raw_line.rstrip()
-                if stripped.endswith('///'):
+                if stripped.endswith(b'///'):
                     # Remove /// and append to current line (keep one space)
-                    current_line += stripped[:-3].rstrip() + " "
+                    current_line += stripped[:-3].rstrip() + b" "
                 else:
                     # No continuation - complete the line
                     current_line += raw_line
                     joined_lines.append(current_line)
-                    current_line = ""
+                    current_line = b""
             # Handle any remaining content (in case file ends with ///)
             if current_line:
                 joined_lines.append(current_line)
 
-            # Process line by line to comment out log commands and add graph names where needed
+            # Process line by line to comment out log commands and add graph names where needed.
+            # The auto_name_graphs check is hoisted out of the loop so the common MCP/LLM path
+            # (no auto-naming) never touches the graph-matching regex.
             cls_commands_found = 0
-            for line in joined_lines:
-                # Ensure line is a string (defensive programming)
-                line = str(line) if line is not None else ""
-
-                # Check if this line has a log command
-                if re.match(r'^\s*(log\s+using|log\s+close|capture\s+log\s+close)', line, re.IGNORECASE):
-                    modified_content += f"* COMMENTED OUT BY MCP: {line}\n"
-                    log_commands_found += 1
-                    continue
-
-                # Check if this is a cls command
-                if re.match(r'^\s*cls\s*$', line, re.IGNORECASE):
-                    modified_content += f"* COMMENTED OUT BY MCP: {line}\n"
-                    cls_commands_found += 1
-                    continue
-
-                # Only auto-name graphs if called from VS Code extension (not from LLM/MCP)
-                if auto_name_graphs:
-                    # Check if this is a graph creation command that might need a name
-                    # Match: scatter, histogram, twoway, kdensity, graph bar/box/dot/etc (but not graph export)
-                    graph_match = re.match(r'^(\s*)(scatter|histogram|twoway|kdensity|graph\s+(bar|box|dot|pie|matrix|hbar|hbox|combine))\s+(.*)$', line, re.IGNORECASE)
-
-                    if graph_match:
-                        indent = str(graph_match.group(1) or "")
-                        graph_cmd = str(graph_match.group(2) or "")
-
-                        # Extract and ensure rest is a string
-                        rest_raw = graph_match.group(4) if graph_match.lastindex >= 4 else ""
-                        if rest_raw is None:
-                            rest_raw = ""
-                        # Force conversion to string to handle any edge cases
-                        rest = str(rest_raw)
-
-                        # Double-check rest is a string before any operations
-                        if not isinstance(rest, str):
-                            logging.warning(f"rest is not a string, type: {type(rest)}, value: {rest}, converting to string")
-                            rest = str(rest)
-
-                        # Check if it already has name() option
-                        if not re.search(r'\bname\s*\(', rest, re.IGNORECASE):
-                            # Add automatic unique name
-                            graph_counter += 1
-                            graph_name = f"graph{graph_counter}"
-
-                            # Add name option - if there's a comma, add after it; otherwise add with comma
-                            if ',' in rest:
-                                # Insert name option right after the first comma
-                                # Ensure rest is definitely a string before re.sub
-                                rest = str(rest)
-                                rest = re.sub(r',', f', name({graph_name}, replace)', rest, 1)
-                            else:
-                                # No comma yet, add it
-                                rest = rest.rstrip() + f', name({graph_name}, replace)'
+            modified_parts = []
+            if auto_name_graphs:
+                for line in joined_lines:
+                    disabled_kind = _mcp_disabled_command_kind(line)
+                    if disabled_kind is not None:
+                        modified_parts.append(b"* COMMENTED OUT BY MCP: " + line + b"\n")
+                        if disabled_kind == 'log':
+                            log_commands_found += 1
+                        else:
+                            cls_commands_found += 1
+                        continue
 
-                            modified_content += f"{indent}{graph_cmd} {rest}\n"
-                            logging.debug(f"Auto-named graph: {graph_name}")
+                    # Only graph commands are decoded; surrogateescape keeps any
+                    # non-UTF-8 bytes intact through the round trip
+                    if _GRAPH_COMMAND_BYTES_RE.match(line):
+                        named_line, graph_counter = _auto_name_graph_line(
+                            line.decode('utf-8', 'surrogateescape'), graph_counter
+                        )
+                        if named_line is not None:
+                            modified_parts.append(named_line.encode('utf-8', 'surrogateescape') + b"\n")
+                            logging.debug(f"Auto-named graph: graph{graph_counter}")
                             continue
 
-                # Keep line as-is (including graph export commands)
-                modified_content += f"{line}\n"
+                    # Keep line as-is (including graph export commands)
+                    modified_parts.append(line + b"\n")
+            else:
+                for line in joined_lines:
+                    disabled_kind = _mcp_disabled_command_kind(line)
+                    if disabled_kind is not None:
+                        modified_parts.append(b"* COMMENTED OUT BY MCP: " + line + b"\n")
+                        if disabled_kind == 'log':
+                            log_commands_found += 1
+                        else:
+                            cls_commands_found += 1
+                        continue
+
+                    modified_parts.append(line + b"\n")
+            modified_content = b"".join(modified_parts)
 
             logging.info(f"Found and commented out {log_commands_found} log commands in the do file")
             if cls_commands_found > 0:
@@ -1463,34 +1899,35 @@ def run_stata_file(
             if graph_counter > 0:
                 logging.info(f"Auto-named {graph_counter} graph commands")
             
-            # Save the modified content to a temporary file
-            with tempfile.NamedTemporaryFile(
-
-                suffix='.do', delete=False, mode='w', encoding='utf-8'
+            # Change working directory based on working_dir parameter
+            # If working_dir is None, default to .do file's directory (like native Stata)
+            # Otherwise, cd to the specified directory
+            # The log file uses an absolute path, so it's saved to the configured location
+            effective_working_dir = working_dir if working_dir is not None else do_file_dir
+            # Use forward slashes for Stata commands to avoid escape sequence issues on Windows
+            wd = os.path.normpath(effective_working_dir).replace('\\', '/')
+            logging.info(f"Setting working directory to: {wd}")
+            # Note: _gr_list on is enabled externally before .do file execution
+            # Note: Graph names are auto-injected above into modified_content
+            log_file_stata = custom_log_file.replace('\\', '/')
+
+            # Save the modified content to a private temp .do file for this run
+            # (removed by the Stata thread once the run finishes)
+            temp_fd, modified_do_file = _temp_do_file()
+            with os.fdopen(temp_fd, 'wb') as temp_do:
+                temp_do.write(
+                    # First close any existing log files, cd, then add our own log command
+                    (
+                        f"capture log close _all\n"
+                        f"cd \"{wd}\"\n"
+                        f"log using \"{log_file_stata}\", replace text\n"
+                    ).encode('utf-8')
+                    + modified_content
+                    # Ensure all logs are closed at the end
+                    # Note: We intentionally do NOT disable _gr_list so graphs persist for detection
+                    + b"\ncapture log close _all\n"
+                )
 
-            ) as temp_do:
-                # First close any existing log files
-                temp_do.write(f"capture log close _all\n")
-                # Change working directory based on working_dir parameter
-                # If working_dir is None, default to .do file's directory (like native Stata)
-                # Otherwise, cd to the specified directory
-                # The log file uses an absolute path, so it's saved to the configured location
-                effective_working_dir = working_dir if working_dir is not None else do_file_dir
-                # Use forward slashes for Stata commands to avoid escape sequence issues on Windows
-                wd = os.path.normpath(effective_working_dir).replace('\\', '/')
-                temp_do.write(f"cd \"{wd}\"\n")
-                logging.info(f"Setting working directory to: {wd}")
-                # Note: _gr_list on is enabled externally before .do file execution
-                # Note: Graph names are auto-injected above into modified_content
-                # Then add our own log command with absolute path
-                # Use forward slashes for Stata commands to avoid escape sequence issues on Windows
-                log_file_stata = custom_log_file.replace('\\', '/')
-                temp_do.write(f"log using \"{log_file_stata}\", replace text\n")
-                temp_do.write(modified_content)
-                temp_do.write(f"\ncapture log close _all\n")  # Ensure all logs are closed at the end
-                # Note: We intentionally do NOT disable _gr_list so graphs persist for detection
-                modified_do_file = temp_do.name
-                
             logging.info(f"Created modified do file at {modified_do_file}")
                 
         except Exception as e:
@@ -1515,16 +1952,8 @@ def run_stata_file(
         # Need to define result variable here so it's accessible in all code paths
         result = initial_result
         
-        # Create a properly escaped file path for Stata
-        if platform.system() == "Windows":
-            # On Windows, escape backslashes and quotes
-            stata_path = modified_do_file.replace('"', '\\"')
-            # Ensure the path is properly quoted for Windows
-            do_command = f'do "{stata_path}"'
-        else:
-            # On Unix systems (macOS/Linux), use double quotes for better compatibility
-            # Double quotes work more reliably across systems
-            do_command = f'do "{modified_do_file}"'
+        # Create a properly quoted do command for this platform
+        do_command = _build_do_command(modified_do_file)
         
         # Run the command in background with timeout
         try:
@@ -1534,13 +1963,15 @@ def run_stata_file(
             # Set up for PyStata execution
             if has_stata and stata_available:
                 # Reset graph tracking BEFORE execution to only detect NEW graphs
-                try:
-                    from pystata.config import stlib, get_encode_str
-                    stlib.StataSO_Execute(get_encode_str("qui _gr_list off"), False)
-                    stlib.StataSO_Execute(get_encode_str("qui _gr_list on"), False)
-                    logging.debug("Graph list reset for file execution")
-                except Exception as e:
-                    logging.warning(f"Could not reset graph listing: {str(e)}")
+                # (skipped entirely when the caller does not want graphs)
+                if auto_detect_graphs:
+                    try:
+                        from pystata.config import stlib
+                        stlib.StataSO_Execute(_encode_stata_command(GR_LIST_OFF), False)
+                        stlib.StataSO_Execute(_encode_stata_command(GR_LIST_ON), False)
+                        logging.debug("Graph list reset for file execution")
+                    except Exception as e:
+                        logging.warning(f"Could not reset graph listing: {str(e)}")
 
                 # Record start time for timeout tracking
                 start_time = time.time()
@@ -1555,22 +1986,15 @@ def run_stata_file(
                 # Execute command via PyStata in separate thread to allow polling
                 stata_thread = None
                 stata_error = None
+                # Set when the Stata thread exits so waits can return immediately
+                stata_done = threading.Event()
                 
                 def run_stata_thread():
                     nonlocal stata_error
                     try:
-                        # Make sure to properly quote the path - this is the key fix
+                        # do_command is already quoted for this platform by _build_do_command
                         # Use inline=False because inline=True calls _gr_list off!
-                        if platform.system() == "Windows":
-                            # Make sure Windows paths are properly escaped
-                            globals()['stata'].run(do_command, echo=False, inline=False)
-                        else:
-                            # On macOS/Linux, double-check the quoting - adding extra safety
-                            if not (do_command.startswith('do "') or do_command.startswith("do '")):
-                                do_command_fixed = f'do "{stata_path}"'
-                                globals()['stata'].run(do_command_fixed, echo=False, inline=False)
-                            else:
-                                globals()['stata'].run(do_command, echo=False, inline=False)
+                        globals()['stata'].run(do_command, echo=False, inline=False)
                     except KeyboardInterrupt:
                         stata_error = "cancelled"
                         logging.debug("Stata thread received KeyboardInterrupt")
@@ -1583,23 +2007,24 @@ def run_stata_file(
                             pass
                     except Exception as e:
                         stata_error = str(e)
+                    finally:
+                        # Stata has finished reading the do-file, so this run's copy can go
+                        try:
+                            os.unlink(modified_do_file)
+                        except OSError:
+                            pass
+                        stata_done.set()
                 
-                import threading
                 stata_thread = threading.Thread(target=run_stata_thread)
                 stata_thread.daemon = True
                 stata_thread.start()
 
                 # Register execution for cancellation support
-                global current_execution_id
                 exec_id = f"exec_{int(time.time() * 1000)}"
+                execution = _Execution(stata_thread, file_path)
                 with execution_lock:
                     current_execution_id = exec_id
-                    execution_registry[exec_id] = {
-                        'thread': stata_thread,
-                        'start_time': start_time,
-                        'cancelled': False,
-                        'file': file_path
-                    }
+                    execution_registry[exec_id] = execution
                 logging.info(f"Registered execution {exec_id} for file {file_path}")
 
                 # Poll for progress while command is running
@@ -1623,8 +2048,8 @@ def run_stata_file(
                                 if stlib is not None:
                                     stlib.StataSO_SetBreak()
                                     logging.warning("Called StataSO_SetBreak() to interrupt Stata")
-                                    time.sleep(0.5)  # Give it a moment
-                                    if not stata_thread.is_alive():
+                                    # Give it a moment, returning early once the thread exits
+                                    if stata_done.wait(timeout=0.5):
                                         termination_successful = True
                                         logging.warning("Thread terminated via StataSO_SetBreak()")
                             except Exception as e:
@@ -1634,27 +2059,9 @@ def run_stata_file(
                             if not termination_successful and stata_thread.is_alive():
                                 logging.warning(f"TIMEOUT - Attempt 2: Raising KeyboardInterrupt in thread via ctypes")
                                 try:
-                                    import ctypes
-                                    thread_id = stata_thread.ident
-                                    if thread_id is not None:
-                                        # Raise KeyboardInterrupt in the target thread
-                                        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(
-                                            ctypes.c_ulong(thread_id),
-                                            ctypes.py_object(KeyboardInterrupt)
-                                        )
-                                        if res == 1:
-                                            logging.warning("KeyboardInterrupt raised in thread")
-                                            time.sleep(1.0)  # Give more time for interrupt to propagate
-                                            if not stata_thread.is_alive():
-                                                termination_successful = True
-                                                logging.warning("Thread terminated via KeyboardInterrupt")
-                                        else:
-                                            # Reset if more than one thread affected
-                                            if res > 1:
-                                                ctypes.pythonapi.PyThreadState_SetAsyncExc(
-                                                    ctypes.c_ulong(thread_id),
-                                                    None
-                                                )
+                                    if _interrupt_thread(stata_thread, stata_done, wait=1.0):
+                                        termination_successful = True
+                                        logging.warning("Thread terminated via KeyboardInterrupt")
                                 except Exception as e:
                                     logging.warning(f"Thread interrupt failed: {str(e)}")
 
@@ -1673,24 +2080,24 @@ def run_stata_file(
                         logging.warning(f"Setting timeout error: {stata_error}")
                         break
 
-                    # Check for user-initiated cancellation
-                    with execution_lock:
-                        if exec_id in execution_registry and execution_registry[exec_id].get('cancelled', False):
-                            logging.debug(f"Execution {exec_id} was cancelled by user")
-                            stata_error = "cancelled"
-                            break
+                    # Check for user-initiated cancellation (a plain read, no lock needed)
+                    if execution.cancelled:
+                        logging.debug(f"Execution {exec_id} was cancelled by user")
+                        stata_error = "cancelled"
+                        break
 
                     # Check if it's time for an update
                     if current_time - last_update_time >= update_interval:
                         # IMPORTANT: Log progress frequently to keep SSE connection alive for long-running scripts
                         logging.info(f"⏱️  Execution in progress: {elapsed_time:.0f}s elapsed ({elapsed_time/60:.1f} minutes) of {MAX_TIMEOUT}s timeout")
 
-                        # Check if log file exists and has been updated
-                        if os.path.exists(custom_log_file):
+                        # Check if log file exists and has been updated (one stat call)
+                        log_stat = _stat_or_none(custom_log_file)
+                        if log_stat is not None:
                             log_file_exists = True
 
                             # Check log file size
-                            current_log_size = os.path.getsize(custom_log_file)
+                            current_log_size = log_stat.st_size
 
                             # If log has grown, report progress
                             if current_log_size > last_log_size:
@@ -1704,7 +2111,8 @@ def run_stata_file(
                                             new_lines = lines[last_reported_lines:]
 
                                             # Only report meaningful lines (skip empty lines and headers)
-                                            meaningful_lines = [line for line in new_lines if line.strip() and not line.startswith('-')]
+                                            # Index/isspace checks avoid allocating a stripped copy per line
+                                            meaningful_lines = [ln for ln in new_lines if ln and not (ln[0] == '-' or ln.isspace())]
 
                                             # If we have meaningful content, add it to result
                                             if meaningful_lines:
@@ -1744,33 +2152,28 @@ def run_stata_file(
                     is_cancelled = (
                         stata_error == "cancelled" or
                         "--Break--" in str(stata_error) or
-                        (exec_id in execution_registry and execution_registry[exec_id].get('cancelled', False))
+                        (execution is not None and execution.cancelled)
                     )
 
                     if is_cancelled:
                         logging.debug("Execution was cancelled by user")
                         # Read final log to include any output up to the break
-                        if os.path.exists(custom_log_file):
-                            try:
-                                with open(custom_log_file, 'r', encoding='utf-8', errors='replace') as log:
-                                    log_content = log.read()
-                                    # Extract just the output portion (after header)
-                                    lines = log_content.splitlines()
-                                    start_index = 0
-                                    for i, line in enumerate(lines):
-                                        if '-------------' in line and i < 20:
-                                            start_index = i + 1
-                                            break
-                                    if start_index < len(lines):
-                                        result = '\n'.join(lines[start_index:])
-                            except Exception as e:
-                                logging.debug(f"Could not read log file for cancelled execution: {e}")
+                        # (a missing log is handled by the except, no separate exists() stat)
+                        try:
+                            with open(custom_log_file, 'r', encoding='utf-8', errors='replace') as log:
+                                log_content = log.read()
+                            # Extract just the output portion (after header)
+                            output = _skip_log_header(log_content).rstrip('\n')
+                            if output:
+                                result = output
+                        except Exception as e:
+                            logging.debug(f"Could not read log file for cancelled execution: {e}")
                         # Add clear cancellation indicator and print to stdout
                         # (stdout is captured by VS Code extension for real-time display)
                         print("\n=== Execution stopped ===", flush=True)
                         result += "\n\n=== Execution stopped ==="
                         # Return result without error wrapper
-                        command_history.append({"command": command_entry, "result": result})
+                        _record_history(command_entry, result)
                         return result
                     else:
                         error_msg = f"Error executing Stata command: {stata_error}"
@@ -1778,52 +2181,29 @@ def run_stata_file(
                         result += f"\n*** ERROR: {stata_error} ***\n"
 
                         # Add command to history and return
-                        command_history.append({"command": command_entry, "result": result})
+                        _record_history(command_entry, result)
                         return result
                 
                 # Read final log output
                 if os.path.exists(custom_log_file):
                     try:
-                        with open(custom_log_file, 'r', encoding='utf-8', errors='replace') as log:
-                            log_content = log.read()
+                        # Read raw bytes and decode once; _clean_log_output strips the '\r' of CRLF logs
+                        with open(custom_log_file, 'rb') as log:
+                            log_content = log.read().decode('utf-8', errors='replace')
                             
                             # Clean up log content - remove headers and Stata startup info
-                            lines = log_content.splitlines()
-                            result_lines = []
-                            
-                            # Skip Stata header if present (search for the separator line)
-                            start_index = 0
-                            for i, line in enumerate(lines):
-                                if '-------------' in line and i < 20:  # Look in first 20 lines
-                                    start_index = i + 1
-                                    break
-                            
-                            # Process the content
-                            for i in range(start_index, len(lines)):
-                                # Ensure line is a string (defensive programming)
-                                line = str(lines[i]) if lines[i] is not None else ""
-                                line = line.rstrip()
-
-                                # Skip empty lines at beginning or redundant empty lines
-                                if not line.strip() and (not result_lines or not result_lines[-1].strip()):
-                                    continue
-
-                                # Clean up SMCL formatting if present
-                                if '{' in line:
-                                    line = re.sub(r'\{[^}]*\}', '', line)  # Remove {...} codes
-                                    
-                                result_lines.append(line)
-                            
+                            cleaned_log = _clean_log_output(log_content)
+
                             # Add completion message with final log content
                             completion_msg = f"\n*** Execution completed in {time.time() - start_time:.1f} seconds ***\n"
                             completion_msg += "Final output:\n"
-                            completion_msg += "\n".join(result_lines)
+                            completion_msg += cleaned_log
 
                             # Replace the result with a clean summary
                             result = f">>> {command_entry}\n{completion_msg}"
 
                             # Only detect and export graphs if called from VS Code extension (not from LLM/MCP)
-                            if auto_name_graphs:
+                            if auto_detect_graphs:
                                 # Detect and export any graphs created by the do file
                                 # Using interactive mode which should work because inline=True keeps graphs in memory
                                 try:
@@ -1831,22 +2211,13 @@ def run_stata_file(
                                     graphs = display_graphs_interactive(graph_format='png', width=800, height=600)
                                     logging.debug(f"Graph detection returned: {graphs}")
                                     if graphs:
-                                        graph_info = "\n\n" + "="*60 + "\n"
-                                        graph_info += f"GRAPHS DETECTED: {len(graphs)} graph(s) created\n"
-                                        graph_info += "="*60 + "\n"
-                                        for graph in graphs:
-                                            # Include command if available, using special format for JavaScript parsing
-                                            if 'command' in graph and graph['command']:
-                                                graph_info += f"  • {graph['name']}: {graph['path']} [CMD: {graph['command']}]\n"
-                                            else:
-                                                graph_info += f"  • {graph['name']}: {graph['path']}\n"
-                                        result += graph_info
+                                        result += _format_graph_summary(graphs)
                                         logging.info(f"Detected {len(graphs)} graphs from do file: {[g['name'] for g in graphs]}")
                                     else:
                                         logging.debug("No graphs detected from do file")
                                 except Exception as e:
                                     logging.warning(f"Error detecting graphs: {str(e)}")
-                                    logging.debug(f"Graph detection error details: {traceback.format_exc()}")
+                                    logging.debug("Graph detection error details", exc_info=True)
 
                             # Log the final file location
                             result += f"\n\nLog file saved to: {custom_log_file}"
@@ -1874,34 +2245,65 @@ def run_stata_file(
             result = f">>> {command_entry}\n{error_msg}"
         
         # Add to command history and return result
-        command_history.append({"command": command_entry, "result": result})
-
-        # Cleanup: unregister execution
-        with execution_lock:
-            if 'exec_id' in dir() and exec_id in execution_registry:
-                del execution_registry[exec_id]
-                logging.info(f"Unregistered execution {exec_id}")
-            current_execution_id = None
-
+        _record_history(command_entry, result)
         return result
 
     except Exception as e:
         error_msg = f"Error in run_stata_file: {str(e)}"
         logging.error(error_msg)
+        return error_msg
 
-        # Cleanup on error: unregister execution
-        with execution_lock:
-            if 'exec_id' in dir() and exec_id in execution_registry:
-                del execution_registry[exec_id]
-            current_execution_id = None
+    finally:
+        # Cleanup: unregister execution (also on the early cancellation/error returns)
+        if exec_id is not None:
+            with execution_lock:
+                if execution_registry.pop(exec_id, None) is not None:
+                    logging.info(f"Unregistered execution {exec_id}")
+                if current_execution_id == exec_id:
+                    current_execution_id = None
+
+def _kill_port_listeners_psutil(port) -> bool:
+    """Kill processes listening on port using psutil instead of netstat/lsof.
+
+    Returns:
+        True if the connection table could be read, False if the caller should fall
+        back to the platform commands (psutil needs extra privileges on macOS)
+    """
+    try:
+        pids = {
+            conn.pid for conn in psutil.net_connections(kind='inet')
+            if conn.pid and conn.laddr and conn.laddr.port == port and conn.status == psutil.CONN_LISTEN
+        }
+    except psutil.AccessDenied:
+        return False
+
+    if not pids:
+        logging.info(f"No process found using port {port}")
+        return True
+
+    killed = []
+    for pid in pids:
+        logging.info(f"Found process with PID {pid} using port {port}")
+        try:
+            proc = psutil.Process(pid)
+            proc.kill()
+            killed.append(proc)
+            logging.info(f"Killed process with PID {pid}")
+        except psutil.Error as kill_error:
+            logging.warning(f"Error killing process with PID {pid}: {str(kill_error)}")
+
+    # Wait (at most a second) for the processes to exit so the port is released
+    psutil.wait_procs(killed, timeout=1)
+    return True
 
-        return error_msg
 
 # Function to kill any process using the specified port
 def kill_process_on_port(port):
     """Kill any process that is currently using the specified port"""
     try:
-        if platform.system() == "Windows":
+        if has_psutil and _kill_port_listeners_psutil(port):
+            pass  # Handled in-process, no netstat/lsof subprocess needed
+        elif platform.system() == "Windows":
             # Windows command to find and kill process on port
             find_cmd = f"netstat -ano | findstr :{port}"
             try:
@@ -1970,28 +2372,51 @@ def kill_process_on_port(port):
     except Exception as socket_error:
         logging.warning(f"Error checking port availability: {str(socket_error)}")
 
-# Function to find an available port
-def find_available_port(start_port, max_attempts=10):
-    """Find an available port starting from start_port"""
-    for port_offset in range(max_attempts):
-        port = start_port + port_offset
+def _port_has_listener(host: str, port: int) -> bool:
+    """Check whether something is accepting connections on host:port.
+
+    The port is first probed by binding it as uvicorn will (SO_REUSEADDR off Windows,
+    so sockets left in TIME_WAIT do not count). Only when that fails is a listener
+    confirmed with a connect, since a bind can also fail for other reasons.
+    """
+    try:
+        family, _, _, _, addr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    except socket.gaierror:
+        return False
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        if platform.system() != "Windows":
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(1)
-                result = s.connect_ex(('localhost', port))
-                if result != 0:  # Port is available
-                    logging.info(f"Found available port: {port}")
-                    return port
-        except Exception as e:
-            logging.warning(f"Error checking port {port}: {str(e)}")
-    
-    # If we get here, we couldn't find an available port
-    logging.warning(f"Could not find an available port after {max_attempts} attempts")
-    return None
+            s.bind(addr)
+            return False
+        except OSError:
+            pass
+    # A wildcard address cannot be connected to; its listeners answer on loopback
+    if addr[0] in ('0.0.0.0', '::'):
+        addr = ('127.0.0.1' if family == socket.AF_INET else '::1',) + tuple(addr[1:])
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.settimeout(1)
+        return s.connect_ex(addr) == 0
 
 # Note: API models (RunSelectionParams, RunFileParams, ToolRequest, ToolResponse)
 # are now imported from api_models.py
 
+def _default_executor_size() -> int:
+    """Number of threads for the loop's default executor used by asyncio.to_thread
+
+    STATA_MCP_THREAD_POOL overrides the size; otherwise it follows the session limit,
+    capped at the same 32 threads as Python's own default.
+    """
+    configured = os.environ.get('STATA_MCP_THREAD_POOL')
+    if configured:
+        try:
+            return max(2, int(configured))
+        except ValueError:
+            logging.warning(f"Ignoring invalid STATA_MCP_THREAD_POOL value: {configured}")
+    sessions = multi_session_max_sessions if multi_session_enabled else 1
+    return max(8, min(32, sessions + 4))
+
+
 # Define lifespan context manager for startup/shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -1999,20 +2424,26 @@ async def lifespan(app: FastAPI):
     # Startup: Log startup
     logging.info("FastAPI application starting up")
 
-    # Start HTTP session manager if it exists
-    if hasattr(app.state, '_http_session_manager_starter'):
-        logging.debug("Calling HTTP session manager startup handler")
-        await app.state._http_session_manager_starter()
+    # Bound the threads used for blocking Stata calls made through asyncio.to_thread
+    pool_size = _default_executor_size()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="stata-io")
+    )
+    logging.debug(f"Default executor limited to {pool_size} threads")
 
-    yield  # Application runs
+    # The exit stack stops anything started here, even if a later startup step fails
+    async with AsyncExitStack() as stack:
+        # Run the HTTP session manager's task group if the streamable transport is mounted
+        http_session_manager = getattr(app.state, 'http_session_manager', None)
+        if http_session_manager is not None:
+            logging.info("Starting StreamableHTTP session manager...")
+            await stack.enter_async_context(http_session_manager.run())
+            logging.info("✓ StreamableHTTP session manager started successfully")
 
-    # Shutdown: Stop HTTP session manager if it exists
-    if hasattr(app.state, '_http_session_manager_stopper'):
-        logging.debug("Calling HTTP session manager shutdown handler")
-        await app.state._http_session_manager_stopper()
+        yield  # Application runs
 
-    # Cleanup if needed
-    logging.info("FastAPI application shutting down")
+        # Cleanup if needed
+        logging.info("FastAPI application shutting down")
 
 # API Tags for documentation organization
 tags_metadata = [
@@ -2116,14 +2547,214 @@ async def stata_run_selection_endpoint(selection: str, session_id: str = None, w
     else:
         result = run_stata_selection(selection, working_dir=working_dir)
 
-    # Format output for better display - replace escaped newlines with actual newlines
-    formatted_result = result.replace("\\n", "\n")
     # Apply MCP output processing (compact mode filtering and token limit)
-    formatted_result = process_mcp_output(formatted_result, for_mcp=True)
+    formatted_result = process_mcp_output(result, for_mcp=True)
     return Response(content=formatted_result, media_type="text/plain")
 
-async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir: str = None, session_id: str = None):
-    """Async generator that runs Stata file and yields SSE progress events
+# Shared pool for the blocking part of SSE streaming runs (bounded, reused threads)
+_STREAM_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="stata-stream")
+
+# Response headers shared by the SSE streaming endpoints
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",  # Disable nginx buffering
+}
+
+
+class _LogTail:
+    """Incrementally read the text a running Stata session appends to its log file.
+
+    read() does blocking file I/O; the streaming generators call it through
+    asyncio.to_thread so a slow disk never stalls the event loop.
+
+    The file handle stays open between reads and is only reopened when the log is
+    replaced or truncated. On Windows it is closed after every read instead, so an
+    open handle can never block Stata's ``log using ..., replace``.
+    """
+
+    def __init__(self, path: str, max_read: int = 1 << 20):
+        self.path = path
+        self.max_read = max_read  # Upper bound on the bytes returned by one read()
+        self._fh = None
+        self._ino = None
+        self._pos = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.got_data = False  # Whether the last read() returned new bytes
+        self.pending = False  # Whether the last read() left unread bytes behind
+
+    def read(self) -> str:
+        """Return the text appended since the last call ('' if there is none).
+
+        At most max_read bytes are read per call, so a client that fell behind
+        catches up in bounded chunks instead of one event holding the whole backlog.
+        """
+        self.got_data = False
+        self.pending = False
+        st = _stat_or_none(self.path)
+        if st is None:
+            return ""
+        if st.st_ino != self._ino or st.st_size < self._pos:
+            # New, replaced or truncated log - start again from the beginning
+            self.close()
+            self._ino = st.st_ino
+            self._pos = 0
+            self._decoder.reset()
+        if st.st_size == self._pos:
+            return ""
+
+        if self._fh is None:
+            self._fh = open(self.path, 'rb')
+            self._fh.seek(self._pos)
+        data = self._fh.read(self.max_read)
+        self._pos += len(data)
+        self.got_data = bool(data)
+        self.pending = self._pos < st.st_size
+        if platform.system() == "Windows":
+            self.close()
+        return self._decoder.decode(data)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def _sse_event(lines) -> str:
+    """Pack several output lines into one SSE event (one data: field per line).
+
+    Clients see the same data: lines as with one event per line, but a busy tick
+    costs a single write down the ASGI stack. Falsy entries are skipped.
+
+    Returns:
+        The event text, or "" when there is nothing to send
+    """
+    fields = [f"data: {line}\n" for line in lines if line]
+    return "".join(fields) + "\n" if fields else ""
+
+
+# Markers written around a streamed selection to find the user code's output in the log
+_SELECTION_MARKER_PREFIX = "__STATA_MCP_OUTPUT_"
+_SELECTION_START_MARKER = _SELECTION_MARKER_PREFIX + "START__"
+_SELECTION_END_MARKER = _SELECTION_MARKER_PREFIX + "END__"
+
+
+def _slice_user_output(text: str, in_user_output: bool) -> tuple[str, bool]:
+    """Keep the parts of a log chunk that lie between the selection start/end markers.
+
+    Searches for the marker prefix with str.find instead of testing every line, and
+    copies whole runs of user output at once. Lines holding a marker are dropped.
+
+    Args:
+        text: Newly read log text
+        in_user_output: Whether the previous chunk ended inside the user code's output
+
+    Returns:
+        Tuple of (user output text, whether this chunk ends inside the user output)
+    """
+    parts = []
+    pos = 0  # Start of the line where the current run began
+    search = 0
+    while True:
+        idx = text.find(_SELECTION_MARKER_PREFIX, search)
+        if idx < 0:
+            break
+        line_start = text.rfind('\n', 0, idx) + 1
+        line_end = text.find('\n', idx)
+        line_end = len(text) if line_end < 0 else line_end + 1
+        line = text[line_start:line_end]
+        if _SELECTION_START_MARKER in line:
+            new_state = True
+        elif _SELECTION_END_MARKER in line:
+            new_state = False
+        else:
+            search = line_end  # Just the prefix - an ordinary line
+            continue
+        if in_user_output:
+            parts.append(text[pos:line_start])
+        in_user_output = new_state
+        pos = search = line_end
+    if in_user_output:
+        parts.append(text[pos:])
+    return "".join(parts), in_user_output
+
+
+async def _log_change_ticks(log_tail: "_LogTail", interval: float):
+    """Yield whenever the tailed log may have new content, and at least every interval seconds.
+
+    Uses OS file-change notifications through watchfiles when it is installed. The
+    parent directory is watched so a log that Stata replaces keeps being tracked.
+    Otherwise it polls with _poll_log_ticks.
+    """
+    if has_watchfiles:
+        target = os.path.abspath(log_tail.path)
+        async for _ in watchfiles.awatch(
+            os.path.dirname(target),
+            watch_filter=lambda change, path: path == target,
+            debounce=50,
+            rust_timeout=int(interval * 1000),
+            yield_on_timeout=True,
+            recursive=False,
+        ):
+            yield
+    else:
+        async for _ in _poll_log_ticks(log_tail, interval):
+            yield
+
+
+async def _poll_log_ticks(log_tail: "_LogTail", interval: float):
+    """Poll with a backoff: 100 ms right after output arrived, doubling while the log stays idle, up to interval"""
+    idle_ticks = 0
+    while True:
+        idle_ticks = 0 if log_tail.got_data else idle_ticks + 1
+        await asyncio.sleep(min(interval, 0.1 * 2 ** min(idle_ticks, 3)))
+        yield
+
+
+class _LogTicker:
+    """Owns a _log_change_ticks generator and the task waiting on its next tick.
+
+    The pending tick survives across wait() calls, and aclose() cancels and awaits
+    it before closing the generator (closing a generator that a task is still
+    running raises RuntimeError). If the file watcher stops or fails, ticks fall
+    back to _poll_log_ticks.
+    """
+
+    def __init__(self, log_tail: "_LogTail", interval: float):
+        self._log_tail = log_tail
+        self._interval = interval
+        self._ticks = _log_change_ticks(log_tail, interval)
+        self._tick: Optional[asyncio.Future] = None
+
+    async def wait(self, execution: asyncio.Future):
+        """Wait for the next tick, returning early if execution completes"""
+        if self._tick is None:
+            self._tick = asyncio.ensure_future(self._ticks.__anext__())
+        await asyncio.wait({self._tick, execution}, return_when=asyncio.FIRST_COMPLETED)
+        if not self._tick.done():
+            return
+
+        tick, self._tick = self._tick, None
+        exc = None if tick.cancelled() else tick.exception()
+        if exc is not None:
+            # StopAsyncIteration or a watcher error: the generator is finished, so poll instead
+            logging.debug(f"Log watcher stopped ({exc!r}); falling back to polling")
+            self._ticks = _poll_log_ticks(self._log_tail, self._interval)
+
+    async def aclose(self):
+        """Cancel any pending tick, then close the tick generator"""
+        if self._tick is not None:
+            tick, self._tick = self._tick, None
+            tick.cancel()
+            try:
+                await tick
+            except (asyncio.CancelledError, Exception):
+                pass
+        await self._ticks.aclose()
+
+
+async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir: str = None, session_id: str = None):
+    """Async generator that runs Stata file and yields SSE progress events
 
     Streams output incrementally by monitoring the log file during execution.
     Works with both single-session and multi-session modes.
@@ -2137,15 +2768,9 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
     Yields:
         SSE formatted events with incremental output
     """
-    import threading
-    import queue as queue_module
-
-    # Queue to communicate between threads
-    result_queue = queue_module.Queue()
-
     # Determine log file path - must match what run_stata_file/worker uses
-    abs_file_path = os.path.abspath(file_path)
-    base_name = os.path.splitext(os.path.basename(abs_file_path))[0]
+    # original_file_dir is used as working_dir (not the temp file's directory)
+    abs_file_path, original_file_dir, base_name = _split_do_file_path(file_path)
 
     # For single-session mode, use get_log_file_path() which respects user settings
     # For multi-session mode, we pass this path to the worker
@@ -2157,22 +2782,16 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
     # Clear (truncate) the log file before starting new execution
     # This ensures we don't read stale content from previous runs
     try:
-        # Ensure parent directory exists
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        # Truncate or create empty file
-        with open(log_file, 'w') as f:
-            pass  # Just open and close to truncate
+        # Truncate or create empty file (creating the parent directory if needed)
+        await asyncio.to_thread(_truncate_file, log_file)
         logging.debug(f"[STREAM] Cleared log file: {log_file}")
     except Exception as e:
         logging.warning(f"[STREAM] Could not clear log file: {e}")
 
     # Pre-process the file to auto-name graphs and handle line continuations
-    processed_file = preprocess_do_file_for_graphs(file_path)
+    processed_file = await asyncio.to_thread(preprocess_do_file_for_graphs, file_path)
     logging.debug(f"[STREAM] Pre-processed file: {processed_file}")
 
-    # Get the original file's directory for working_dir (not the temp file's directory)
-    original_file_dir = os.path.dirname(os.path.abspath(file_path))
-
     def run_with_progress():
         """Run Stata file in thread"""
         try:
@@ -2197,7 +2816,7 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
             else:
                 logging.info("[STREAM] Using single-session mode")
                 # Note: run_stata_file handles graph reset and detection internally
-                result = run_stata_file(processed_file, timeout=timeout, working_dir=working_dir, auto_name_graphs=True)
+                result = run_stata_file(processed_file, timeout=timeout, working_dir=working_dir, auto_name_graphs=True, auto_detect_graphs=True)
                 # Detect graphs after execution for single-session streaming mode
                 # This is needed because streaming reads log file directly, not the returned result string
                 # run_stata_file already reset the graph list before execution
@@ -2210,18 +2829,20 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
                         logging.debug("[STREAM] No graphs detected in single-session mode")
                 except Exception as e:
                     logging.warning(f"[STREAM] Error detecting graphs: {str(e)}")
-            result_queue.put(('success', result, graphs))
+            return ('success', result, graphs)
         except Exception as e:
             logging.error(f"[STREAM] Execution error: {str(e)}")
-            result_queue.put(('error', str(e), []))
+            return ('error', str(e), [])
+        finally:
+            release_preprocessed_do_file(processed_file)
 
-    # Start execution thread
-    thread = threading.Thread(target=run_with_progress, daemon=True)
-    thread.start()
+    # Start execution on the shared stream pool
+    execution = asyncio.get_running_loop().run_in_executor(_STREAM_EXECUTOR, run_with_progress)
 
     start_time = time.time()
-    last_read_pos = 0  # Track byte position in file for incremental reading
-    check_interval = 0.5  # Check every 500ms for responsive streaming
+    log_tail = _LogTail(log_file)  # Keeps the log open and tracks what was already sent
+    check_interval = 0.5  # Check at least every 500ms for responsive streaming
+    log_ticks = _LogTicker(log_tail, check_interval)
 
     # Monitor progress by reading log file incrementally using byte offset
     # Wrap in try-except to handle client disconnection gracefully
@@ -2230,30 +2851,28 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
         # Yield initial event
         yield f"data: Starting execution of {os.path.basename(file_path)}...\n\n"
 
-        while thread.is_alive():
+        while not execution.done():
             current_time = time.time()
             elapsed = current_time - start_time
 
             # Check log file for new content
-            if os.path.exists(log_file):
-                try:
-                    current_size = os.path.getsize(log_file)
-                    if current_size > last_read_pos:
-                        with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
-                            f.seek(last_read_pos)
-                            new_content = f.read()
-                            last_read_pos = f.tell()
-
-                        # Send only new lines (no filtering for VS Code - full output)
-                        if new_content.strip():
-                            for line in new_content.splitlines():
-                                if line.strip():
-                                    escaped = line.replace('\\', '\\\\')
-                                    yield f"data: {escaped}\n\n"
-                except Exception as e:
-                    logging.debug(f"Error reading log file: {e}")
+            try:
+                new_content = await asyncio.to_thread(log_tail.read)
+
+                # Send only new lines (no filtering for VS Code - full output)
+                if new_content.strip():
+                    # Escape backslashes once for the whole chunk, then send its lines as one event
+                    escaped_lines = new_content.replace('\\', '\\\\').splitlines()
+                    frame = _sse_event(line for line in escaped_lines if line.strip())
+                    if frame:
+                        yield frame
+            except Exception as e:
+                logging.debug(f"Error reading log file: {e}")
 
-            await asyncio.sleep(check_interval)
+            # Wake up as soon as the log changes or the execution finishes
+            # (or after check_interval at the latest); keep reading while a backlog remains
+            if not log_tail.pending:
+                await log_ticks.wait(execution)
 
             # Check timeout
             if elapsed > timeout:
@@ -2262,23 +2881,22 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
 
         # Get final result - check for any remaining content
         try:
-            status, result, graphs = result_queue.get(timeout=5.0)
+            status, result, graphs = await asyncio.wait_for(asyncio.shield(execution), timeout=5.0)
 
             # Read any remaining log file content not yet sent
-            if os.path.exists(log_file):
-                try:
-                    current_size = os.path.getsize(log_file)
-                    if current_size > last_read_pos:
-                        with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
-                            f.seek(last_read_pos)
-                            remaining = f.read()
-                        if remaining.strip():
-                            for line in remaining.splitlines():
-                                if line.strip():
-                                    escaped = line.replace('\\', '\\\\')
-                                    yield f"data: {escaped}\n\n"
-                except Exception as e:
-                    logging.debug(f"Error reading final log content: {e}")
+            try:
+                while True:
+                    remaining = await asyncio.to_thread(log_tail.read)
+                    if remaining.strip():
+                        # Escape backslashes once for the whole chunk, then send its lines as one event
+                        escaped_lines = remaining.replace('\\', '\\\\').splitlines()
+                        frame = _sse_event(line for line in escaped_lines if line.strip())
+                        if frame:
+                            yield frame
+                    if not log_tail.pending:
+                        break
+            except Exception as e:
+                logging.debug(f"Error reading final log content: {e}")
 
             if status == 'error':
                 yield f"data: ERROR: {result}\n\n"
@@ -2295,11 +2913,16 @@ async def stata_run_file_stream(file_path: str, timeout: int = 600, working_dir:
                         yield f"data:   • {graph['name']}: {graph['path']}\n\n"
                     logging.info(f"[STREAM] Sent {len(graphs)} graph(s) info to client")
 
-        except queue_module.Empty:
+        except asyncio.TimeoutError:
             yield "data: ERROR: Failed to get execution result (timeout)\n\n"
 
+        log_tail.close()
+        await log_ticks.aclose()
+
     except (GeneratorExit, asyncio.CancelledError):
         # Client disconnected - exit cleanly without trying to yield more data
+        log_tail.close()
+        await log_ticks.aclose()
         logging.debug("[STREAM] Client disconnected, stopping stream")
         return
 
@@ -2347,22 +2970,21 @@ async def stata_run_file_endpoint(
         logging.info(f"Working directory: {working_dir}")
 
     # Pre-process the file to auto-name graphs and handle line continuations
-    processed_file = preprocess_do_file_for_graphs(file_path)
+    processed_file = await asyncio.to_thread(preprocess_do_file_for_graphs, file_path)
     logging.debug(f"Pre-processed file: {processed_file}")
 
     # Route through session manager if multi-session is enabled
     if multi_session_enabled and session_manager is not None:
         # Determine log file path based on user settings
         # Include session_id in log filename to prevent file locking conflicts in parallel execution
-        abs_file_path = os.path.abspath(file_path)
-        base_name = os.path.splitext(os.path.basename(abs_file_path))[0]
+        # original_file_dir is used as working_dir (not the temp file's directory)
+        abs_file_path, original_file_dir, base_name = _split_do_file_path(file_path)
         log_file = get_log_file_path(file_path, base_name, session_id)
 
-        # Get the original file's directory for working_dir (not the temp file's directory)
-        original_file_dir = os.path.dirname(abs_file_path)
-
         # Run blocking session_manager.execute_file in thread pool to allow concurrent requests
         result_dict = await asyncio.to_thread(
+            _run_with_preprocessed_do_file,
+            processed_file,
             session_manager.execute_file,
             processed_file,
             session_id=session_id,
@@ -2375,14 +2997,15 @@ async def stata_run_file_endpoint(
         else:
             result = f"Error: {result_dict.get('error', 'Unknown error')}"
     else:
-        result = await asyncio.to_thread(run_stata_file, processed_file, timeout=timeout, working_dir=working_dir)
-
-    # Format output for better display - replace escaped newlines with actual newlines
-    formatted_result = result.replace("\\n", "\n")
+        result = await asyncio.to_thread(
+            _run_with_preprocessed_do_file,
+            processed_file,
+            run_stata_file, processed_file, timeout=timeout, working_dir=working_dir
+        )
 
     # Apply MCP output processing (compact mode filtering and token limit)
     # filter_command_echo=True for run_file (LLM already knows the file contents)
-    formatted_result = process_mcp_output(formatted_result, for_mcp=True, filter_command_echo=True)
+    formatted_result = process_mcp_output(result, for_mcp=True, filter_command_echo=True)
 
     # Log the output (truncated) for debugging
     logging.debug(f"Run file output (first 100 chars): {formatted_result[:100]}...")
@@ -2435,11 +3058,7 @@ async def stata_run_file_stream_endpoint(
     return StreamingResponse(
         stata_run_file_stream(file_path, timeout, working_dir, session_id),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",  # Disable nginx buffering
-        }
+        headers=_SSE_HEADERS
     )
 
 
@@ -2461,36 +3080,43 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
     Yields:
         SSE formatted events with incremental output
     """
-    import threading
-    import queue as queue_module
     import tempfile
 
     # Preprocess: Join lines with /// continuation into single logical lines
     processed_selection = join_stata_line_continuations(selection)
 
-    # Markers to identify user code output boundaries
-    START_MARKER = "__STATA_MCP_OUTPUT_START__"
-    END_MARKER = "__STATA_MCP_OUTPUT_END__"
+    # Auto-name graphs in memory so the temp do file is written only once.
+    # Continuations are already joined, so a selection without graph commands runs as written
+    if _GRAPH_COMMAND_LINE_RE.search(processed_selection):
+        try:
+            named_selection = preprocess_do_text_for_graphs(processed_selection)
+            if not processed_selection.endswith('\n'):
+                named_selection = named_selection[:-1]
+            processed_selection = named_selection
+        except Exception as e:
+            logging.error(f"[STREAM-SEL] Error pre-processing selection: {e}")
+
+    def write_selection_do_file():
+        """Write the selection, wrapped in the output markers, to a new temp .do file"""
+        fd, path = tempfile.mkstemp(suffix='.do', prefix='stata_selection_')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            # If working directory specified, prepend cd command
+            if working_dir and os.path.isdir(working_dir):
+                working_dir_stata = os.path.normpath(working_dir).replace('\\', '/')
+                f.write(f'cd "{working_dir_stata}"\n')
+            # Add start marker before user code
+            f.write(f'display "{_SELECTION_START_MARKER}"\n')
+            f.write(processed_selection)
+            # Add end marker after user code
+            f.write(f'\ndisplay "{_SELECTION_END_MARKER}"\n')
+        return path
 
     # Create temp file BEFORE the generator logic (not in try-finally)
-    # This matches run_file_stream approach
-    fd, temp_file = tempfile.mkstemp(suffix='.do', prefix='stata_selection_')
-    with os.fdopen(fd, 'w', encoding='utf-8') as f:
-        # If working directory specified, prepend cd command
-        if working_dir and os.path.isdir(working_dir):
-            working_dir_stata = os.path.normpath(working_dir).replace('\\', '/')
-            f.write(f'cd "{working_dir_stata}"\n')
-        # Add start marker before user code
-        f.write(f'display "{START_MARKER}"\n')
-        f.write(processed_selection)
-        # Add end marker after user code
-        f.write(f'\ndisplay "{END_MARKER}"\n')
+    # This matches run_file_stream approach; the file I/O runs off the event loop
+    temp_file = await asyncio.to_thread(write_selection_do_file)
 
     logging.info(f"[STREAM-SEL] Created temp file: {temp_file}")
 
-    # Queue to communicate between threads
-    result_queue = queue_module.Queue()
-
     # Determine log file path
     base_name = os.path.splitext(os.path.basename(temp_file))[0]
     log_file = get_log_file_path(temp_file, base_name, session_id)
@@ -2499,17 +3125,11 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
 
     # Clear (truncate) the log file before starting new execution
     try:
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        with open(log_file, 'w') as f:
-            pass
+        await asyncio.to_thread(_truncate_file, log_file)
         logging.debug(f"[STREAM-SEL] Cleared log file: {log_file}")
     except Exception as e:
         logging.warning(f"[STREAM-SEL] Could not clear log file: {e}")
 
-    # Pre-process the temp file to auto-name graphs
-    processed_file = preprocess_do_file_for_graphs(temp_file)
-    logging.debug(f"[STREAM-SEL] Pre-processed file: {processed_file}")
-
     def run_with_progress():
         """Run Stata selection in thread and cleanup temp file when done"""
         try:
@@ -2517,7 +3137,7 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
             if multi_session_enabled and session_manager is not None:
                 logging.info(f"[STREAM-SEL] Using multi-session mode, session_id={session_id or 'default'}")
                 result_dict = session_manager.execute_file(
-                    processed_file,
+                    temp_file,
                     session_id=session_id,
                     timeout=float(timeout),
                     log_file=log_file,
@@ -2531,7 +3151,7 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
                     result = f"Error: {result_dict.get('error', 'Unknown error')}"
             else:
                 logging.info("[STREAM-SEL] Using single-session mode")
-                result = run_stata_file(processed_file, timeout=timeout, working_dir=working_dir, auto_name_graphs=True)
+                result = run_stata_file(temp_file, timeout=timeout, working_dir=working_dir, auto_name_graphs=True, auto_detect_graphs=True)
                 try:
                     logging.debug("[STREAM-SEL] Detecting graphs for single-session mode...")
                     graphs = display_graphs_interactive(graph_format='png', width=800, height=600)
@@ -2539,21 +3159,13 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
                         logging.info(f"[STREAM-SEL] Detected {len(graphs)} graph(s)")
                 except Exception as e:
                     logging.warning(f"[STREAM-SEL] Error detecting graphs: {str(e)}")
-            result_queue.put(('success', result, graphs))
+            return ('success', result, graphs)
         except Exception as e:
             logging.error(f"[STREAM-SEL] Execution error: {str(e)}")
-            result_queue.put(('error', str(e), []))
+            return ('error', str(e), [])
         finally:
-            # Clean up temp files in the worker thread (not in generator)
+            # Clean up the temp file in the worker thread (not in generator)
             # This avoids the try-finally in generator that causes h11 issues
-            # Clean up processed_file first (created by preprocess_do_file_for_graphs)
-            if processed_file and processed_file != temp_file and os.path.exists(processed_file):
-                try:
-                    os.unlink(processed_file)
-                    logging.debug(f"[STREAM-SEL] Cleaned up processed file: {processed_file}")
-                except Exception as e:
-                    logging.warning(f"[STREAM-SEL] Could not delete processed file: {e}")
-            # Clean up original temp file
             if temp_file and os.path.exists(temp_file):
                 try:
                     os.unlink(temp_file)
@@ -2561,42 +3173,16 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
                 except Exception as e:
                     logging.warning(f"[STREAM-SEL] Could not delete temp file: {e}")
 
-    # Start execution thread
-    thread = threading.Thread(target=run_with_progress, daemon=True)
-    thread.start()
+    # Start execution on the shared stream pool
+    execution = asyncio.get_running_loop().run_in_executor(_STREAM_EXECUTOR, run_with_progress)
 
     # State-based filtering: only output lines between START and END markers
     in_user_output = False
 
-    def process_line(line: str) -> tuple:
-        """Process a line and return (should_output, new_state).
-
-        Returns:
-            (output_line, new_in_user_output_state)
-            output_line is None if line should be skipped
-        """
-        nonlocal in_user_output
-        stripped = line.strip()
-
-        # Check for start marker - transition to user output mode
-        if START_MARKER in stripped:
-            in_user_output = True
-            return (None, True)  # Skip the marker line itself
-
-        # Check for end marker - transition out of user output mode
-        if END_MARKER in stripped:
-            in_user_output = False
-            return (None, False)  # Skip the marker line itself
-
-        # Only output if we're in user output mode
-        if in_user_output and stripped:
-            return (line, True)
-
-        return (None, in_user_output)
-
     start_time = time.time()
-    last_read_pos = 0
+    log_tail = _LogTail(log_file)
     check_interval = 0.5
+    log_ticks = _LogTicker(log_tail, check_interval)
 
     # Monitor progress by reading log file incrementally
     # Same structure as run_file_stream - wrap in try-except for client disconnect
@@ -2605,29 +3191,27 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
         # Yield initial separator for new execution
         yield f"data: \n\n"
 
-        while thread.is_alive():
+        while not execution.done():
             current_time = time.time()
             elapsed = current_time - start_time
 
-            if os.path.exists(log_file):
-                try:
-                    current_size = os.path.getsize(log_file)
-                    if current_size > last_read_pos:
-                        with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
-                            f.seek(last_read_pos)
-                            new_content = f.read()
-                            last_read_pos = f.tell()
-
-                        if new_content.strip():
-                            for line in new_content.splitlines():
-                                output_line, _ = process_line(line)
-                                if output_line:
-                                    escaped = output_line.replace('\\', '\\\\')
-                                    yield f"data: {escaped}\n\n"
-                except Exception as e:
-                    logging.debug(f"Error reading log file: {e}")
+            try:
+                new_content = await asyncio.to_thread(log_tail.read)
+                if new_content.strip():
+                    # Escaping backslashes does not affect the marker search
+                    user_output, in_user_output = _slice_user_output(
+                        new_content.replace('\\', '\\\\'), in_user_output
+                    )
+                    frame = _sse_event(line for line in user_output.splitlines() if not line.isspace())
+                    if frame:
+                        yield frame
+            except Exception as e:
+                logging.debug(f"Error reading log file: {e}")
 
-            await asyncio.sleep(check_interval)
+            # Wake up as soon as the log changes or the execution finishes
+            # (or after check_interval at the latest); keep reading while a backlog remains
+            if not log_tail.pending:
+                await log_ticks.wait(execution)
 
             if elapsed > timeout:
                 yield f"data: ERROR: Execution timed out after {timeout}s\n\n"
@@ -2635,24 +3219,24 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
 
         # Get final result
         try:
-            status, result, graphs = result_queue.get(timeout=5.0)
+            status, result, graphs = await asyncio.wait_for(asyncio.shield(execution), timeout=5.0)
 
             # Read any remaining log file content
-            if os.path.exists(log_file):
-                try:
-                    current_size = os.path.getsize(log_file)
-                    if current_size > last_read_pos:
-                        with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
-                            f.seek(last_read_pos)
-                            remaining = f.read()
-                        if remaining.strip():
-                            for line in remaining.splitlines():
-                                output_line, _ = process_line(line)
-                                if output_line:
-                                    escaped = output_line.replace('\\', '\\\\')
-                                    yield f"data: {escaped}\n\n"
-                except Exception as e:
-                    logging.debug(f"Error reading final log content: {e}")
+            try:
+                while True:
+                    remaining = await asyncio.to_thread(log_tail.read)
+                    if remaining.strip():
+                        # Escaping backslashes does not affect the marker search
+                        user_output, in_user_output = _slice_user_output(
+                            remaining.replace('\\', '\\\\'), in_user_output
+                        )
+                        frame = _sse_event(line for line in user_output.splitlines() if not line.isspace())
+                        if frame:
+                            yield frame
+                    if not log_tail.pending:
+                        break
+            except Exception as e:
+                logging.debug(f"Error reading final log content: {e}")
 
             if status == 'error':
                 yield f"data: ERROR: {result}\n\n"
@@ -2669,12 +3253,17 @@ async def stata_run_selection_stream(selection: str, timeout: int = 600, working
                         yield f"data:   • {graph['name']}: {graph['path']}\n\n"
                     logging.info(f"[STREAM-SEL] Sent {len(graphs)} graph(s) info to client")
 
-        except queue_module.Empty:
+        except asyncio.TimeoutError:
             yield "data: ERROR: Failed to get execution result (timeout)\n\n"
 
+        log_tail.close()
+        await log_ticks.aclose()
+
     except (GeneratorExit, asyncio.CancelledError):
         # Client disconnected - exit cleanly without trying to yield more data
         # Temp file cleanup is handled by the worker thread
+        log_tail.close()
+        await log_ticks.aclose()
         logging.debug("[STREAM-SEL] Client disconnected, stopping stream")
         return
 
@@ -2723,272 +3312,356 @@ async def stata_run_selection_stream_endpoint(
     return StreamingResponse(
         stata_run_selection_stream(selection, timeout, working_dir, session_id),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
+        headers=_SSE_HEADERS
     )
 
 
-# MCP server will be initialized in main() after args are parsed
+# JSON helpers for tool results and /view_data: orjson when installed, otherwise the
+# stdlib encoder configured to produce the same compact, UTF-8 output
+def _dumps_json(data) -> str:
+    """Serialize a tool result to compact JSON, using orjson when available"""
+    if has_orjson:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
 
-# Add FastAPI endpoint for legacy VS Code extension
-@app.post("/v1/tools", include_in_schema=False)
-async def call_tool(request: ToolRequest) -> ToolResponse:
-    try:
-        # Map VS Code extension tool names to MCP tool names
-        tool_name_map = {
-            "run_selection": "stata_run_selection",
-            "run_file": "stata_run_file",
-            "session": "stata_session"
-        }
 
-        # Get the actual tool name
-        mcp_tool_name = tool_name_map.get(request.tool, request.tool)
+def _loads_json(content: bytes):
+    """Parse a JSON body, using orjson when available"""
+    if has_orjson:
+        return orjson.loads(content)
+    return json.loads(content)
 
-        # Log the request
-        logging.info(f"REST API request for tool: {request.tool} -> {mcp_tool_name}")
 
-        # List of valid tools
-        valid_tools = ["stata_run_selection", "stata_run_file", "stata_session"]
+def _json_response(data, status_code: int = 200) -> Response:
+    """Build a JSON Response for a plain dict, skipping FastAPI's jsonable_encoder pass"""
+    return Response(content=_dumps_json(data), media_type="application/json", status_code=status_code)
 
-        # Check if the tool exists
-        if mcp_tool_name not in valid_tools:
-            return ToolResponse(
-                status="error",
-                message=f"Unknown tool: {request.tool}"
-            )
-        
-        # Execute the appropriate function
-        if mcp_tool_name == "stata_run_selection":
-            if "selection" not in request.parameters:
-                return ToolResponse(
-                    status="error",
-                    message="Missing required parameter: selection"
-                )
-            # Get optional parameters
-            working_dir = request.parameters.get("working_dir", None)
-            session_id = request.parameters.get("session_id", None)
 
-            # Route through session manager if multi-session is enabled
-            if multi_session_enabled and session_manager is not None:
-                if session_id:
-                    logging.info(f"MCP run_selection using session: {session_id}")
-                result_dict = await asyncio.to_thread(
-                    session_manager.execute,
-                    request.parameters["selection"],
-                    session_id=session_id
-                )
-                if result_dict.get('status') == 'success':
-                    result = result_dict.get('output', '')
-                    # Append graph info if any graphs were created
-                    # (matching run_file behavior - no keyword check needed since worker already detected them)
-                    extra = result_dict.get('extra', {})
-                    graphs = extra.get('graphs', []) if extra else []
-                    if graphs:
-                        graph_info = "\n\n" + "="*60 + "\n"
-                        graph_info += f"GRAPHS DETECTED: {len(graphs)} graph(s) created\n"
-                        graph_info += "="*60 + "\n"
-                        for graph in graphs:
-                            graph_info += f"  • {graph['name']}: {graph['path']}\n"
-                        result += graph_info
-                        logging.info(f"Multi-session: Added {len(graphs)} graphs to output")
-                else:
-                    result = f"Error: {result_dict.get('error', 'Unknown error')}"
-            else:
-                # Single-session mode: use direct execution
-                # Enable auto_detect_graphs for VS Code extension calls
-                result = await asyncio.to_thread(run_stata_selection, request.parameters["selection"], working_dir, True)
-            # Format output for better display
-            result = result.replace("\\n", "\n")
-            
-        elif mcp_tool_name == "stata_run_file":
-            if "file_path" not in request.parameters:
-                return ToolResponse(
-                    status="error",
-                    message="Missing required parameter: file_path"
-                )
+def _frame_rows(df) -> list:
+    """Convert a DataFrame to a list of row lists ready for _dumps_json
 
-            # Get the file path from the parameters
-            file_path = request.parameters["file_path"]
+    orjson already writes NaN as null, so the NaN->None replacement pass
+    over every cell is only needed for the stdlib encoder.
+    """
+    if has_orjson:
+        return df.values.tolist()
+    return df.replace({float('nan'): None}).values.tolist()
 
-            # Get timeout parameter if provided, otherwise use default (10 minutes)
-            timeout = request.parameters.get("timeout", 600)
-            try:
-                timeout = int(timeout)  # Ensure it's an integer
-                if timeout <= 0:
-                    logging.warning(f"Invalid timeout value: {timeout}, using default 600")
-                    timeout = 600
-            except (ValueError, TypeError):
-                logging.warning(f"Non-integer timeout value: {timeout}, using default 600")
-                timeout = 600
 
-            # Get optional parameters
-            working_dir = request.parameters.get("working_dir", None)
-            session_id = request.parameters.get("session_id", None)
+def _frame_columns(df) -> list:
+    """Convert a DataFrame to one list per column for the columnar /view_data layout"""
+    if not has_orjson:
+        df = df.replace({float('nan'): None})
+    return [df[col].tolist() for col in df.columns]
 
-            logging.info(f"MCP run_file request for: {file_path} with timeout {timeout} seconds ({timeout/60:.1f} minutes)")
-            if working_dir:
-                logging.info(f"Working directory: {working_dir}")
-            if session_id:
-                logging.info(f"Using session: {session_id}")
 
-            # Normalize the path for cross-platform compatibility
-            file_path = os.path.normpath(file_path)
+# Entries per chunk when /view_data streams NDJSON
+_NDJSON_CHUNK_ROWS = 1000
 
-            # On Windows, convert forward slashes to backslashes if needed
-            if platform.system() == "Windows" and '/' in file_path:
-                file_path = file_path.replace('/', '\\')
+# Payloads above this many cells are encoded in a worker thread instead of on the event loop
+_VIEW_DATA_OFFLOAD_CELLS = 50_000
 
-            # Route through session manager if multi-session is enabled
-            if multi_session_enabled and session_manager is not None:
-                # Pre-process the file to auto-name graphs and handle line continuations
-                processed_file = preprocess_do_file_for_graphs(file_path)
-                logging.debug(f"Pre-processed file: {processed_file}")
-
-                # Get the original file's directory for working_dir (not the temp file's directory)
-                # This ensures outputs go to the expected location like native Stata
-                abs_file_path = os.path.abspath(file_path)
-                original_file_dir = os.path.dirname(abs_file_path)
-
-                # Determine log file path based on user settings
-                # Include session_id in log filename to prevent file locking conflicts in parallel execution
-                base_name = os.path.splitext(os.path.basename(abs_file_path))[0]
-                log_file = get_log_file_path(file_path, base_name, session_id)
-
-                result_dict = await asyncio.to_thread(
-                    session_manager.execute_file,
-                    processed_file,
-                    session_id=session_id,
-                    timeout=float(timeout),
-                    log_file=log_file,  # Pass log file path to respect logFileLocation setting
-                    working_dir=original_file_dir
-                )
-                if result_dict.get('status') == 'success':
-                    result = result_dict.get('output', '')
-                    # Append graph info if any graphs were created (format must match extension's parseGraphsFromOutput)
-                    extra = result_dict.get('extra', {})
-                    graphs = extra.get('graphs', []) if extra else []
-                    if graphs:
-                        graph_info = "\n\n" + "="*60 + "\n"
-                        graph_info += f"GRAPHS DETECTED: {len(graphs)} graph(s) created\n"
-                        graph_info += "="*60 + "\n"
-                        for graph in graphs:
-                            graph_info += f"  • {graph['name']}: {graph['path']}\n"
-                        result += graph_info
-                        logging.info(f"Multi-session run_file: Added {len(graphs)} graphs to output")
-                else:
-                    result = f"Error: {result_dict.get('error', 'Unknown error')}"
-            else:
-                # Single-session mode: use direct execution
-                # Enable auto_name_graphs for VS Code extension calls
-                result = await asyncio.to_thread(run_stata_file, file_path, timeout, True, working_dir)
 
-            # Format output for better display
-            result = result.replace("\\n", "\n")
+async def _view_data_response(payload: dict, data_key: str, ndjson: bool) -> Response:
+    """Return a /view_data payload as one JSON document, or as NDJSON when requested
 
-            # Log the output length for debugging
-            logging.debug(f"MCP run_file output length: {len(result)}")
+    The NDJSON form starts with a line holding every field except payload[data_key],
+    followed by one line per entry of payload[data_key]. Chunks are encoded as the
+    client reads them, so large frames are never materialized as a single string.
+    Non-success payloads (timeouts, worker errors) carry no data and are returned as-is.
+    """
+    if payload.get("status") != "success":
+        return _json_response(payload)
 
-            # If no output was captured, log a warning
-            if "Command executed but" in result and "output not captured" in result:
-                logging.warning(f"No output captured for file: {file_path}")
+    if not ndjson:
+        cells = int(payload.get("rows") or 0) * len(payload.get("columns") or ())
+        if cells > _VIEW_DATA_OFFLOAD_CELLS:
+            content = await asyncio.to_thread(_dumps_json, payload)
+        else:
+            content = _dumps_json(payload)
+        return Response(content=content, media_type="application/json")
 
-            # If file not found error, make the message more helpful
-            if "File not found" in result:
-                # Add help text explaining common issues with Windows paths
-                result += get_windows_path_help_message()
+    values = payload.pop(data_key)
 
-        # Session management tool - unified with action parameter
-        elif mcp_tool_name == "stata_session":
-            action = request.parameters.get("action", "list")
-            session_id = request.parameters.get("session_id", None)
+    def lines():
+        yield _dumps_json(payload) + "\n"
+        for start in range(0, len(values), _NDJSON_CHUNK_ROWS):
+            yield "".join(_dumps_json(value) + "\n" for value in values[start:start + _NDJSON_CHUNK_ROWS])
 
-            # Action: list - List all active sessions
-            if action == "list":
-                if multi_session_enabled and session_manager is not None:
-                    sessions = session_manager.list_sessions()
-                    stats = session_manager.get_stats()
-                    result_data = {
-                        "sessions": sessions,
-                        "max_sessions": stats.get("max_sessions", 0),
-                        "available_slots": stats.get("available_slots", 0),
-                        "multi_session_enabled": True
-                    }
-                else:
-                    result_data = {
-                        "sessions": [],
-                        "multi_session_enabled": False,
-                        "message": "Multi-session mode is not enabled"
-                    }
-                return ToolResponse(
-                    status="success",
-                    result=json.dumps(result_data, indent=2)
-                )
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-            # Action: destroy - Destroy a session
-            elif action == "destroy":
-                if not multi_session_enabled or session_manager is None:
-                    return ToolResponse(
-                        status="error",
-                        message="Multi-session mode is not enabled"
-                    )
 
-                if not session_id:
-                    return ToolResponse(
-                        status="error",
-                        message="Missing required parameter: session_id (required for destroy action)"
-                    )
+async def _call_run_selection_tool(request: ToolRequest) -> ToolResponse:
+    """Handle the stata_run_selection tool for the /v1/tools endpoint"""
+    if "selection" not in request.parameters:
+        return ToolResponse(
+            status="error",
+            message="Missing required parameter: selection"
+        )
+    # Get optional parameters
+    working_dir = request.parameters.get("working_dir", None)
+    session_id = request.parameters.get("session_id", None)
 
-                logging.info(f"Destroying session: {session_id}")
-                success, error = session_manager.destroy_session(session_id)
-
-                if success:
-                    return ToolResponse(
-                        status="success",
-                        result=json.dumps({
-                            "action": "destroy",
-                            "session_id": session_id,
-                            "message": f"Session '{session_id}' destroyed successfully"
-                        }, indent=2)
-                    )
-                else:
-                    return ToolResponse(
-                        status="error",
-                        message=error or f"Failed to destroy session '{session_id}'"
-                    )
+    # Route through session manager if multi-session is enabled
+    if multi_session_enabled and session_manager is not None:
+        if session_id:
+            logging.info(f"MCP run_selection using session: {session_id}")
+        result_dict = await asyncio.to_thread(
+            session_manager.execute,
+            request.parameters["selection"],
+            session_id=session_id
+        )
+        if result_dict.get('status') == 'success':
+            result = result_dict.get('output', '')
+            # Append graph info if any graphs were created
+            # (matching run_file behavior - no keyword check needed since worker already detected them)
+            extra = result_dict.get('extra', {})
+            graphs = extra.get('graphs', []) if extra else []
+            if graphs:
+                result += _format_graph_summary(graphs, include_commands=False)
+                logging.info(f"Multi-session: Added {len(graphs)} graphs to output")
+        else:
+            result = f"Error: {result_dict.get('error', 'Unknown error')}"
+    else:
+        # Single-session mode: use direct execution
+        # Enable auto_detect_graphs for VS Code extension calls
+        result = await asyncio.to_thread(run_stata_selection, request.parameters["selection"], working_dir, True)
+    # Apply output filtering for MCP returns (skip if interactive mode)
+    # Interactive mode sets skip_filter=true to get full unfiltered output
+    # filter_command_echo=False to preserve command context
+    if not request.parameters.get("skip_filter", False):
+        result = process_mcp_output(result, log_path=None, for_mcp=True, filter_command_echo=False)
+
+    return ToolResponse(status="success", result=result)
 
-            else:
-                return ToolResponse(
-                    status="error",
-                    message=f"Unknown action: {action}. Valid actions: list, destroy"
-                )
 
-        # Apply output filtering for MCP returns (skip if interactive mode)
-        # Interactive mode sets skip_filter=true to get full unfiltered output
-        skip_filter = request.parameters.get("skip_filter", False)
-        if not skip_filter:
-            # For run_file: filter_command_echo=True because VS Code already knows the file contents
-            # For run_selection: filter_command_echo=False to preserve command context
-            if mcp_tool_name == "stata_run_file":
-                result = process_mcp_output(result, log_path=None, for_mcp=True, filter_command_echo=True)
-            elif mcp_tool_name == "stata_run_selection":
-                result = process_mcp_output(result, log_path=None, for_mcp=True, filter_command_echo=False)
-
-        # Return successful response
+async def _call_run_file_tool(request: ToolRequest) -> ToolResponse:
+    """Handle the stata_run_file tool for the /v1/tools endpoint"""
+    if "file_path" not in request.parameters:
+        return ToolResponse(
+            status="error",
+            message="Missing required parameter: file_path"
+        )
+
+    # Get the file path from the parameters
+    file_path = request.parameters["file_path"]
+
+    # Get timeout parameter if provided, otherwise use default (10 minutes)
+    timeout = request.parameters.get("timeout", 600)
+    try:
+        timeout = int(timeout)  # Ensure it's an integer
+        if timeout <= 0:
+            logging.warning(f"Invalid timeout value: {timeout}, using default 600")
+            timeout = 600
+    except (ValueError, TypeError):
+        logging.warning(f"Non-integer timeout value: {timeout}, using default 600")
+        timeout = 600
+
+    # Get optional parameters
+    working_dir = request.parameters.get("working_dir", None)
+    session_id = request.parameters.get("session_id", None)
+
+    logging.info(f"MCP run_file request for: {file_path} with timeout {timeout} seconds ({timeout/60:.1f} minutes)")
+    if working_dir:
+        logging.info(f"Working directory: {working_dir}")
+    if session_id:
+        logging.info(f"Using session: {session_id}")
+
+    # Normalize the path for cross-platform compatibility
+    file_path = os.path.normpath(file_path)
+
+    # On Windows, convert forward slashes to backslashes if needed
+    if platform.system() == "Windows" and '/' in file_path:
+        file_path = file_path.replace('/', '\\')
+
+    skip_filter = request.parameters.get("skip_filter", False)
+    # Whether the worker applied compact filtering to the output itself
+    worker_filtered = False
+
+    # Route through session manager if multi-session is enabled
+    if multi_session_enabled and session_manager is not None:
+        # Pre-process the file to auto-name graphs and handle line continuations
+        processed_file = await asyncio.to_thread(preprocess_do_file_for_graphs, file_path)
+        logging.debug(f"Pre-processed file: {processed_file}")
+
+        # Get the original file's directory for working_dir (not the temp file's directory)
+        # This ensures outputs go to the expected location like native Stata
+        abs_file_path, original_file_dir, base_name = _split_do_file_path(file_path)
+
+        # Determine log file path based on user settings
+        # Include session_id in log filename to prevent file locking conflicts in parallel execution
+        log_file = get_log_file_path(file_path, base_name, session_id)
+
+        result_dict = await asyncio.to_thread(
+            _run_with_preprocessed_do_file,
+            processed_file,
+            session_manager.execute_file,
+            processed_file,
+            session_id=session_id,
+            timeout=float(timeout),
+            log_file=log_file,  # Pass log file path to respect logFileLocation setting
+            working_dir=original_file_dir,
+            # Let the worker run the compact filter so the full log never reaches the event loop
+            compact_filter=not skip_filter and result_display_mode == 'compact',
+            filter_command_echo=True
+        )
+        if result_dict.get('status') == 'success':
+            result = result_dict.get('output', '')
+            worker_filtered = bool((result_dict.get('extra') or {}).get('filtered'))
+            # Append graph info if any graphs were created (format must match extension's parseGraphsFromOutput)
+            extra = result_dict.get('extra', {})
+            graphs = extra.get('graphs', []) if extra else []
+            if graphs:
+                result += _format_graph_summary(graphs, include_commands=False)
+                logging.info(f"Multi-session run_file: Added {len(graphs)} graphs to output")
+        else:
+            result = f"Error: {result_dict.get('error', 'Unknown error')}"
+    else:
+        # Single-session mode: use direct execution
+        # Enable auto_name_graphs and graph detection for VS Code extension calls
+        result = await asyncio.to_thread(
+            run_stata_file, file_path, timeout, True, working_dir, auto_detect_graphs=True
+        )
+
+    # Log the output length for debugging
+    logging.debug(f"MCP run_file output length: {len(result)}")
+
+    # If no output was captured, log a warning
+    if "Command executed but" in result and "output not captured" in result:
+        logging.warning(f"No output captured for file: {file_path}")
+
+    # If file not found error, make the message more helpful
+    if "File not found" in result:
+        # Add help text explaining common issues with Windows paths
+        result += get_windows_path_help_message()
+
+    # Apply output filtering for MCP returns (skip if interactive mode)
+    # filter_command_echo=True because VS Code already knows the file contents
+    if worker_filtered:
+        # Compact filtering already done in the worker - only the token limit is left
+        result, _ = check_token_limit_and_save(result)
+    elif not skip_filter:
+        result = process_mcp_output(result, log_path=None, for_mcp=True, filter_command_echo=True)
+
+    return ToolResponse(status="success", result=result)
+
+
+async def _call_session_tool(request: ToolRequest) -> ToolResponse:
+    """Handle the stata_session tool (list/destroy actions) for the /v1/tools endpoint"""
+    action = request.parameters.get("action", "list")
+    session_id = request.parameters.get("session_id", None)
+
+    # Action: list - List all active sessions
+    if action == "list":
+        if multi_session_enabled and session_manager is not None:
+            snapshot = session_manager.snapshot()
+            sessions = snapshot["sessions"]
+            stats = snapshot["stats"]
+            result_data = {
+                "sessions": sessions,
+                "max_sessions": stats.get("max_sessions", 0),
+                "available_slots": stats.get("available_slots", 0),
+                "multi_session_enabled": True
+            }
+        else:
+            result_data = {
+                "sessions": [],
+                "multi_session_enabled": False,
+                "message": "Multi-session mode is not enabled"
+            }
         return ToolResponse(
             status="success",
-            result=result
+            result=_dumps_json(result_data)
         )
-        
+
+    # Action: destroy - Destroy a session
+    elif action == "destroy":
+        if not multi_session_enabled or session_manager is None:
+            return ToolResponse(
+                status="error",
+                message="Multi-session mode is not enabled"
+            )
+
+        if not session_id:
+            return ToolResponse(
+                status="error",
+                message="Missing required parameter: session_id (required for destroy action)"
+            )
+
+        logging.info(f"Destroying session: {session_id}")
+        success, error = session_manager.destroy_session(session_id)
+
+        if success:
+            return ToolResponse(
+                status="success",
+                result=_dumps_json({
+                    "action": "destroy",
+                    "session_id": session_id,
+                    "message": f"Session '{session_id}' destroyed successfully"
+                })
+            )
+        else:
+            return ToolResponse(
+                status="error",
+                message=error or f"Failed to destroy session '{session_id}'"
+            )
+
+    else:
+        return ToolResponse(
+            status="error",
+            message=f"Unknown action: {action}. Valid actions: list, destroy"
+        )
+
+
+# Map VS Code extension tool names to MCP tool names
+_TOOL_NAME_MAP = {
+    "run_selection": "stata_run_selection",
+    "run_file": "stata_run_file",
+    "session": "stata_session",
+}
+
+# Handlers for the /v1/tools endpoint, keyed by MCP tool name
+_TOOL_HANDLERS = {
+    "stata_run_selection": _call_run_selection_tool,
+    "stata_run_file": _call_run_file_tool,
+    "stata_session": _call_session_tool,
+}
+
+
+# MCP server will be initialized in main() after args are parsed
+
+# Add FastAPI endpoint for legacy VS Code extension
+@app.post("/v1/tools", include_in_schema=False)
+async def call_tool(request: ToolRequest) -> Response:
+    try:
+        # Get the actual tool name
+        mcp_tool_name = _TOOL_NAME_MAP.get(request.tool, request.tool)
+
+        # Log the request
+        logging.info(f"REST API request for tool: {request.tool} -> {mcp_tool_name}")
+
+        # Check if the tool exists
+        handler = _TOOL_HANDLERS.get(mcp_tool_name)
+        if handler is None:
+            result = ToolResponse(
+                status="error",
+                message=f"Unknown tool: {request.tool}"
+            )
+        else:
+            # Execute the appropriate function
+            result = await handler(request)
+
     except Exception as e:
         logging.error(f"Error handling tool request: {str(e)}")
-        return ToolResponse(
+        result = ToolResponse(
             status="error",
             message=f"Server error: {str(e)}"
         )
 
+    # Tool output can be hundreds of KB, so encode it directly rather than
+    # through FastAPI's response_model and jsonable_encoder passes
+    return _json_response(result.model_dump())
+
 # Simplified health check endpoint - only report server status without executing Stata commands
 @app.get("/health", include_in_schema=False)
 async def health_check():
@@ -3053,14 +3726,13 @@ async def stop_execution(session_id: str = None):
         except Exception as e:
             logging.debug(f"[STOP] StataSO_SetBreak() failed: {str(e)}")
 
-    # Mark any tracked execution as cancelled
-    exec_id = None
-    with execution_lock:
-        if current_execution_id is not None:
-            exec_id = current_execution_id
-            if exec_id in execution_registry:
-                execution_registry[exec_id]['cancelled'] = True
-                logging.info(f"[STOP] Marked execution {exec_id} as cancelled")
+    # Mark any tracked execution as cancelled. No execution_lock on the event loop:
+    # the id and entry are read once, and setting the flag is a single atomic store
+    exec_id = current_execution_id
+    execution = execution_registry.get(exec_id) if exec_id is not None else None
+    if execution is not None:
+        execution.cancelled = True
+        logging.info(f"[STOP] Marked execution {exec_id} as cancelled")
 
     if stop_sent:
         return {
@@ -3077,14 +3749,93 @@ async def stop_execution(session_id: str = None):
             "message": "Stop signal sent (multi-session mode)"
         }
 
+def _start_pre_warm(manager):
+    """Boot --warm-sessions workers for manager in the background so the caller is not delayed"""
+    if multi_session_warm_sessions > 0:
+        threading.Thread(
+            target=manager.pre_warm,
+            args=(multi_session_warm_sessions,),
+            daemon=True,
+            name="session-warmup"
+        ).start()
+
+
+def _reload_session_manager(old_manager) -> bool:
+    """Start a manager built from freshly reloaded worker modules, then retire old_manager.
+
+    Blocking - reload_workers runs it in a background thread. The old manager keeps
+    serving requests until the new default session is ready; only then is the global
+    swapped and the old workers stopped, so callers never see a stopped manager. If
+    the new manager fails to start, the old one stays in place.
+
+    Returns:
+        True if the new manager was swapped in
+    """
+    global session_manager
+
+    # Reload the worker module
+    import importlib
+    import stata_worker
+    # Drop cached finder state so edited sources are picked up on every reload
+    importlib.invalidate_caches()
+    importlib.reload(stata_worker)
+    logging.info("[RELOAD] Worker module reloaded")
+
+    # Create new session manager with fresh workers
+    session_manager_module = importlib.reload(importlib.import_module('session_manager'))
+    ReloadedSessionManager = session_manager_module.SessionManager
+
+    # Carry the Stata installation over from the old manager
+    stata_path = getattr(old_manager, 'stata_path', None) or os.environ.get('SYSDIR_STATA', '/Applications/Stata')
+    stata_edition = getattr(old_manager, 'stata_edition', 'mp')
+
+    new_manager = ReloadedSessionManager(
+        stata_path=stata_path,
+        stata_edition=stata_edition,
+        max_sessions=100,
+        graphs_dir=_graphs_dir()
+    )
+    if not new_manager.start():
+        logging.error("[RELOAD] Failed to start default session, keeping the existing workers")
+        new_manager.stop()
+        return False
+
+    session_manager = new_manager
+    logging.info("[RELOAD] New session manager ready, shutting down previous workers...")
+    old_manager.stop()
+    _start_pre_warm(new_manager)
+    return True
+
+
+# Set while a worker reload is running. reload_workers checks and sets it without
+# awaiting in between, so concurrent requests cannot both start a reload.
+_reload_in_flight = False
+
+# Source fingerprint of the worker modules as of the last successful reload
+_last_reload_fingerprint = None
+
+
+def _worker_sources_fingerprint() -> tuple:
+    """Return the mtime_ns of stata_worker.py and session_manager.py (None if missing)."""
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    fingerprint = []
+    for name in ('stata_worker.py', 'session_manager.py'):
+        st = _stat_or_none(os.path.join(src_dir, name))
+        fingerprint.append(st.st_mtime_ns if st is not None else None)
+    return tuple(fingerprint)
+
+
 @app.post("/reload_workers", include_in_schema=False)
-async def reload_workers():
+async def reload_workers(force: bool = False):
     """Reload worker processes without restarting the server.
 
     This allows updating worker code (stata_worker.py) without killing
     the MCP connection. The main server stays running.
+
+    Args:
+        force: Reload even if the worker sources are unchanged since the last reload
     """
-    global session_manager, multi_session_enabled
+    global multi_session_enabled, _last_reload_fingerprint, _reload_in_flight
 
     if not multi_session_enabled or session_manager is None:
         return {
@@ -3092,46 +3843,48 @@ async def reload_workers():
             "message": "Multi-session mode not enabled, no workers to reload"
         }
 
+    if _reload_in_flight:
+        return _json_response({
+            "status": "error",
+            "error": "A worker reload is already in progress"
+        }, status_code=409)
+    _reload_in_flight = True
+    handed_off = False
+
     try:
         # Get current session count
-        old_sessions = session_manager.list_sessions()
-
-        # Shutdown all existing workers
-        logging.info("[RELOAD] Shutting down existing workers...")
-        session_manager.stop()
-
-        # Wait for workers to stop
-        await asyncio.sleep(2)
+        old_manager = session_manager
+        old_sessions = old_manager.list_sessions()
 
-        # Reload the worker module
-        import importlib
-        import stata_worker
-        importlib.reload(stata_worker)
-        logging.info("[RELOAD] Worker module reloaded")
-
-        # Create new session manager with fresh workers
-        from session_manager import SessionManager
-        importlib.reload(__import__('session_manager'))
-        from session_manager import SessionManager as ReloadedSessionManager
-
-        # Determine graphs directory
-        if extension_path:
-            reload_graphs_dir = os.path.join(extension_path, 'graphs')
-        else:
-            reload_graphs_dir = os.path.join(tempfile.gettempdir(), 'stata_mcp_graphs')
+        # Nothing to pick up if the sources haven't changed since the last reload
+        fingerprint = await asyncio.to_thread(_worker_sources_fingerprint)
+        if not force and fingerprint == _last_reload_fingerprint:
+            logging.info("[RELOAD] Worker sources unchanged since last reload, skipping")
+            return {
+                "status": "success",
+                "message": "No changes since the last reload (use force=true to reload anyway)",
+                "old_sessions": len(old_sessions)
+            }
 
-        session_manager = ReloadedSessionManager(
-            stata_path=session_manager.stata_path if hasattr(session_manager, 'stata_path') else os.environ.get('SYSDIR_STATA', '/Applications/Stata'),
-            stata_edition=session_manager.stata_edition if hasattr(session_manager, 'stata_edition') else 'mp',
-            max_sessions=100,
-            graphs_dir=reload_graphs_dir
-        )
+        # Re-importing modules and starting Stata block for seconds, so run the reload in
+        # the background; the current workers keep serving until the new ones are ready
+        def run_reload():
+            global _last_reload_fingerprint, _reload_in_flight
+            try:
+                if _reload_session_manager(old_manager):
+                    _last_reload_fingerprint = fingerprint
+                    logging.info("[RELOAD] Default session ready")
+            except Exception as e:
+                logging.error(f"[RELOAD] Error reloading workers: {str(e)}")
+            finally:
+                _reload_in_flight = False
 
-        logging.info("[RELOAD] New session manager created")
+        threading.Thread(target=run_reload, daemon=True, name="worker-reload").start()
+        handed_off = True
 
         return {
             "status": "success",
-            "message": f"Workers reloaded. Previous sessions: {len(old_sessions)}, new default session ready.",
+            "message": f"Workers reloading. Previous sessions: {len(old_sessions)}, kept in service until the new default session is ready.",
             "old_sessions": len(old_sessions)
         }
 
@@ -3141,30 +3894,38 @@ async def reload_workers():
             "status": "error",
             "error": str(e)
         }
+    finally:
+        if not handed_off:
+            _reload_in_flight = False
 
 
-@app.get("/execution_status", include_in_schema=False)
-async def get_execution_status():
-    """Get the current execution status"""
-    global current_execution_id
+# Pre-serialized reply for the common idle poll (Response objects can be sent repeatedly)
+_IDLE_STATUS_RESPONSE = Response(content=b'{"status":"idle","executing":false}', media_type="application/json")
 
-    with execution_lock:
-        if current_execution_id is None:
-            return {"status": "idle", "executing": False}
 
-        if current_execution_id in execution_registry:
-            execution = execution_registry[current_execution_id]
-            elapsed = time.time() - execution.get('start_time', time.time())
-            return {
-                "status": "running",
-                "executing": True,
-                "execution_id": current_execution_id,
-                "file": execution.get('file', 'unknown'),
-                "elapsed_seconds": round(elapsed, 1),
-                "cancelled": execution.get('cancelled', False)
-            }
+@app.get("/execution_status", include_in_schema=False)
+async def get_execution_status():
+    """Get the current execution status
 
-        return {"status": "idle", "executing": False}
+    Reads the registry without taking execution_lock: the current id and its entry
+    are each read once (atomic under the GIL), so polling never waits on the lock.
+    """
+    exec_id = current_execution_id
+    execution = execution_registry.get(exec_id) if exec_id is not None else None
+    if execution is None:
+        return _IDLE_STATUS_RESPONSE
+
+    # Tenths of a second on the monotonic clock (immune to wall-clock jumps)
+    elapsed_tenths = (time.monotonic_ns() - execution.start_time_ns) // 100_000_000
+    # Serialize directly rather than through FastAPI's jsonable_encoder
+    return Response(content=_dumps_json({
+        "status": "running",
+        "executing": True,
+        "execution_id": exec_id,
+        "file": execution.file,
+        "elapsed_seconds": elapsed_tenths / 10,
+        "cancelled": execution.cancelled
+    }), media_type="application/json")
 
 # ============================================================================
 # Multi-Session Management Endpoints
@@ -3176,36 +3937,36 @@ async def create_session():
     global session_manager, multi_session_enabled
 
     if not multi_session_enabled:
-        return {
+        return _json_response({
             "status": "error",
             "message": "Multi-session mode is not enabled. Start server with --multi-session flag."
-        }
+        })
 
     if session_manager is None:
-        return {
+        return _json_response({
             "status": "error",
             "message": "Session manager not initialized"
-        }
+        })
 
     try:
         result = session_manager.create_session()
         if result["success"]:
-            return {
+            return _json_response({
                 "status": "success",
                 "session_id": result["session_id"],
                 "message": "Session created successfully"
-            }
+            })
         else:
-            return {
+            return _json_response({
                 "status": "error",
                 "message": result.get("error", "Unknown error")
-            }
+            })
     except Exception as e:
         logging.error(f"Error creating session: {str(e)}")
-        return {
+        return _json_response({
             "status": "error",
             "message": str(e)
-        }
+        })
 
 
 @app.get("/sessions", include_in_schema=False)
@@ -3214,34 +3975,35 @@ async def list_sessions():
     global session_manager, multi_session_enabled
 
     if not multi_session_enabled:
-        return {
+        return _json_response({
             "sessions": [],
             "multi_session_enabled": False,
             "message": "Multi-session mode is not enabled"
-        }
+        })
 
     if session_manager is None:
-        return {
+        return _json_response({
             "sessions": [],
             "multi_session_enabled": True,
             "message": "Session manager not initialized"
-        }
+        })
 
     try:
-        sessions = session_manager.list_sessions()
-        stats = session_manager.get_stats()
-        return {
+        snapshot = session_manager.snapshot()
+        sessions = snapshot["sessions"]
+        stats = snapshot["stats"]
+        return _json_response({
             "sessions": sessions,
             "max_sessions": stats.get("max_sessions", 4),
             "available_slots": stats.get("available_slots", 0),
             "multi_session_enabled": True
-        }
+        })
     except Exception as e:
         logging.error(f"Error listing sessions: {str(e)}")
-        return {
+        return _json_response({
             "sessions": [],
             "error": str(e)
-        }
+        })
 
 
 @app.get("/sessions/{session_id}", include_in_schema=False)
@@ -3250,29 +4012,29 @@ async def get_session_details(session_id: str):
     global session_manager, multi_session_enabled
 
     if not multi_session_enabled or session_manager is None:
-        return {
+        return _json_response({
             "status": "error",
             "message": "Multi-session mode is not enabled or not initialized"
-        }
+        })
 
     try:
         session = session_manager.get_session(session_id)
         if session:
-            return {
+            return _json_response({
                 "status": "success",
                 "session": session.to_dict()
-            }
+            })
         else:
-            return {
+            return _json_response({
                 "status": "error",
                 "message": f"Session not found: {session_id}"
-            }
+            })
     except Exception as e:
         logging.error(f"Error getting session {session_id}: {str(e)}")
-        return {
+        return _json_response({
             "status": "error",
             "message": str(e)
-        }
+        })
 
 
 @app.delete("/sessions/{session_id}", include_in_schema=False)
@@ -3281,29 +4043,29 @@ async def destroy_session(session_id: str):
     global session_manager, multi_session_enabled
 
     if not multi_session_enabled or session_manager is None:
-        return {
+        return _json_response({
             "status": "error",
             "message": "Multi-session mode is not enabled or not initialized"
-        }
+        })
 
     try:
         success, error = session_manager.destroy_session(session_id)
         if success:
-            return {
+            return _json_response({
                 "status": "success",
                 "message": f"Session {session_id} destroyed"
-            }
+            })
         else:
-            return {
+            return _json_response({
                 "status": "error",
                 "message": error
-            }
+            })
     except Exception as e:
         logging.error(f"Error destroying session {session_id}: {str(e)}")
-        return {
+        return _json_response({
             "status": "error",
             "message": str(e)
-        }
+        })
 
 
 @app.post("/sessions/{session_id}/stop", include_in_schema=False)
@@ -3312,33 +4074,40 @@ async def stop_session_execution(session_id: str):
     global session_manager, multi_session_enabled
 
     if not multi_session_enabled or session_manager is None:
-        return {
+        return _json_response({
             "status": "error",
             "message": "Multi-session mode is not enabled or not initialized"
-        }
+        })
 
     try:
         result = session_manager.stop_execution(session_id)
-        return result
+        return _json_response(result)
     except Exception as e:
         logging.error(f"Error stopping execution in session {session_id}: {str(e)}")
-        return {
+        return _json_response({
             "status": "error",
             "message": str(e)
-        }
+        })
+
 
+# Only read and set on the event loop thread, so a plain flag is enough to reject
+# overlapping restarts (there is no await between the check and the set)
+_single_session_restart_in_flight = False
 
-_single_session_restart_lock = threading.Lock()
+# Soft-reset commands for single-session mode, sent to Stata as one block.
+# clear all resets Stata defaults including `set more on`,
+# which would deadlock the session on long output
+_SINGLE_SESSION_RESET_COMMANDS = "\n".join([
+    "capture log close _all",
+    "capture clear all",
+    "capture graph drop _all",
+    "capture set more off",
+    "set more off",
+])
 
 def _single_session_restart():
     """Run single-session restart commands in a thread to avoid blocking the event loop."""
-    stata.run("capture log close _all", inline=False, echo=False)
-    stata.run("capture clear all", inline=False, echo=False)
-    stata.run("capture graph drop _all", inline=False, echo=False)
-    # clear all resets Stata defaults including `set more on`,
-    # which would deadlock the session on long output
-    stata.run("capture set more off", inline=False, echo=False)
-    stata.run("set more off", inline=False, echo=False)
+    stata.run(_SINGLE_SESSION_RESET_COMMANDS, inline=False, echo=False)
 
 @app.post("/sessions/restart", include_in_schema=False)
 async def restart_session():
@@ -3347,7 +4116,7 @@ async def restart_session():
     In multi-session mode: destroys and recreates the default worker process.
     In single-session mode: runs cleanup commands to reset Stata state.
     """
-    global session_manager, multi_session_enabled, stata_available
+    global session_manager, multi_session_enabled, stata_available, _single_session_restart_in_flight
 
     if multi_session_enabled and session_manager is not None:
         try:
@@ -3364,8 +4133,9 @@ async def restart_session():
         if not stata_available or 'stata' not in globals():
             return {"status": "error", "message": "Stata is not available"}
 
-        if not _single_session_restart_lock.acquire(blocking=False):
+        if _single_session_restart_in_flight:
             return {"status": "error", "message": "Session is already being restarted"}
+        _single_session_restart_in_flight = True
 
         try:
             await asyncio.to_thread(_single_session_restart)
@@ -3382,12 +4152,18 @@ async def restart_session():
             logging.error(f"Error resetting Stata state: {str(e)}")
             return {"status": "error", "message": str(e)}
         finally:
-            _single_session_restart_lock.release()
+            _single_session_restart_in_flight = False
 
 
 # Lock for single-session help requests to prevent concurrent Stata access
 _help_lock = threading.Lock()
 
+# Patterns for validating help topics and stripping log chrome from help output
+_HELP_TOPIC_RE = re.compile(r'^[a-zA-Z0-9_\-.]+$')
+_LOG_RULE_RE = re.compile(r'^-{5,}$')
+_BLOCK_END_ECHO_RE = re.compile(r'^\.\s*(}|else\s*\{)')
+_HELP_NOT_FOUND_ECHO_RE = re.compile(r'^\.\s+display\s+as\s+error\s+"help file not found')
+
 # Endpoint to serve Stata help text
 # Hidden from OpenAPI schema so it won't be exposed to LLMs via MCP
 @app.get("/help", include_in_schema=False)
@@ -3420,7 +4196,7 @@ async def help_endpoint(topic: str, format: str = "text"):
 
     # Validate topic: only allow alphanumeric, underscores, hyphens, and dots
     # This prevents Stata code injection via backticks, quotes, newlines, etc.
-    if not re.match(r'^[a-zA-Z0-9_\-.]+$', topic):
+    if not _HELP_TOPIC_RE.match(topic):
         return Response(
             content="Invalid topic name",
             status_code=400,
@@ -3631,7 +4407,7 @@ set linesize `_stata_help_old_linesize\'
 
             if phase == 'header':
                 # Skip log header lines (dashes, log metadata, etc.)
-                if re.match(r'^-{5,}$', stripped):
+                if _LOG_RULE_RE.match(stripped):
                     continue
                 if stripped_lower.startswith('log:') or stripped_lower.startswith('log type:') or stripped_lower.startswith('opened on:') or stripped_lower.startswith('name:'):
                     continue
@@ -3664,7 +4440,7 @@ set linesize `_stata_help_old_linesize\'
             # phase == 'content': keep lines except log footer
             if phase == 'content':
                 # Skip log footer lines
-                if re.match(r'^-{5,}$', stripped):
+                if _LOG_RULE_RE.match(stripped):
                     continue
                 if stripped_lower.startswith('name:') and '_stata_help_log' in stripped_lower:
                     continue
@@ -3677,9 +4453,9 @@ set linesize `_stata_help_old_linesize\'
                     continue
                 # Skip echoes from if/else block endings (Stata logs both branches)
                 # Use regex to handle variable indentation (e.g. ".     display" vs ". display")
-                if re.match(r'^\.\s*(}|else\s*\{)', stripped):
+                if _BLOCK_END_ECHO_RE.match(stripped):
                     continue
-                if re.match(r'^\.\s+display\s+as\s+error\s+"help file not found', stripped):
+                if _HELP_NOT_FOUND_ECHO_RE.match(stripped):
                     continue
                 if stripped == '.':
                     continue
@@ -4003,7 +4779,7 @@ else {{
         )
     except Exception as e:
         logging.error(f"Error fetching HTML help for {topic}: {str(e)}")
-        logging.debug(traceback.format_exc())
+        logging.debug("HTML help error details", exc_info=True)
         return Response(
             content=f"Error fetching help: {str(e)}",
             status_code=500,
@@ -4013,30 +4789,70 @@ else {{
 
 # Endpoint to serve graph images
 # Hidden from OpenAPI schema so it won't be exposed to LLMs via MCP
+# Characters that would let a graph name point outside the graphs directory
+_BAD_GRAPH_NAME_RE = re.compile(r'[/\\:\x00]|\.\.')
+
+
+@functools.lru_cache(maxsize=4)
+def _real_graphs_dir(graphs_dir: str) -> str:
+    """Resolve the graphs directory once instead of on every graph request."""
+    return os.path.realpath(graphs_dir)
+
+
+def _graph_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Check a graph request's conditional headers against the file on disk
+
+    If-None-Match takes precedence; If-Modified-Since is only consulted without it.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match == etag
+    if_modified_since = request.headers.get("if-modified-since")
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(mtime) <= since
+
+
 @app.get("/graphs/{graph_name}", include_in_schema=False)
-async def get_graph(graph_name: str):
-    """Serve a graph image file"""
+async def get_graph(graph_name: str, request: Request):
+    """Serve a graph image file
+
+    The file is streamed from disk by FileResponse, and a matching If-None-Match
+    gets a 304 without a body.
+    """
     try:
         # CRITICAL: Decode URL-encoded graph name (e.g., "Graph%201" -> "Graph 1")
         # The extension uses encodeURIComponent() which encodes spaces and special chars
         graph_name = unquote(graph_name)
 
         # Construct the path to the graph file
-        if extension_path:
-            graphs_dir = os.path.join(extension_path, 'graphs')
-        else:
-            graphs_dir = os.path.join(tempfile.gettempdir(), 'stata_mcp_graphs')
+        graphs_dir = _graphs_dir()
 
         # Support both with and without .png extension
         if not graph_name.endswith('.png'):
             graph_name = f"{graph_name}.png"
 
+        # Prevent path traversal attacks: reject separators, drive colons and ".."
+        # before building any path
+        if _BAD_GRAPH_NAME_RE.search(graph_name):
+            logging.warning(f"Path traversal attempt blocked: {graph_name}")
+            return Response(
+                content="Invalid graph name",
+                status_code=400,
+                media_type="text/plain"
+            )
+
         graph_path = os.path.join(graphs_dir, graph_name)
 
-        # Prevent path traversal attacks
-        real_graph_path = os.path.realpath(graph_path)
-        real_graphs_dir = os.path.realpath(graphs_dir)
-        if not real_graph_path.startswith(real_graphs_dir + os.sep) and real_graph_path != real_graphs_dir:
+        # Resolve the file itself too, so a symlink in the graphs directory cannot
+        # point outside it; the directory's own realpath is cached
+        real_graphs_dir = _real_graphs_dir(graphs_dir)
+        real_graph_path = os.path.realpath(os.path.join(real_graphs_dir, graph_name))
+        if not real_graph_path.startswith(real_graphs_dir + os.sep):
             logging.warning(f"Path traversal attempt blocked: {graph_name}")
             return Response(
                 content="Invalid graph name",
@@ -4060,11 +4876,18 @@ async def get_graph(graph_name: str):
                 media_type="text/plain"
             )
 
-        # Read and return the image file
-        with open(graph_path, 'rb') as f:
-            image_data = f.read()
+        st = os.stat(real_graph_path)
+        headers = {
+            "ETag": f'"{st.st_mtime_ns:x}-{st.st_size:x}"',
+            "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+            "Cache-Control": "no-cache",
+        }
+        if _graph_not_modified(request, headers["ETag"], st.st_mtime):
+            return Response(status_code=304, headers=headers)
 
-        return Response(content=image_data, media_type="image/png")
+        # FileResponse reads the file in chunks off the event loop and adds
+        # Content-Length/Last-Modified from the stat we already have
+        return FileResponse(real_graph_path, media_type="image/png", headers=headers, stat_result=st)
 
     except Exception as e:
         logging.error(f"Error serving graph {graph_name}: {str(e)}")
@@ -4076,10 +4899,8 @@ async def get_graph(graph_name: str):
 @app.post("/clear_history", include_in_schema=False)
 async def clear_history_endpoint():
     """Clear the command history"""
-    global command_history
     try:
-        count = len(command_history)
-        command_history = []
+        count = _clear_history()
         logging.info(f"Cleared command history ({count} items)")
         return {"status": "success", "message": f"Cleared {count} items from history"}
     except Exception as e:
@@ -4087,18 +4908,25 @@ async def clear_history_endpoint():
         return {"status": "error", "message": str(e)}
 
 @app.get("/view_data", include_in_schema=False)
-async def view_data_endpoint(if_condition: str = None, session_id: str = None, max_rows: int = 10000):
+async def view_data_endpoint(request: Request, if_condition: str = None, session_id: str = None,
+                             max_rows: int = 10000, format: str = None):
     """Get current Stata data as a pandas DataFrame and return as JSON
 
     Args:
         if_condition: Optional Stata if condition (e.g., "price > 5000 & mpg < 30")
         session_id: Optional session ID for multi-session mode
         max_rows: Maximum number of rows to return (default 10000). User can configure via extension settings.
+        format: Set to "columnar" to return one list per column in "data_columnar" instead of row lists in "data"
+
+    Clients sending "Accept: application/x-ndjson" get the same payload streamed as NDJSON.
     """
     global stata_available, stata, multi_session_enabled, session_manager
 
     # Ensure max_rows has minimum value (no hard upper limit - controlled by extension settings)
     max_rows = max(100, max_rows)
+    columnar = format == "columnar"
+    data_key = "data_columnar" if columnar else "data"
+    ndjson = "application/x-ndjson" in request.headers.get("accept", "")
 
     try:
         # Route through session manager if multi-session mode is enabled
@@ -4112,7 +4940,7 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
 
             if result.get('status') == 'error':
                 return Response(
-                    content=json.dumps({
+                    content=_dumps_json({
                         "status": "error",
                         "message": result.get('error', 'Unknown error')
                     }),
@@ -4120,26 +4948,16 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
                     status_code=500
                 )
 
-            return Response(
-                content=json.dumps({
-                    "status": "success",
-                    "data": result.get('data', []),
-                    "columns": result.get('columns', []),
-                    "dtypes": result.get('dtypes', {}),
-                    "rows": result.get('rows', 0),
-                    "index": result.get('index', []),
-                    "total_rows": result.get('total_rows', result.get('rows', 0)),
-                    "displayed_rows": result.get('displayed_rows', result.get('rows', 0)),
-                    "max_rows": result.get('max_rows', max_rows)
-                }),
-                media_type="application/json"
-            )
+            # get_data already returns the full /view_data payload shape
+            if columnar and result.get('status') == 'success':
+                result[data_key] = [list(column) for column in zip(*result.pop('data', []))]
+            return await _view_data_response(result, data_key, ndjson)
 
         # Single-session mode: use direct Stata access
         if not stata_available or stata is None:
             logging.error("Stata is not available")
             return Response(
-                content=json.dumps({
+                content=_dumps_json({
                     "status": "error",
                     "message": "Stata is not initialized"
                 }),
@@ -4155,10 +4973,10 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
         if total_obs == 0:
             logging.info("No data currently loaded in Stata")
             return Response(
-                content=json.dumps({
+                content=_dumps_json({
                     "status": "success",
                     "message": "No data currently loaded",
-                    "data": [],
+                    data_key: [],
                     "columns": [],
                     "rows": 0,
                     "total_rows": 0,
@@ -4173,7 +4991,8 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
         if if_condition:
             logging.info(f"Applying filter: if {if_condition}")
             try:
-                # Preserve current data state
+                # Preserve current data state; restore also resets c(changed), so viewing
+                # filtered data never marks the user's dataset as modified
                 stata.run("preserve", inline=False, echo=False)
 
                 try:
@@ -4194,26 +5013,22 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
                         stata.run(f"quietly keep in 1/{max_rows}", inline=False, echo=False)
                         logging.info(f"Limited to first {max_rows} rows")
 
-                    # Get the filtered data
-                    df = stata.pdataframe_from_data()
-
-                    # Extract original obs numbers as index, then drop the temp column
-                    orig_obs_index = df['_stata_mcp_orig_obs'].tolist()
-                    df = df.drop(columns=['_stata_mcp_orig_obs'])
+                    if filtered_obs == 0:
+                        df = None
+                    else:
+                        # Get the filtered data
+                        df = stata.pdataframe_from_data()
 
-                    # Restore original data
-                    stata.run("restore", inline=False, echo=False)
+                        # Extract original obs numbers as index, then drop the temp column
+                        orig_obs_index = df['_stata_mcp_orig_obs'].tolist()
+                        df = df.drop(columns=['_stata_mcp_orig_obs'])
 
                     total_matching = filtered_obs
                     displayed_rows = min(filtered_obs, max_rows)
 
-                except Exception as filter_err:
-                    # Make sure to restore on error
-                    try:
-                        stata.run("restore", inline=False, echo=False)
-                    except:
-                        pass
-                    raise filter_err
+                finally:
+                    # Restore original data, even if the condition was invalid
+                    stata.run("restore", inline=False, echo=False)
 
             except Exception as e:
                 error_msg = str(e)
@@ -4222,7 +5037,7 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
                     error_msg = f"Invalid condition syntax: {if_condition}"
                 logging.error(f"Filter error: {error_msg}")
                 return Response(
-                    content=json.dumps({
+                    content=_dumps_json({
                         "status": "error",
                         "message": f"Filter error: {error_msg}"
                     }),
@@ -4249,10 +5064,10 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
         if df is None or df.empty:
             logging.info("No data returned from Stata")
             return Response(
-                content=json.dumps({
+                content=_dumps_json({
                     "status": "success",
                     "message": "No data matches the condition" if if_condition else "No data loaded",
-                    "data": [],
+                    data_key: [],
                     "columns": [],
                     "rows": 0,
                     "total_rows": total_matching,
@@ -4265,38 +5080,31 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
         rows, cols = df.shape
         logging.info(f"Data retrieved: {rows} observations, {cols} variables")
 
-        # Convert DataFrame to JSON format
-        # Replace NaN with None for proper JSON serialization
-        df_clean = df.replace({float('nan'): None})
-
         # Convert to list of lists for better performance
-        data_values = df_clean.values.tolist()
-        column_names = df_clean.columns.tolist()
+        data_values = _frame_columns(df) if columnar else _frame_rows(df)
+        column_names = df.columns.tolist()
 
         # Get data types for each column
-        dtypes = {col: str(df[col].dtype) for col in df.columns}
+        dtypes = dict(zip(column_names, map(str, df.dtypes)))
 
-        return Response(
-            content=json.dumps({
-                "status": "success",
-                "data": data_values,
-                "columns": column_names,
-                "dtypes": dtypes,
-                "rows": int(rows),
-                "total_rows": int(total_matching),
-                "displayed_rows": int(displayed_rows),
-                "max_rows": max_rows,
-                "index": orig_obs_index  # Original observation numbers (0-based, JS adds 1)
-            }),
-            media_type="application/json"
-        )
+        return await _view_data_response({
+            "status": "success",
+            data_key: data_values,
+            "columns": column_names,
+            "dtypes": dtypes,
+            "rows": int(rows),
+            "total_rows": int(total_matching),
+            "displayed_rows": int(displayed_rows),
+            "max_rows": max_rows,
+            "index": orig_obs_index  # Original observation numbers (0-based, JS adds 1)
+        }, data_key, ndjson)
 
     except Exception as e:
         error_msg = f"Error getting data: {str(e)}"
         logging.error(error_msg)
         logging.error(traceback.format_exc())
         return Response(
-            content=json.dumps({
+            content=_dumps_json({
                 "status": "error",
                 "message": error_msg
             }),
@@ -4304,15 +5112,9 @@ async def view_data_endpoint(if_condition: str = None, session_id: str = None, m
             status_code=500
         )
 
-@app.get("/interactive", include_in_schema=False)
-async def interactive_window(file: str = None, code: str = None):
-    """Serve the interactive Stata window as a full webpage"""
-    # If a file path or code is provided, we'll auto-execute it on page load
-    auto_run_file = file if file else ""
-    auto_run_code = code if code else ""
-
-    # Use regular string and insert the file path separately to avoid f-string conflicts
-    html_content = """
+# The interactive page is static; its script reads the file/code query parameters
+# itself, so the same encoded bytes are served for every request
+_INTERACTIVE_HTML = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -4434,6 +5236,19 @@ async def interactive_window(file: str = None, code: str = None):
             height: auto;
             border-radius: 4px;
         }
+        .graph-command {
+            color: #858585;
+            font-size: 12px;
+            margin-bottom: 8px;
+            font-family: 'Courier New', monospace;
+            background: #1a1a1a;
+            padding: 6px;
+            border-radius: 3px;
+            border-left: 3px solid #4a9eff;
+        }
+        .graph-error {
+            color: #f48771;
+        }
         .error {
             background: #5a1d1d;
             border-left: 3px solid #f48771;
@@ -4478,11 +5293,20 @@ async def interactive_window(file: str = None, code: str = None):
         </div>
     </div>
 
+    <template id="graph-card-template">
+        <div class="graph-card">
+            <h3></h3>
+            <div class="graph-command" hidden></div>
+            <img>
+        </div>
+    </template>
+
     <script>
         const commandInput = document.getElementById('command-input');
         const runButton = document.getElementById('run-button');
         const outputContainer = document.getElementById('output-container');
         const graphsContainer = document.getElementById('graphs-container');
+        const graphCardTemplate = document.getElementById('graph-card-template');
 
         runButton.addEventListener('click', executeCommand);
         commandInput.addEventListener('keypress', (e) => {
@@ -4510,6 +5334,28 @@ async def interactive_window(file: str = None, code: str = None):
             }
         });
 
+        // Queue DOM updates and flush them together on the next animation frame,
+        // so an output cell and its graph cards cost one layout instead of several
+        const pendingDomUpdates = [];
+        let domFlushScheduled = false;
+
+        function batchDom(update) {
+            pendingDomUpdates.push(update);
+            if (domFlushScheduled) return;
+            domFlushScheduled = true;
+            requestAnimationFrame(() => {
+                const updates = pendingDomUpdates.splice(0);
+                domFlushScheduled = false;
+                for (const fn of updates) {
+                    try {
+                        fn();
+                    } catch (err) {
+                        console.error('Error updating page:', err);
+                    }
+                }
+            });
+        }
+
         async function executeCommand() {
             const command = commandInput.value.trim();
             if (!command) return;
@@ -4530,8 +5376,10 @@ async def interactive_window(file: str = None, code: str = None):
                 const data = await response.json();
 
                 if (data.status === 'success') {
-                    addOutputCell(command, data.result);
-                    updateGraphs(data.result);
+                    batchDom(() => {
+                        addOutputCell(command, data.result);
+                        updateGraphs(data.result);
+                    });
                 } else {
                     addError(data.message || 'Command failed');
                 }
@@ -4577,57 +5425,95 @@ async def interactive_window(file: str = None, code: str = None):
                     graphsContainer.innerHTML = '';
                 }
 
-                // Add or update each graph
+                // Update existing graphs in place and collect new ones to add as a batch
+                const newGraphs = new Map();
                 matches.forEach(match => {
                     const name = match[1].trim();
-                    const path = match[2].trim();
                     const command = match[3] ? match[3].trim() : null;
+                    const url = `/graphs/${encodeURIComponent(name)}`;
 
                     // Check if graph already exists
                     const existingGraph = graphsContainer.querySelector(`[data-graph-name="${name}"]`);
                     if (existingGraph) {
-                        // Update existing graph - force reload by adding timestamp
-                        updateGraph(existingGraph, name, `/graphs/${encodeURIComponent(name)}`, command);
+                        // Update existing graph - revalidated against the server's ETag
+                        updateGraph(existingGraph, name, url, command);
                     } else {
-                        // Add new graph
-                        addGraph(name, `/graphs/${encodeURIComponent(name)}`, command);
+                        // A name repeated in one output keeps only its last entry
+                        newGraphs.set(name, { name, url, command });
                     }
                 });
+                if (newGraphs.size > 0) {
+                    addGraphs([...newGraphs.values()]);
+                }
+            }
+        }
+
+        function cloneGraphCard(name, command) {
+            // Clone the static card markup and fill it through the DOM: no HTML
+            // parsing per card, and names/commands never need escaping
+            const card = graphCardTemplate.content.firstElementChild.cloneNode(true);
+            card.dataset.graphName = name;
+            card.querySelector('h3').textContent = name;
+            if (command) {
+                const commandLine = card.querySelector('.graph-command');
+                commandLine.textContent = '$ ' + command;
+                commandLine.hidden = false;
             }
+            card.querySelector('img').alt = name;
+            return card;
+        }
+
+        function showGraphLoadError(card) {
+            const message = document.createElement('p');
+            message.className = 'graph-error';
+            message.textContent = 'Failed to load graph';
+            card.replaceChildren(message);
         }
 
         function updateGraph(existingCard, name, url, command) {
-            // Force reload by adding timestamp to bypass cache
-            const timestamp = new Date().getTime();
-            const urlWithTimestamp = `${url}?t=${timestamp}`;
-
-            const commandHtml = command ? `<div style="color: #858585; font-size: 12px; margin-bottom: 8px; font-family: 'Courier New', monospace; background: #1a1a1a; padding: 6px; border-radius: 3px; border-left: 3px solid #4a9eff;">$ ${escapeHtml(command)}</div>` : '';
-            existingCard.innerHTML = `
-                <h3>${escapeHtml(name)}</h3>
-                ${commandHtml}
-                <img src="${urlWithTimestamp}" alt="${escapeHtml(name)}"
-                     onerror="this.parentElement.innerHTML='<p style=\\'color:#f48771\\'>Failed to load graph</p>'">
-            `;
+            const card = cloneGraphCard(name, command);
+            existingCard.replaceWith(card);
+
+            // Revalidate instead of cache-busting: an unchanged graph comes back as a
+            // 304 and the cached image is reused, a regenerated one gets the new bytes
+            const img = card.querySelector('img');
+            fetch(url, { cache: 'no-cache' })
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP ${response.status}`);
+                    }
+                    return response.blob();
+                })
+                .then(blob => {
+                    const objectUrl = URL.createObjectURL(blob);
+                    img.onload = () => URL.revokeObjectURL(objectUrl);
+                    img.src = objectUrl;
+                })
+                .catch(() => showGraphLoadError(card));
         }
 
-        function addGraph(name, url, command) {
-            const card = document.createElement('div');
-            card.className = 'graph-card';
-            card.setAttribute('data-graph-name', name);
-            const commandHtml = command ? `<div style="color: #858585; font-size: 12px; margin-bottom: 8px; font-family: 'Courier New', monospace; background: #1a1a1a; padding: 6px; border-radius: 3px; border-left: 3px solid #4a9eff;">$ ${escapeHtml(command)}</div>` : '';
-            card.innerHTML = `
-                <h3>${escapeHtml(name)}</h3>
-                ${commandHtml}
-                <img src="${url}" alt="${escapeHtml(name)}"
-                     onerror="this.parentElement.innerHTML='<p style=\\'color:#f48771\\'>Failed to load graph</p>'">
-            `;
-            graphsContainer.appendChild(card);
+        function buildGraphCard(name, url, command) {
+            const card = cloneGraphCard(name, command);
+            const img = card.querySelector('img');
+            img.onerror = () => showGraphLoadError(card);
+            img.src = url;
+            return card;
+        }
+
+        function addGraphs(graphs) {
+            // Insert all new cards with a single append so the page lays out once
+            const fragment = document.createDocumentFragment();
+            graphs.forEach(g => fragment.appendChild(buildGraphCard(g.name, g.url, g.command)));
+            graphsContainer.appendChild(fragment);
         }
 
+        const HTML_ESCAPES = { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' };
+
         function escapeHtml(text) {
-            const div = document.createElement('div');
-            div.textContent = text;
-            return div.innerHTML;
+            // Most names and outputs contain nothing to escape, so test before replacing.
+            // Quotes are escaped too, since results are also placed in attributes.
+            const str = String(text);
+            return /[&<>"']/.test(str) ? str.replace(/[&<>"']/g, ch => HTML_ESCAPES[ch]) : str;
         }
 
         // Auto-execute file or code if provided in URL parameter
@@ -4635,172 +5521,277 @@ async def interactive_window(file: str = None, code: str = None):
         const autoRunFile = urlParams.get('file');
         const autoRunCode = urlParams.get('code');
 
-        if (autoRunFile) {
-            console.log('Auto-running file from URL parameter:', autoRunFile);
-            // Run the file on page load
-            fetch('/v1/tools', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    tool: 'run_file',
-                    parameters: { file_path: autoRunFile, skip_filter: true }
+        function runAutoRun() {
+            if (autoRunFile) {
+                console.log('Auto-running file from URL parameter:', autoRunFile);
+                // Run the file on page load
+                fetch('/v1/tools', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({
+                        tool: 'run_file',
+                        parameters: { file_path: autoRunFile, skip_filter: true }
+                    })
                 })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.status === 'success') {
-                    addOutputCell('Running file: ' + autoRunFile, data.result);
-                    updateGraphs(data.result);
-                } else {
-                    addError(data.message || 'Failed to run file');
-                }
-            })
-            .catch(error => {
-                addError('Error running file: ' + error.message);
-            });
-        } else if (autoRunCode) {
-            console.log('Auto-running code from URL parameter');
-            // Run the selected code on page load
-            fetch('/v1/tools', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    tool: 'run_selection',
-                    parameters: { selection: autoRunCode, skip_filter: true }
+                .then(response => response.json())
+                .then(data => {
+                    if (data.status === 'success') {
+                        batchDom(() => {
+                            addOutputCell('Running file: ' + autoRunFile, data.result);
+                            updateGraphs(data.result);
+                        });
+                    } else {
+                        addError(data.message || 'Failed to run file');
+                    }
                 })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.status === 'success') {
-                    addOutputCell('Running selection', data.result);
-                    updateGraphs(data.result);
-                } else {
-                    addError(data.message || 'Failed to run code');
-                }
-            })
-            .catch(error => {
-                addError('Error running code: ' + error.message);
-            });
+                .catch(error => {
+                    addError('Error running file: ' + error.message);
+                });
+            } else if (autoRunCode) {
+                console.log('Auto-running code from URL parameter');
+                // Run the selected code on page load
+                fetch('/v1/tools', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({
+                        tool: 'run_selection',
+                        parameters: { selection: autoRunCode, skip_filter: true }
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.status === 'success') {
+                        batchDom(() => {
+                            addOutputCell('Running selection', data.result);
+                            updateGraphs(data.result);
+                        });
+                    } else {
+                        addError(data.message || 'Failed to run code');
+                    }
+                })
+                .catch(error => {
+                    addError('Error running code: ' + error.message);
+                });
+            }
+        }
+
+        // Only start the auto-run once the page is actually shown; a page opened in a
+        // background tab would otherwise run Stata for output nobody is looking at
+        if (autoRunFile || autoRunCode) {
+            if (document.visibilityState === 'visible') {
+                runAutoRun();
+            } else {
+                const onVisible = () => {
+                    if (document.visibilityState === 'visible') {
+                        document.removeEventListener('visibilitychange', onVisible);
+                        runAutoRun();
+                    }
+                };
+                document.addEventListener('visibilitychange', onVisible);
+            }
         }
 
         commandInput.focus();
     </script>
 </body>
 </html>
+    """.encode("utf-8")
+
+
+@app.get("/interactive", include_in_schema=False)
+async def interactive_window(file: str = None, code: str = None):
+    """Serve the interactive Stata window as a full webpage
+
+    The page auto-executes the file or code given in the query string on load.
+    """
+    return Response(
+        content=_INTERACTIVE_HTML,
+        media_type="text/html",
+        headers={"Cache-Control": "public, max-age=60"},
+    )
+
+
+def _find_windows_stata_path() -> str:
+    """Pick the newest Stata install under Program Files with one directory listing.
+
+    Returns:
+        The highest-numbered Stata directory (64-bit Program Files preferred on ties),
+        or the Stata18 default when none is installed
     """
-    # Replace the placeholder with the actual file path (with proper escaping)
-    if auto_run_file:
-        # Escape the file path for JavaScript string
-        escaped_file = auto_run_file.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
-        html_content = html_content.replace('AUTO_RUN_FILE_PLACEHOLDER', escaped_file)
+    candidates = glob.glob('C:\\Program Files*\\Stata*')
+    if not candidates:
+        return 'C:\\Program Files\\Stata18'  # Default if none found
+
+    def version_key(path):
+        digits = re.search(r'(\d+)$', path)
+        return (int(digits.group(1)) if digits else 0, '(x86)' not in path)
 
-    return Response(content=html_content, media_type="text/html")
+    return max(candidates, key=version_key)
+
+
+def _join_split_stata_path(args_to_parse: list) -> list:
+    """Rejoin a quoted --stata-path value that the shell split on spaces.
+
+    Args:
+        args_to_parse: Raw command-line arguments
+
+    Returns:
+        The arguments with the quoted path collapsed back into a single value
+    """
+    fixed_args = []
+    i = 0
+    while i < len(args_to_parse):
+        arg = args_to_parse[i]
+            
+        if arg == '--stata-path' and i + 1 < len(args_to_parse):
+            # The next argument might be a path that got split
+            stata_path = args_to_parse[i + 1]
+            
+            # Check if this is a quoted path
+            if (stata_path.startswith('"') and not stata_path.endswith('"')) or (stata_path.startswith("'") and not stata_path.endswith("'")):
+                # Look for the rest of the path in subsequent arguments
+                i += 2  # Move past '--stata-path' and the first part
+                
+                # Get the quote character (single or double)
+                quote_char = stata_path[0]
+                path_parts = [stata_path[1:]]  # Remove the starting quote
+                
+                # Collect all parts until we find the end quote
+                while i < len(args_to_parse):
+                    current = args_to_parse[i]
+                    if current.endswith(quote_char):
+                        # Found the end quote
+                        path_parts.append(current[:-1])  # Remove the ending quote
+                        i += 1  # Consume it so it is not re-added as a separate argument
+                        break
+                    else:
+                        path_parts.append(current)
+                    i += 1
+                
+                # Join all parts to form the complete path
+                complete_path = " ".join(path_parts)
+                fixed_args.append('--stata-path')
+                fixed_args.append(complete_path)
+            else:
+                # Normal path handling (either without quotes or with properly matched quotes)
+                fixed_args.append(arg)
+                fixed_args.append(stata_path)
+                i += 2
+        else:
+        # For all other arguments, add them as-is
+            fixed_args.append(arg)
+            i += 1
+    return fixed_args
+
+
+def _windows_exception_handler(loop, context):
+    """Custom exception handler to suppress Windows IOCP socket errors."""
+    exception = context.get('exception')
+
+    # Only OSErrors are suppressed; the integer winerror check needs no string work
+    if isinstance(exception, OSError):
+        # WinError 64: The specified network name is no longer available
+        # WinError 995: The I/O operation has been aborted
+        # WinError 10053/10054: Connection aborted/reset by the client
+        # These are normal when clients disconnect and can be safely ignored
+        winerror = getattr(exception, 'winerror', None)
+        if winerror in (64, 995, 10053, 10054):
+            logging.debug(f"Suppressed Windows socket error (winerror={winerror}): {exception}")
+            return
+
+        # Suppress asyncio's "Accept failed on a socket" reports for network errors
+        if context.get('message', '').startswith('Accept failed'):
+            logging.debug(f"Suppressed accept failed error: {exception}")
+            return
+
+    # For other exceptions, use the default handler
+    loop.default_exception_handler(context)
+
+
+def _windows_loop_factory() -> asyncio.AbstractEventLoop:
+    """Event loop factory passed to uvicorn on Windows (as a "module:attr" loop setting)"""
+    loop = asyncio.ProactorEventLoop()
+    loop.set_exception_handler(_windows_exception_handler)
+    return loop
+
+
+def _build_arg_parser() -> argparse.ArgumentParser:
+    """Build the command-line parser for the server"""
+    parser = argparse.ArgumentParser(description='Stata MCP Server')
+    parser.add_argument('--stata-path', type=str, help='Path to Stata installation')
+    parser.add_argument('--port', type=int, default=4000, help='Port to run MCP server on')
+    parser.add_argument('--host', type=str, default='localhost', help='Host to bind the server to')
+    parser.add_argument('--log-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], 
+                      default='INFO', help='Logging level')
+    parser.add_argument('--force-port', action='store_true', help='Force the specified port, even if it requires killing processes')
+    parser.add_argument('--log-file', type=str, help='Path to log file (default: stata_mcp_server.log in current directory)')
+    parser.add_argument('--stata-edition', type=str, choices=['mp', 'se', 'be'], default='mp', 
+                      help='Stata edition to use (mp, se, be) - default: mp')
+    parser.add_argument('--log-file-location', type=str, choices=['dofile', 'parent', 'workspace', 'extension', 'custom'], default='extension',
+                      help='Location for .do file logs (dofile, parent, workspace, extension, custom) - default: extension')
+    parser.add_argument('--custom-log-directory', type=str, default='',
+                      help='Custom directory for .do file logs (when location is custom)')
+    parser.add_argument('--workspace-root', type=str, default='',
+                      help='VS Code workspace root directory (for workspace log file location)')
+    parser.add_argument('--result-display-mode', type=str, choices=['compact', 'full'], default='compact',
+                      help='Result display mode for MCP returns: compact (filters verbose output) or full - default: compact')
+    parser.add_argument('--max-output-tokens', type=int, default=10000,
+                      help='Maximum tokens for MCP output (0 for unlimited) - default: 10000')
+    # Multi-session arguments (multi-session is enabled by default)
+    parser.add_argument('--multi-session', action='store_true', default=True,
+                      help='Enable multi-session mode for parallel Stata execution (default: enabled). '
+                           'Concurrent blocking Stata calls are capped at max-sessions + 4 threads (between 8 and 32); '
+                           'set STATA_MCP_THREAD_POOL to override')
+    parser.add_argument('--no-multi-session', action='store_true',
+                      help='Disable multi-session mode (use single shared Stata instance)')
+    parser.add_argument('--max-sessions', type=int, default=100,
+                      help='Maximum concurrent sessions when multi-session is enabled - default: 100')
+    parser.add_argument('--session-timeout', type=int, default=3600,
+                      help='Session idle timeout in seconds - default: 3600 (1 hour)')
+    parser.add_argument('--warm-sessions', type=int, default=2,
+                      help='Worker sessions to pre-spawn at startup in multi-session mode (0 to disable) - default: 2')
+    parser.add_argument('--transport', type=str, choices=['sse', 'http', 'both'], default='both',
+                      help='MCP transports to serve: sse (/mcp), http (/mcp-streamable) or both - default: both')
+    return parser
 
 
 def main():
     """Main function to set up and run the server"""
     try:
         # Get Stata path from arguments
-        parser = argparse.ArgumentParser(description='Stata MCP Server')
-        parser.add_argument('--stata-path', type=str, help='Path to Stata installation')
-        parser.add_argument('--port', type=int, default=4000, help='Port to run MCP server on')
-        parser.add_argument('--host', type=str, default='localhost', help='Host to bind the server to')
-        parser.add_argument('--log-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], 
-                          default='INFO', help='Logging level')
-        parser.add_argument('--force-port', action='store_true', help='Force the specified port, even if it requires killing processes')
-        parser.add_argument('--log-file', type=str, help='Path to log file (default: stata_mcp_server.log in current directory)')
-        parser.add_argument('--stata-edition', type=str, choices=['mp', 'se', 'be'], default='mp', 
-                          help='Stata edition to use (mp, se, be) - default: mp')
-        parser.add_argument('--log-file-location', type=str, choices=['dofile', 'parent', 'workspace', 'extension', 'custom'], default='extension',
-                          help='Location for .do file logs (dofile, parent, workspace, extension, custom) - default: extension')
-        parser.add_argument('--custom-log-directory', type=str, default='',
-                          help='Custom directory for .do file logs (when location is custom)')
-        parser.add_argument('--workspace-root', type=str, default='',
-                          help='VS Code workspace root directory (for workspace log file location)')
-        parser.add_argument('--result-display-mode', type=str, choices=['compact', 'full'], default='compact',
-                          help='Result display mode for MCP returns: compact (filters verbose output) or full - default: compact')
-        parser.add_argument('--max-output-tokens', type=int, default=10000,
-                          help='Maximum tokens for MCP output (0 for unlimited) - default: 10000')
-        # Multi-session arguments (multi-session is enabled by default)
-        parser.add_argument('--multi-session', action='store_true', default=True,
-                          help='Enable multi-session mode for parallel Stata execution (default: enabled)')
-        parser.add_argument('--no-multi-session', action='store_true',
-                          help='Disable multi-session mode (use single shared Stata instance)')
-        parser.add_argument('--max-sessions', type=int, default=100,
-                          help='Maximum concurrent sessions when multi-session is enabled - default: 100')
-        parser.add_argument('--session-timeout', type=int, default=3600,
-                          help='Session idle timeout in seconds - default: 3600 (1 hour)')
+        parser = _build_arg_parser()
 
         # Special handling when running as a module
         if is_running_as_module:
             print(f"Command line arguments when running as module: {sys.argv}")
             # When run as a module, the first arg won't be the script path
-            args_to_parse = sys.argv[1:]
+            raw_args = sys.argv[1:]
         else:
             # Regular mode - arg 0 is script path
             #print(f"[MCP Server] Original command line arguments: {sys.argv}")
-            args_to_parse = sys.argv
-            
-            # Skip if an argument is a duplicate script path (e.g., on Windows with shell:true)
-            clean_args = []
-            script_path_found = False
-            
-            for arg in args_to_parse:
-                # Skip duplicate script paths, but keep the first one (sys.argv[0])
-                if arg.endswith('stata_mcp_server.py'):
-                    if script_path_found and arg != sys.argv[0]:
-                        logging.debug(f"Skipping duplicate script path: {arg}")
-                        continue
-                    script_path_found = True
-                
-                clean_args.append(arg)
-            
-            args_to_parse = clean_args
-        
-        # Process commands for Stata path with spaces
-        fixed_args = []
-        i = 0
-        while i < len(args_to_parse):
-            arg = args_to_parse[i]
-                
-            if arg == '--stata-path' and i + 1 < len(args_to_parse):
-                # The next argument might be a path that got split
-                stata_path = args_to_parse[i + 1]
-                
-                # Check if this is a quoted path
-                if (stata_path.startswith('"') and not stata_path.endswith('"')) or (stata_path.startswith("'") and not stata_path.endswith("'")):
-                    # Look for the rest of the path in subsequent arguments
-                    i += 2  # Move past '--stata-path' and the first part
-                    
-                    # Get the quote character (single or double)
-                    quote_char = stata_path[0]
-                    path_parts = [stata_path[1:]]  # Remove the starting quote
-                    
-                    # Collect all parts until we find the end quote
-                    while i < len(args_to_parse):
-                        current = args_to_parse[i]
-                        if current.endswith(quote_char):
-                            # Found the end quote
-                            path_parts.append(current[:-1])  # Remove the ending quote
-                            break
-                        else:
-                            path_parts.append(current)
-                        i += 1
-                    
-                    # Join all parts to form the complete path
-                    complete_path = " ".join(path_parts)
-                    fixed_args.append('--stata-path')
-                    fixed_args.append(complete_path)
-                else:
-                    # Normal path handling (either without quotes or with properly matched quotes)
-                    fixed_args.append(arg)
-                    fixed_args.append(stata_path)
-                    i += 2
-            else:
-            # For all other arguments, add them as-is
-                fixed_args.append(arg)
-                i += 1
-        
+            raw_args = sys.argv
+
+        # Single pass over argv: drop duplicate script paths (e.g., on Windows with
+        # shell:true) and note whether any argument starts with a quote
+        args_to_parse = []
+        append = args_to_parse.append
+        script_path_found = False
+        has_quoted_arg = False
+        for arg in raw_args:
+            # Skip duplicate script paths, but keep the first one (sys.argv[0])
+            if not is_running_as_module and arg.endswith('stata_mcp_server.py'):
+                if script_path_found and arg != sys.argv[0]:
+                    logging.debug(f"Skipping duplicate script path: {arg}")
+                    continue
+                script_path_found = True
+            if arg.startswith(('"', "'")):
+                has_quoted_arg = True
+            append(arg)
+
+        # Process commands for Stata path with spaces; a split path always leaves an
+        # argument starting with a quote, so skip the rebuild when there is none
+        fixed_args = _join_split_stata_path(args_to_parse) if has_quoted_arg else args_to_parse
+
         # Print debug info
         print(f"Command line arguments: {fixed_args}")
         
@@ -4825,6 +5816,7 @@ def main():
 
         # Configure log file
         log_file = args.log_file or 'stata_mcp_server.log'
+        abs_log_file = os.path.abspath(log_file)
         log_dir = os.path.dirname(log_file)
         
         # Create log directory if needed
@@ -4837,7 +5829,7 @@ def main():
                 # Continue anyway, the file handler creation will fail if needed
         
         # Always print where we're trying to log
-        print(f"Logging to: {os.path.abspath(log_file)}")
+        print(f"Logging to: {abs_log_file}")
             
         # Remove existing handlers
         for handler in logging.getLogger().handlers[:]:
@@ -4848,7 +5840,7 @@ def main():
             file_handler = logging.FileHandler(log_file, mode='a', encoding='utf-8')
             file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             logging.getLogger().addHandler(file_handler)
-            print(f"Successfully configured log file: {os.path.abspath(log_file)}")
+            print(f"Successfully configured log file: {abs_log_file}")
         except Exception as log_error:
             print(f"ERROR: Failed to configure log file {log_file}: {str(log_error)}")
             # Continue with console logging only
@@ -4863,7 +5855,7 @@ def main():
         # Set Stata edition
         global stata_edition, log_file_location, custom_log_directory, workspace_root, extension_path
         global result_display_mode, max_output_tokens
-        global multi_session_enabled, multi_session_max_sessions, multi_session_timeout
+        global multi_session_enabled, multi_session_max_sessions, multi_session_timeout, multi_session_warm_sessions
         stata_edition = args.stata_edition.lower()
         log_file_location = args.log_file_location
         custom_log_directory = args.custom_log_directory
@@ -4874,11 +5866,12 @@ def main():
         multi_session_enabled = args.multi_session and not args.no_multi_session
         multi_session_max_sessions = args.max_sessions
         multi_session_timeout = args.session_timeout
+        multi_session_warm_sessions = max(0, args.warm_sessions)
 
         # Try to determine extension path from the log file path
         if args.log_file:
             # If log file is in a logs subdirectory, the parent of that is the extension path
-            log_file_dir = os.path.dirname(os.path.abspath(args.log_file))
+            log_file_dir = os.path.dirname(abs_log_file)
             if log_file_dir.endswith('logs'):
                 extension_path = os.path.dirname(log_file_dir)
             else:
@@ -4892,15 +5885,17 @@ def main():
         if multi_session_enabled:
             logging.info(f"Max sessions: {multi_session_max_sessions}")
             logging.info(f"Session timeout: {multi_session_timeout}s")
+            logging.info(f"Warm sessions: {multi_session_warm_sessions}")
         if custom_log_directory:
             logging.info(f"Custom log directory: {custom_log_directory}")
         if extension_path:
             logging.info(f"Extension path: {extension_path}")
         
         # Log startup information
-        logging.info(f"Log initialized at {os.path.abspath(log_file)}")
+        system_name = platform.system()
+        logging.info(f"Log initialized at {abs_log_file}")
         logging.info(f"Log level set to {args.log_level}")
-        logging.info(f"Platform: {platform.system()} {platform.release()}")
+        logging.info(f"Platform: {system_name} {platform.release()}")
         logging.info(f"Python version: {sys.version}")
         logging.info(f"Working directory: {os.getcwd()}")
 
@@ -4912,24 +5907,10 @@ def main():
         else:
             STATA_PATH = os.environ.get('STATA_PATH')
             if not STATA_PATH:
-                if platform.system() == 'Darwin':  # macOS
+                if system_name == 'Darwin':  # macOS
                     STATA_PATH = '/Applications/Stata'
-                elif platform.system() == 'Windows':
-                    # Try common Windows paths
-                    potential_paths = [
-                        'C:\\Program Files\\Stata18',
-                        'C:\\Program Files\\Stata17', 
-                        'C:\\Program Files\\Stata16',
-                        'C:\\Program Files (x86)\\Stata18',
-                        'C:\\Program Files (x86)\\Stata17',
-                        'C:\\Program Files (x86)\\Stata16'
-                    ]
-                    for path in potential_paths:
-                        if os.path.exists(path):
-                            STATA_PATH = path
-                            break
-                    if not STATA_PATH:
-                        STATA_PATH = 'C:\\Program Files\\Stata18'  # Default if none found
+                elif system_name == 'Windows':
+                    STATA_PATH = _find_windows_stata_path()
                 else:  # Linux
                     STATA_PATH = '/usr/local/stata'
                     
@@ -4951,15 +5932,13 @@ def main():
                 logging.info(f"Ensuring port 4000 is available by terminating any existing processes")
                 kill_process_on_port(port)
             else:
-                # For other ports, check if available
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(1)
-                    result = s.connect_ex(('localhost', port))
-                    if result == 0:  # Port is in use
-                        logging.warning(f"Port {port} is already in use")
-                        # Kill the process on the port instead of finding a new one
-                        logging.info(f"Attempting to kill process using port {port}")
-                        kill_process_on_port(port)
+                # For other ports, check if something is already listening on the bind address
+                port_in_use = _port_has_listener(args.host, port)
+                if port_in_use:
+                    logging.warning(f"Port {port} is already in use")
+                    # Kill the process on the port instead of finding a new one
+                    logging.info(f"Attempting to kill process using port {port}")
+                    kill_process_on_port(port)
         
         # Try to initialize Stata (for single-session mode or as fallback)
         if not multi_session_enabled:
@@ -4976,10 +5955,7 @@ def main():
                 from session_manager import SessionManager
 
                 # Determine graphs directory (same as used by single-session mode)
-                if extension_path:
-                    graphs_dir = os.path.join(extension_path, 'graphs')
-                else:
-                    graphs_dir = os.path.join(tempfile.gettempdir(), 'stata_mcp_graphs')
+                graphs_dir = _graphs_dir()
                 os.makedirs(graphs_dir, exist_ok=True)
                 logging.info(f"Graphs directory for multi-session mode: {graphs_dir}")
 
@@ -4998,6 +5974,7 @@ def main():
                     global stata_available, has_stata
                     stata_available = True
                     has_stata = True
+                    _start_pre_warm(session_manager)
                 else:
                     logging.error("Failed to start session manager")
                     multi_session_enabled = False
@@ -5017,11 +5994,12 @@ def main():
         # Create and mount the MCP server
         # Only expose run_selection and run_file to LLMs
         # Other endpoints are still accessible via direct HTTP calls from VS Code extension
-        # Configure HTTP client with ASGI transport and extended timeout for long-running Stata operations
+        # Configure HTTP client with ASGI transport; only the read phase is long,
+        # so connection and pool stalls fail fast while Stata runs get 20 minutes
         http_client = httpx.AsyncClient(
             transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
             base_url="http://apiserver",
-            timeout=1200.0  # 20 minutes timeout for long Stata operations
+            timeout=httpx.Timeout(connect=5.0, read=1200.0, write=30.0, pool=5.0)
         )
 
         mcp = FastApiMCP(
@@ -5041,202 +6019,158 @@ def main():
         )
 
         # Mount SSE transport at /mcp for backward compatibility
-        mcp.mount_sse(mount_path="/mcp")
+        if args.transport != 'http':
+            mcp.mount_sse(mount_path="/mcp")
 
         # ========================================================================
         # HTTP (Streamable) Transport - Separate Server Instance
         # ========================================================================
-        # Create a SEPARATE MCP server instance for HTTP to avoid session conflicts
-        # This ensures notifications go to the correct transport
-        from mcp.server import Server as MCPServer
-        from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
-        from starlette.responses import StreamingResponse as StarletteStreamingResponse
-
-        logging.info("Creating separate MCP server instance for HTTP transport...")
-        http_mcp_server = MCPServer(SERVER_NAME)
-
-        # Register list_tools handler to expose the same tools
-        @http_mcp_server.list_tools()
-        async def list_tools_http():
-            """List available tools - delegate to main server"""
-            # Get tools from the main fastapi_mcp server
-            import mcp.types as types
-
-            tools_list = []
-            # stata_run_selection tool
-            tools_list.append(types.Tool(
-                name="stata_run_selection",
-                description="Stata Run Selection Endpoint\n\nRun selected Stata code and return the output\n\n### Responses:\n\n**200**: Successful Response (Success Response)",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "selection": {"type": "string", "title": "selection"}
-                    },
-                    "title": "stata_run_selectionArguments",
-                    "required": ["selection"]
-                }
-            ))
-            # stata_run_file tool
-            tools_list.append(types.Tool(
-                name="stata_run_file",
-                description="Stata Run File Endpoint\n\nRun a Stata .do file and return the output (MCP-compatible endpoint)\n\nArgs:\n    file_path: Path to the .do file\n    timeout: Timeout in seconds (default: 600 seconds / 10 minutes)\n\nReturns:\n    Response with plain text output\n\n### Responses:\n\n**200**: Successful Response (Success Response)",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "file_path": {"type": "string", "title": "file_path"},
-                        "timeout": {"type": "integer", "default": 600, "title": "timeout"}
-                    },
-                    "title": "stata_run_fileArguments",
-                    "required": ["file_path"]
-                }
-            ))
-            # stata_session tool for session management
-            tools_list.append(types.Tool(
-                name="stata_session",
-                description="Stata Session Management\n\nManage Stata sessions for parallel execution. Supports two actions:\n- list: List all active sessions and their status\n- destroy: Destroy an existing session\n\nIn multi-session mode, you can run multiple Stata tasks in parallel by specifying different session_id values in run_selection or run_file calls. Sessions are created automatically when needed.",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "action": {
-                            "type": "string",
-                            "enum": ["list", "destroy"],
-                            "default": "list",
-                            "description": "Action to perform: 'list' to show sessions, 'destroy' to remove a session"
+        # Skipped entirely (including the mcp.server imports) for --transport sse
+        if args.transport != 'sse':
+            # Create a SEPARATE MCP server instance for HTTP to avoid session conflicts
+            # This ensures notifications go to the correct transport
+            from mcp.server import Server as MCPServer
+            from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+
+            logging.info("Creating separate MCP server instance for HTTP transport...")
+            http_mcp_server = MCPServer(SERVER_NAME)
+
+            # Register list_tools handler to expose the same tools
+            @http_mcp_server.list_tools()
+            async def list_tools_http():
+                """List available tools - delegate to main server"""
+                # Get tools from the main fastapi_mcp server
+                import mcp.types as types
+
+                tools_list = []
+                # stata_run_selection tool
+                tools_list.append(types.Tool(
+                    name="stata_run_selection",
+                    description="Stata Run Selection Endpoint\n\nRun selected Stata code and return the output\n\n### Responses:\n\n**200**: Successful Response (Success Response)",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "selection": {"type": "string", "title": "selection"}
                         },
-                        "session_id": {
-                            "type": "string",
-                            "description": "Session ID. Required for 'destroy' action"
-                        }
-                    },
-                    "title": "stata_sessionArguments"
-                }
-            ))
-            return tools_list
-
-        # Register call_tool handler to execute tools with HTTP server's context
-        @http_mcp_server.call_tool()
-        async def call_tool_http(name: str, arguments: dict) -> list:
-            """Execute tools using HTTP server's own context for proper notification routing"""
-            import mcp.types as types
-
-            logging.debug(f"HTTP server executing tool: {name}")
-
-            # Handle stata_session tool specially since it's not in operation_map
-            if name == "stata_session":
-                # Call the /v1/tools endpoint directly
-                response = await http_client.post(
-                    "/v1/tools",
-                    json={
-                        "tool": "stata_session",
-                        "parameters": arguments
+                        "title": "stata_run_selectionArguments",
+                        "required": ["selection"]
+                    }
+                ))
+                # stata_run_file tool
+                tools_list.append(types.Tool(
+                    name="stata_run_file",
+                    description="Stata Run File Endpoint\n\nRun a Stata .do file and return the output (MCP-compatible endpoint)\n\nArgs:\n    file_path: Path to the .do file\n    timeout: Timeout in seconds (default: 600 seconds / 10 minutes)\n\nReturns:\n    Response with plain text output\n\n### Responses:\n\n**200**: Successful Response (Success Response)",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "file_path": {"type": "string", "title": "file_path"},
+                            "timeout": {"type": "integer", "default": 600, "title": "timeout"}
+                        },
+                        "title": "stata_run_fileArguments",
+                        "required": ["file_path"]
                     }
+                ))
+                # stata_session tool for session management
+                tools_list.append(types.Tool(
+                    name="stata_session",
+                    description="Stata Session Management\n\nManage Stata sessions for parallel execution. Supports two actions:\n- list: List all active sessions and their status\n- destroy: Destroy an existing session\n\nIn multi-session mode, you can run multiple Stata tasks in parallel by specifying different session_id values in run_selection or run_file calls. Sessions are created automatically when needed.",
+                    inputSchema={
+                        "type": "object",
+                        "properties": {
+                            "action": {
+                                "type": "string",
+                                "enum": ["list", "destroy"],
+                                "default": "list",
+                                "description": "Action to perform: 'list' to show sessions, 'destroy' to remove a session"
+                            },
+                            "session_id": {
+                                "type": "string",
+                                "description": "Session ID. Required for 'destroy' action"
+                            }
+                        },
+                        "title": "stata_sessionArguments"
+                    }
+                ))
+                return tools_list
+
+            # Register call_tool handler to execute tools with HTTP server's context
+            @http_mcp_server.call_tool()
+            async def call_tool_http(name: str, arguments: dict) -> list:
+                """Execute tools using HTTP server's own context for proper notification routing"""
+                import mcp.types as types
+
+                logging.debug(f"HTTP server executing tool: {name}")
+
+                # Handle stata_session tool specially since it's not in operation_map
+                if name == "stata_session":
+                    # Call the /v1/tools endpoint directly
+                    response = await http_client.post(
+                        "/v1/tools",
+                        json={
+                            "tool": "stata_session",
+                            "parameters": arguments
+                        },
+                        # list and destroy never run user code, so they get a short timeout
+                        timeout=_SESSION_TOOL_TIMEOUT
+                    )
+                    response_data = _loads_json(response.content)
+                    if response_data.get("status") == "success":
+                        return [types.TextContent(
+                            type="text",
+                            text=response_data.get("result", "")
+                        )]
+                    else:
+                        return [types.TextContent(
+                            type="text",
+                            text=f"Error: {response_data.get('message', 'Unknown error')}"
+                        )]
+
+                # Call the fastapi_mcp's execute method, which has the streaming wrapper
+                # The streaming wrapper will check http_mcp_server.request_context (which is set by StreamableHTTPSessionManager)
+                result = await mcp._execute_api_tool(
+                    client=http_client,
+                    tool_name=name,
+                    arguments=arguments,
+                    operation_map=mcp.operation_map,  # Correct attribute name
+                    http_request_info=None
                 )
-                response_data = response.json()
-                if response_data.get("status") == "success":
-                    return [types.TextContent(
-                        type="text",
-                        text=response_data.get("result", "")
-                    )]
-                else:
-                    return [types.TextContent(
-                        type="text",
-                        text=f"Error: {response_data.get('message', 'Unknown error')}"
-                    )]
-
-            # Call the fastapi_mcp's execute method, which has the streaming wrapper
-            # The streaming wrapper will check http_mcp_server.request_context (which is set by StreamableHTTPSessionManager)
-            result = await mcp._execute_api_tool(
-                client=http_client,
-                tool_name=name,
-                arguments=arguments,
-                operation_map=mcp.operation_map,  # Correct attribute name
-                http_request_info=None
-            )
 
-            return result
+                return result
 
-        logging.debug("Registered tool handlers with HTTP server")
+            logging.debug("Registered tool handlers with HTTP server")
 
-        # Create HTTP session manager with dedicated server
-        http_session_manager = StreamableHTTPSessionManager(
-            app=http_mcp_server,  # Use dedicated HTTP server, not shared
-            event_store=None,
-            json_response=False,  # Use SSE format for responses
-            stateless=False,  # Maintain session state
-        )
-        logging.info("HTTP transport configured with dedicated MCP server")
-
-        # Create a custom Response class that properly handles ASGI streaming
-        class ASGIPassthroughResponse(StarletteStreamingResponse):
-            """Response that passes through ASGI calls without buffering"""
-            def __init__(self, asgi_handler, scope, receive):
-                # Initialize the parent class with a dummy streaming function
-                # We need this to set up all required attributes like background, headers, etc.
-                super().__init__(content=iter([]), media_type="text/event-stream")
-
-                # Store our ASGI handler
-                self.asgi_handler = asgi_handler
-                self.scope_data = scope
-                self.receive_func = receive
-
-            async def __call__(self, scope, receive, send):
-                """Handle ASGI request/response cycle"""
-                # Call the ASGI handler directly with the provided send callback
-                # This allows SSE events to be sent immediately without buffering
-                await self.asgi_handler(self.scope_data, self.receive_func, send)
-
-        @app.api_route(
-            "/mcp-streamable",
-            methods=["GET", "POST", "DELETE"],
-            include_in_schema=False,
-            operation_id="mcp_http_streamable"
-        )
-        async def handle_mcp_streamable(request: Request):
-            """Handle MCP Streamable HTTP requests with proper ASGI passthrough"""
-            # Return a response that directly passes through to the ASGI handler
-            # This avoids any buffering by FastAPI/Starlette
-            return ASGIPassthroughResponse(
-                asgi_handler=http_session_manager.handle_request,
-                scope=request.scope,
-                receive=request.receive
+            # Create HTTP session manager with dedicated server
+            http_session_manager = StreamableHTTPSessionManager(
+                app=http_mcp_server,  # Use dedicated HTTP server, not shared
+                event_store=None,
+                json_response=False,  # Use SSE format for responses
+                stateless=False,  # Maintain session state
+            )
+            logging.info("HTTP transport configured with dedicated MCP server")
+
+            class StreamableHTTPEndpoint:
+                """Raw ASGI endpoint that hands /mcp-streamable straight to the session manager"""
+                async def __call__(self, scope, receive, send):
+                    # The session manager sends directly, so SSE events are never buffered
+                    await http_session_manager.handle_request(scope, receive, send)
+
+            # Starlette treats a non-function endpoint as an ASGI app, so no Request or
+            # Response objects are built. A Route is used instead of app.mount() because a
+            # mount would redirect the bare /mcp-streamable path to /mcp-streamable/
+            app.add_route(
+                "/mcp-streamable",
+                StreamableHTTPEndpoint(),
+                methods=["GET", "POST", "DELETE"],
+                name="mcp_http_streamable",
+                include_in_schema=False,
             )
 
-        # Store the session manager for startup/shutdown
-        app.state.http_session_manager = http_session_manager
-        app.state.http_session_manager_cm = None
-
-        # Define startup handler for the HTTP session manager
-        async def _start_http_session_manager():
-            """Start the HTTP session manager task group"""
-            try:
-                logging.info("Starting StreamableHTTP session manager...")
-                # Enter the context manager
-                app.state.http_session_manager_cm = http_session_manager.run()
-                await app.state.http_session_manager_cm.__aenter__()
-                logging.info("✓ StreamableHTTP session manager started successfully")
-            except Exception as e:
-                logging.error(f"Failed to start StreamableHTTP session manager: {e}", exc_info=True)
-                raise
-
-        # Define shutdown handler for the HTTP session manager
-        async def _stop_http_session_manager():
-            """Stop the HTTP session manager"""
-            if app.state.http_session_manager_cm:
-                try:
-                    logging.info("Stopping StreamableHTTP session manager...")
-                    await app.state.http_session_manager_cm.__aexit__(None, None, None)
-                    logging.info("✓ StreamableHTTP session manager stopped")
-                except Exception as e:
-                    logging.error(f"Error stopping HTTP session manager: {e}", exc_info=True)
-
-        # Store handlers on app.state for the lifespan manager to call
-        app.state._http_session_manager_starter = _start_http_session_manager
-        app.state._http_session_manager_stopper = _stop_http_session_manager
-        logging.debug("HTTP session manager startup/shutdown handlers registered with lifespan")
+            # Store the session manager; the app lifespan runs it for startup/shutdown
+            app.state.http_session_manager = http_session_manager
 
-        # Store reference
-        mcp._http_transport = http_session_manager
-        logging.info("MCP HTTP Streamable transport mounted at /mcp-streamable with TRUE SSE streaming (ASGI direct)")
+            # Store reference
+            mcp._http_transport = http_session_manager
+            logging.info("MCP HTTP Streamable transport mounted at /mcp-streamable with TRUE SSE streaming (ASGI direct)")
 
         LOG_LEVEL_RANK = {
             "debug": 0,
@@ -5261,7 +6195,10 @@ def main():
 
             session = getattr(ctx, "session", None)
             if session is not None:
-                setattr(session, "_stata_log_level", (level or "info").lower())
+                session_level = (level or "info").lower()
+                setattr(session, "_stata_log_level", session_level)
+                # Cache the rank so streaming ticks compare ints without lookups
+                setattr(session, "_stata_log_rank", LOG_LEVEL_RANK.get(session_level, LOG_LEVEL_RANK[DEFAULT_LOG_LEVEL]))
                 logging.debug(f"Set MCP log level for session to {level}")
 
         # Enhance stata_run_file with MCP-native streaming updates
@@ -5274,6 +6211,12 @@ def main():
 
             bound_self = call_args[0]
             original_args = call_args[1:]
+
+            # Fast path: only stata_run_file is streamed, so skip argument normalization for other tools
+            fast_tool_name = call_kwargs.get("tool_name") or (call_args[2] if len(call_args) >= 3 else None)
+            if fast_tool_name != "stata_run_file":
+                return await original_execute(*original_args, **call_kwargs)
+
             original_kwargs = dict(call_kwargs)
 
             # Extract known keyword arguments
@@ -5344,13 +6287,12 @@ def main():
 
             # DEBUG: Log session information
             logging.info(f"✓ Streaming enabled via {server_type} server - Tool: {tool_name}")
-            if session:
-                session_attrs = [attr for attr in dir(session) if not attr.startswith('__')]
-                logging.debug(f"Session type: {type(session)}, Attributes: {session_attrs[:10]}")
-                session_id = getattr(session, "_session_id", getattr(session, "session_id", getattr(session, "id", None)))
-            else:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
                 session_id = None
-            logging.debug(f"Tool execution - Server: {server_type}, Session ID: {session_id}, Request ID: {request_id}, Progress Token: {progress_token}")
+                if session:
+                    logging.debug(f"Session type: {type(session)}")
+                    session_id = getattr(session, "_session_id", getattr(session, "session_id", getattr(session, "id", None)))
+                logging.debug(f"Tool execution - Server: {server_type}, Session ID: {session_id}, Request ID: {request_id}, Progress Token: {progress_token}")
 
             if session is None:
                 logging.debug("MCP session not available; falling back to default execution")
@@ -5362,8 +6304,10 @@ def main():
                     http_request_info=http_request_info,
                 )
 
-            if not hasattr(session, "_stata_log_level"):
+            # send_log and the tick loop read the cached rank, so make sure it exists
+            if not hasattr(session, "_stata_log_rank"):
                 setattr(session, "_stata_log_level", DEFAULT_LOG_LEVEL)
+                setattr(session, "_stata_log_rank", LOG_LEVEL_RANK[DEFAULT_LOG_LEVEL])
 
             file_path = arguments_dict.get("file_path", "")
 
@@ -5372,12 +6316,24 @@ def main():
             except (TypeError, ValueError):
                 timeout = 600
 
+            # Jobs that must finish before the first progress tick get nothing from streaming
+            stream_interval = 5
+            if timeout <= stream_interval:
+                return await original_execute(
+                    client=client,
+                    tool_name=tool_name,
+                    arguments=arguments_dict,
+                    operation_map=operation_map,
+                    http_request_info=http_request_info,
+                )
+
             resolved_path, resolution_candidates = resolve_do_file_path(file_path)
             effective_path = resolved_path or os.path.abspath(file_path)
-            base_name = os.path.splitext(os.path.basename(effective_path))[0]
+            effective_name = os.path.basename(effective_path)
+            base_name = os.path.splitext(effective_name)[0]
             log_file_path = get_log_file_path(effective_path, base_name)
 
-            logging.info(f"📡 MCP streaming enabled for {os.path.basename(file_path)}")
+            logging.info(f"📡 MCP streaming enabled for {effective_name}")
             logging.debug(f"MCP log streaming monitoring: {log_file_path}")
             if not resolved_path:
                 logging.debug(f"Resolution attempts: {resolution_candidates}")
@@ -5386,11 +6342,10 @@ def main():
             import time as _time
 
             async def send_log(level: str, message: str):
-                level = (level or "info").lower()
-                session_level = getattr(session, "_stata_log_level", DEFAULT_LOG_LEVEL)
-                if LOG_LEVEL_RANK.get(level, 0) < LOG_LEVEL_RANK.get(session_level, LOG_LEVEL_RANK[DEFAULT_LOG_LEVEL]):
+                # Callers pass lowercase level literals; the session rank is cached by handle_set_logging_level
+                if LOG_LEVEL_RANK.get(level, 0) < session._stata_log_rank:
                     return
-                logging.debug(f"MCP streaming log [{level}] (session level {session_level}): {message}")
+                logging.debug(f"MCP streaming log [{level}] (session level {session._stata_log_level}): {message}")
                 try:
                     await session.send_log_message(
                         level=level,
@@ -5426,59 +6381,71 @@ def main():
             )
 
             start_time = _time.time()
-            stream_interval = 5
-            poll_interval = 2
-            last_stream = 0.0
+            stream_tail_bytes = 4096
+            notice_rank = LOG_LEVEL_RANK["notice"]
+            # Opened once the log appears and kept open across ticks
+            log_fh = None
             last_offset = 0
 
-            start_message = f"▶️  Starting Stata execution: {os.path.basename(effective_path)}"
+            start_message = f"▶️  Starting Stata execution: {effective_name}"
             await send_log("notice", start_message)
             await send_progress(0.0, start_message)
 
             try:
                 while not task.done():
-                    await _asyncio.sleep(poll_interval)
-                    now = _time.time()
-                    elapsed = now - start_time
+                    # Wake on completion or at the next stream tick, whichever comes first
+                    done, _ = await _asyncio.wait({task}, timeout=stream_interval)
+                    if task in done:
+                        break
+                    elapsed = _time.time() - start_time
 
-                    if now - last_stream >= stream_interval:
-                        progress_msg = f"⏱️  {elapsed:.0f}s elapsed / {timeout}s timeout"
-                        await send_progress(elapsed, progress_msg)
+                    # Skip the log read and message building when nothing would be sent
+                    # (the client may change its log level mid-run, so check every tick)
+                    log_enabled = session._stata_log_rank <= notice_rank
+                    if progress_token is None and not log_enabled:
+                        continue
 
-                        if os.path.exists(log_file_path):
-                            await send_log(
-                                "notice",
-                                f"{progress_msg}\n\n(📁 Inspecting Stata log for new output...)",
-                            )
-                            try:
-                                with open(log_file_path, "r", encoding="utf-8", errors="replace") as log_file:
-                                    log_file.seek(last_offset)
-                                    new_content = log_file.read()
-                                    last_offset = log_file.tell()
-
-                                snippet = ""
-                                if new_content.strip():
-                                    lines = new_content.strip().splitlines()
-                                    snippet = "\n".join(lines[-3:])
-
-
-                                if snippet:
-                                    progress_msg = f"{progress_msg}\n\n📝 Recent output:\n{snippet}"
-
-                                await send_log("notice", progress_msg)
-                            except Exception as read_exc:  # noqa: BLE001
-                                logging.debug(f"Error reading log for streaming: {read_exc}")
-                                await send_log(
-                                    "notice",
-                                    f"{progress_msg} (waiting for output...)",
-                                )
-                        else:
-                            await send_log(
-                                "notice",
-                                f"{progress_msg} (initializing...)",
-                            )
+                    progress_msg = f"⏱️  {int(elapsed)}s elapsed / {timeout}s timeout"
+
+                    if log_fh is None:
+                        try:
+                            log_fh = open(log_file_path, "rb")
+                        except FileNotFoundError:
+                            pass
 
-                        last_stream = now
+                    # Read the log first so each tick sends one combined progress/log message
+                    if log_fh is None:
+                        progress_msg = f"{progress_msg} (initializing...)"
+                    else:
+                        try:
+                            # Only the last few lines are shown, so read a bounded tail of the new output
+                            size = log_fh.seek(0, os.SEEK_END)
+                            snippet = ""
+                            # An unchanged size means no new output: skip the read and decode
+                            if size != last_offset:
+                                if size < last_offset:
+                                    # Log was truncated (e.g. "log using ..., replace")
+                                    last_offset = 0
+                                read_from = max(last_offset, size - stream_tail_bytes)
+                                log_fh.seek(read_from)
+                                new_content = log_fh.read(size - read_from).decode("utf-8", errors="replace")
+                                last_offset = size
+
+                                new_content = new_content.strip()
+                                if new_content:
+                                    lines = new_content.rsplit("\n", 3)[-3:]
+                                    snippet = "\n".join(line.rstrip("\r") for line in lines)
+
+                            if snippet:
+                                progress_msg = f"{progress_msg}\n\n📝 Recent output:\n{snippet}"
+                        except Exception as read_exc:  # noqa: BLE001
+                            logging.debug(f"Error reading log for streaming: {read_exc}")
+                            progress_msg = f"{progress_msg} (waiting for output...)"
+
+                    if progress_token is not None:
+                        await send_progress(elapsed, progress_msg)
+                    if log_enabled:
+                        await send_log("notice", progress_msg)
 
                 result = await task
                 total_time = _time.time() - start_time
@@ -5488,10 +6455,15 @@ def main():
                 logging.error(f"❌ Error during MCP streaming: {exc}", exc_info=True)
                 await send_log("error", f"Error during execution: {exc}")
                 raise
-
-        import types as _types
-
-        mcp._execute_api_tool = _types.MethodType(execute_with_streaming, mcp)
+            finally:
+                # If we were cancelled mid-wait (e.g. client disconnect), don't leave the child task running
+                if not task.done():
+                    task.cancel()
+                if log_fh is not None:
+                    log_fh.close()
+
+        # Install the wrapper as a method on a per-instance subclass so lookups use the type's method cache
+        mcp.__class__ = type("StreamingFastApiMCP", (type(mcp),), {"_execute_api_tool": execute_with_streaming})
         logging.info("📡 MCP streaming wrapper installed for stata_run_file")
 
         # Mark MCP as initialized (will also be set in startup event)
@@ -5505,81 +6477,30 @@ def main():
             logging.info(f"Stata available: {stata_available}")
             
             # Print to stdout as well to ensure visibility
-            if platform.system() == 'Windows':
+            if system_name == 'Windows':
                 # For Windows, completely skip the startup message if another instance is detected
                 # as we already printed information above
                 if not stata_banner_displayed:
                     print(f"INITIALIZATION SUCCESS: Stata MCP Server starting on {args.host}:{port}")
                     print(f"Stata available: {stata_available}")
-                    print(f"Log file: {os.path.abspath(log_file)}")
+                    print(f"Log file: {abs_log_file}")
             else:
                 # Normal behavior for macOS/Linux
                 print(f"INITIALIZATION SUCCESS: Stata MCP Server starting on {args.host}:{port}")
                 print(f"Stata available: {stata_available}")
-                print(f"Log file: {os.path.abspath(log_file)}")
+                print(f"Log file: {abs_log_file}")
             
             import uvicorn
-            import asyncio
-
-            # On Windows, use custom server setup to handle IOCP socket errors gracefully
-            if platform.system() == "Windows":
-                def windows_exception_handler(loop, context):
-                    """Custom exception handler to suppress Windows IOCP socket errors."""
-                    exception = context.get('exception')
-                    message = context.get('message', '')
-
-                    # Check for known non-critical socket errors
-                    if exception and isinstance(exception, OSError):
-                        # WinError 64: The specified network name is no longer available
-                        # WinError 995: The I/O operation has been aborted
-                        # These are normal when clients disconnect and can be safely ignored
-                        winerror = getattr(exception, 'winerror', None)
-                        if winerror in (64, 995):
-                            logging.debug(f"Suppressed Windows socket error (winerror={winerror}): {exception}")
-                            return
-                        # Also check error message for network-related issues
-                        err_str = str(exception).lower()
-                        if 'network name is no longer available' in err_str:
-                            logging.debug(f"Suppressed Windows network error: {exception}")
-                            return
-
-                    # Suppress "Accept failed on a socket" messages for network errors
-                    if 'accept failed' in message.lower():
-                        if exception and isinstance(exception, OSError):
-                            logging.debug(f"Suppressed accept failed error: {exception}")
-                            return
-
-                    # For other exceptions, use the default handler
-                    loop.default_exception_handler(context)
-
-                async def run_server_windows():
-                    """Run uvicorn server with custom exception handling on Windows."""
-                    config = uvicorn.Config(
-                        app,
-                        host=args.host,
-                        port=port,
-                        log_level="warning",
-                        access_log=False
-                    )
-                    server = uvicorn.Server(config)
-                    await server.serve()
 
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.set_exception_handler(windows_exception_handler)
-                try:
-                    loop.run_until_complete(run_server_windows())
-                finally:
-                    loop.close()
-            else:
-                # Standard uvicorn.run for macOS/Linux
-                uvicorn.run(
-                    app,
-                    host=args.host,
-                    port=port,
-                    log_level="warning",  # Use warning to allow important messages through
-                    access_log=False  # Disable access logs
-                )
+            # On Windows, run on a Proactor loop whose exception handler drops IOCP disconnect noise
+            uvicorn.run(
+                app,
+                host=args.host,
+                port=port,
+                log_level="warning",  # Use warning to allow important messages through
+                access_log=False,  # Disable access logs
+                loop=f"{__name__}:_windows_loop_factory" if system_name == "Windows" else "auto"
+            )
             
         except Exception as e:
             logging.error(f"Server error: {str(e)}")
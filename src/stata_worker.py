@@ -816,6 +816,7 @@ capture log close _all
                     timeout = payload.get('timeout', 600.0)
                     log_file = payload.get('log_file', None)
                     working_dir = payload.get('working_dir', None)
+                    compact_filter = payload.get('compact_filter', False)
 
                     # Reset graph tracking BEFORE execution to only detect NEW graphs
                     if stlib is not None:
@@ -825,6 +826,18 @@ capture log close _all
                         file_path, timeout, log_file, working_dir
                     )
 
+                    # Filter here so the server doesn't have to rescan the full log
+                    filtered = False
+                    if compact_filter and success:
+                        try:
+                            from output_filter import apply_compact_mode_filter
+                            output = apply_compact_mode_filter(
+                                output, filter_command_echo=payload.get('filter_command_echo', False)
+                            )
+                            filtered = True
+                        except Exception:
+                            pass  # Server falls back to filtering the raw output
+
                     # Detect and export graphs after execution
                     graphs = []
                     if success and stlib is not None and graphs_dir:
@@ -839,7 +852,8 @@ capture log close _all
                         output=output,
                         error=error,
                         execution_time=exec_time,
-                        extra={"file_path": file_path, "log_file": actual_log_file, "graphs": graphs}
+                        extra={"file_path": file_path, "log_file": actual_log_file, "graphs": graphs,
+                               "filtered": filtered}
                     )
 
                 elif cmd_type == CommandType.GET_DATA:
@@ -880,6 +894,7 @@ capture log close _all
                                 )
                             elif if_condition:
                                 # Use efficient Stata-native filtering with preserve/restore
+                                # (restore also resets c(changed), so the user's data stays unmodified)
                                 try:
                                     stata.run("preserve", inline=False, echo=False)
 
@@ -896,34 +911,26 @@ capture log close _all
                                         if filtered_obs > max_rows:
                                             stata.run(f"quietly keep in 1/{max_rows}", inline=False, echo=False)
 
-                                        df = stata.pdataframe_from_data()
+                                        if filtered_obs == 0:
+                                            df = None
+                                        else:
+                                            df = stata.pdataframe_from_data()
 
-                                        # Extract original obs numbers as index, then drop the temp column
-                                        orig_obs_index = df['_stata_mcp_orig_obs'].tolist()
-                                        df = df.drop(columns=['_stata_mcp_orig_obs'])
-
-                                        stata.run("restore", inline=False, echo=False)
+                                            # Extract original obs numbers as index, then drop the temp column
+                                            orig_obs_index = df['_stata_mcp_orig_obs'].tolist()
+                                            df = df.drop(columns=['_stata_mcp_orig_obs'])
 
                                         total_matching = filtered_obs
                                         displayed_rows = min(filtered_obs, max_rows)
 
-                                    except Exception as filter_err:
-                                        try:
-                                            stata.run("restore", inline=False, echo=False)
-                                        except:
-                                            pass
-                                        send_result(
-                                            command_id=cmd_id,
-                                            status="error",
-                                            error=f"Filter error: {str(filter_err)}"
-                                        )
-                                        continue
-
-                                except Exception as preserve_err:
+                                    finally:
+                                        stata.run("restore", inline=False, echo=False)
+
+                                except Exception as filter_err:
                                     send_result(
                                         command_id=cmd_id,
                                         status="error",
-                                        error=f"Filter error: {str(preserve_err)}"
+                                        error=f"Filter error: {str(filter_err)}"
                                     )
                                     continue
                                 # For filtered case, orig_obs_index is already set above
@@ -960,6 +967,7 @@ capture log close _all
                             else:
                                 # Clean data for JSON serialization
                                 df_clean = df.replace({np.nan: None})
+                                column_names = df.columns.tolist()
 
                                 send_result(
                                     command_id=cmd_id,
@@ -967,8 +975,8 @@ capture log close _all
                                     output="",
                                     extra={
                                         "data": df_clean.values.tolist(),
-                                        "columns": df_clean.columns.tolist(),
-                                        "dtypes": {col: str(df[col].dtype) for col in df.columns},
+                                        "columns": column_names,
+                                        "dtypes": dict(zip(column_names, map(str, df.dtypes))),
                                         "rows": len(df),
                                         "index": orig_obs_index,
                                         "total_rows": total_matching,
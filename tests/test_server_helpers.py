@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""
+Tests for pure helpers in stata_mcp_server.
+
+These run without Stata: they cover log tailing, SSE framing, output slicing
+and HTTP caching helpers used by the streaming and graph endpoints.
+"""
+
+import sys
+import os
+import asyncio
+import pytest
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import stata_mcp_server as server
+
+
+class _FakeLogTail:
+    """Minimal stand-in for _LogTail as seen by the tick helpers"""
+
+    def __init__(self, path):
+        self.path = path
+        self.got_data = False
+
+
+# =============================================================================
+# Log change ticks
+# =============================================================================
+
+class TestLogTicker:
+    """Tests for _LogTicker"""
+
+    async def test_aclose_with_pending_tick(self, tmp_path):
+        """Closing while a tick is still pending must not raise"""
+        ticker = server._LogTicker(_FakeLogTail(str(tmp_path / "run.log")), 10.0)
+        execution = asyncio.get_running_loop().create_future()
+        execution.set_result(None)
+
+        await ticker.wait(execution)
+        assert ticker._tick is not None and not ticker._tick.done()
+
+        await ticker.aclose()
+        assert ticker._tick is None
+
+    async def test_watcher_failure_falls_back_to_polling(self, tmp_path):
+        """A watcher that dies is replaced by the sleep poll instead of spinning"""
+        calls = []
+
+        async def broken_ticks():
+            calls.append(1)
+            raise OSError("watcher died")
+            yield  # pragma: no cover
+
+        ticker = server._LogTicker(_FakeLogTail(str(tmp_path / "run.log")), 0.05)
+        ticker._ticks = broken_ticks()
+        execution = asyncio.get_running_loop().create_future()
+
+        await ticker.wait(execution)
+        await ticker.wait(execution)
+        await ticker.wait(execution)
+
+        assert calls == [1]
+        await ticker.aclose()
+
+    async def test_exhausted_watcher_falls_back_to_polling(self, tmp_path):
+        """StopAsyncIteration from the watcher switches to polling"""
+        async def no_ticks():
+            return
+            yield  # pragma: no cover
+
+        ticker = server._LogTicker(_FakeLogTail(str(tmp_path / "run.log")), 0.05)
+        ticker._ticks = no_ticks()
+        execution = asyncio.get_running_loop().create_future()
+
+        await ticker.wait(execution)
+        await asyncio.wait_for(ticker.wait(execution), timeout=1.0)
+        await ticker.aclose()
+
+
+# =============================================================================
+# Temp do-files
+# =============================================================================
+
+class TestTempDoFile:
+    """Tests for _temp_do_file"""
+
+    def test_private_unique_files(self):
+        """Each run gets its own file inside a private directory"""
+        fd1, path1 = server._temp_do_file()
+        fd2, path2 = server._temp_do_file()
+        os.close(fd1)
+        os.close(fd2)
+        try:
+            assert path1 != path2
+            assert os.path.dirname(path1) == os.path.dirname(path2) == server._temp_do_dir
+            assert os.path.dirname(path1) != server.tempfile.gettempdir()
+            if os.name == "posix":
+                assert os.stat(server._temp_do_dir).st_mode & 0o077 == 0
+        finally:
+            os.unlink(path1)
+            os.unlink(path2)
+
+
+# =============================================================================
+# Worker reload
+# =============================================================================
+
+class _FakeManager:
+    """Session manager stand-in for /reload_workers"""
+
+    def list_sessions(self):
+        return []
+
+
+class TestReloadWorkers:
+    """Tests for the /reload_workers serialization"""
+
+    def test_concurrent_reload_rejected(self, monkeypatch):
+        """A second reload while one is running gets 409 and does not start another"""
+        import threading
+        import time
+        from fastapi.testclient import TestClient
+
+        release = threading.Event()
+        calls = []
+
+        def fake_reload(old_manager):
+            calls.append(old_manager)
+            release.wait(timeout=5)
+            return True
+
+        monkeypatch.setattr(server, "multi_session_enabled", True)
+        monkeypatch.setattr(server, "session_manager", _FakeManager())
+        monkeypatch.setattr(server, "_reload_session_manager", fake_reload)
+
+        client = TestClient(server.app)
+        first = client.post("/reload_workers", params={"force": True})
+        second = client.post("/reload_workers", params={"force": True})
+        release.set()
+
+        assert first.json()["status"] == "success"
+        assert second.status_code == 409
+
+        deadline = time.time() + 5
+        while server._reload_in_flight and time.time() < deadline:
+            time.sleep(0.01)
+        assert not server._reload_in_flight
+        assert len(calls) == 1
+
+
+# =============================================================================
+# Pre-processed do-file cache
+# =============================================================================
+
+class TestPreprocessCache:
+    """Tests for preprocess_do_file_for_graphs caching"""
+
+    def _run(self, do_file):
+        """Pre-process a file the way a finished run does: acquire, then release"""
+        processed = server.preprocess_do_file_for_graphs(str(do_file))
+        server.release_preprocessed_do_file(processed)
+        return processed
+
+    def _edit(self, do_file, text):
+        """Rewrite a file and move its mtime forward so the edit is visible to stat"""
+        stat = os.stat(do_file)
+        do_file.write_text(text)
+        os.utime(do_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def test_unchanged_file_reuses_processed_copy(self, tmp_path):
+        """Re-running an unchanged file returns the same processed file"""
+        do_file = tmp_path / "analysis.do"
+        do_file.write_text("scatter price mpg\n")
+
+        first = self._run(do_file)
+        second = self._run(do_file)
+
+        assert first == second
+        assert "name(graph1, replace)" in open(first).read()
+
+    def test_touched_file_reuses_processed_copy(self, tmp_path):
+        """A new mtime with the same content is matched by the content hash"""
+        do_file = tmp_path / "analysis.do"
+        do_file.write_text("scatter price mpg\n")
+        first = self._run(do_file)
+
+        self._edit(do_file, "scatter price mpg\n")
+
+        assert self._run(do_file) == first
+
+    def test_edit_deletes_previous_copy(self, tmp_path):
+        """The replaced processed copy is removed when no run holds it"""
+        do_file = tmp_path / "analysis.do"
+        do_file.write_text("scatter price mpg\n")
+        first = self._run(do_file)
+
+        self._edit(do_file, "scatter price wgt\n")
+        second = self._run(do_file)
+
+        assert second != first
+        assert "wgt" in open(second).read()
+        assert not os.path.exists(first)
+
+    def test_edit_keeps_copy_until_last_run_releases_it(self, tmp_path):
+        """A copy still used by a run survives the edit and goes when that run ends"""
+        do_file = tmp_path / "analysis.do"
+        do_file.write_text("scatter price mpg\n")
+        running = server.preprocess_do_file_for_graphs(str(do_file))
+
+        self._edit(do_file, "scatter price wgt\n")
+        self._run(do_file)
+
+        assert os.path.exists(running)
+        server.release_preprocessed_do_file(running)
+        assert not os.path.exists(running)
+
+    def test_evicted_copy_deleted(self, tmp_path, monkeypatch):
+        """Copies pushed out of the cache are removed from disk"""
+        monkeypatch.setattr(server, "_PREPROCESS_CACHE_SIZE", 1)
+        old_file = tmp_path / "old.do"
+        old_file.write_text("scatter price mpg\n")
+        new_file = tmp_path / "new.do"
+        new_file.write_text("histogram price\n")
+
+        evicted = self._run(old_file)
+        kept = self._run(new_file)
+
+        assert not os.path.exists(evicted)
+        assert os.path.exists(kept)
+
+
+# =============================================================================
+# /view_data responses
+# =============================================================================
+
+class TestDumpsJson:
+    """Tests for _dumps_json"""
+
+    def test_compact_utf8_output(self):
+        """Output is compact and keeps non-ASCII text as-is, with or without orjson"""
+        assert server._dumps_json({"label": "Região", "n": [1, None]}) == '{"label":"Região","n":[1,null]}'
+
+
+class TestViewDataResponse:
+    """Tests for _view_data_response"""
+
+    async def test_timeout_payload_passed_through_as_ndjson(self):
+        """A non-success payload has no data key and is returned unchanged"""
+        payload = {"status": "timeout", "error": "Worker did not respond"}
+
+        response = await server._view_data_response(dict(payload), "data", ndjson=True)
+
+        assert response.status_code == 200
+        assert response.media_type == "application/json"
+        assert server.json.loads(response.body) == payload
+
+
+# =============================================================================
+# Log cleanup
+# =============================================================================
+
+class TestCleanLogOutput:
+    """Tests for _clean_log_output"""
+
+    def test_header_stripped(self):
+        """Everything up to and including the header separator line is dropped"""
+        log = "      name:  <unnamed>\n       log:  /tmp/run.log\n-------------------\n. display 1\n1\n"
+        assert server._clean_log_output(log) == ". display 1\n1"
+
+    def test_late_separator_is_not_a_header(self):
+        """A separator beyond the first 20 lines is kept as output"""
+        log = "line\n" * 25 + "-------------\nend\n"
+        assert server._clean_log_output(log) == log[:-1]
+
+    def test_smcl_codes_removed(self):
+        """SMCL directives are stripped from the text"""
+        log = "-------------\n. di {res}2{txt}\n{res}2\n"
+        assert server._clean_log_output(log) == ". di 2\n2"
+
+    def test_whitespace_and_blank_lines(self):
+        """Trailing whitespace is trimmed, leading blank lines dropped and blank runs collapsed"""
+        log = "-------------\n\n\n. display 1   \n1\t\n\n\n\n. display 2\n"
+        assert server._clean_log_output(log) == ". display 1\n1\n\n. display 2"
+
+    def test_indentation_preserved(self):
+        """Leading spaces in output lines (e.g. table layout) are kept"""
+        log = "-------------\n. summarize\n    Variable |        Obs\n-------------+-----------\n"
+        assert server._clean_log_output(log) == ". summarize\n    Variable |        Obs\n-------------+-----------"
+
+    def test_missing_final_newline(self):
+        """The last line is kept whether or not the log ends with a newline"""
+        assert server._clean_log_output("-------------\n. display 1\n1") == ". display 1\n1"
+        assert server._clean_log_output("") == ""
+
+
+# =============================================================================
+# Selection output slicing
+# =============================================================================
+
+START = server._SELECTION_START_MARKER
+END = server._SELECTION_END_MARKER
+
+
+class TestSliceUserOutput:
+    """Tests for _slice_user_output"""
+
+    def test_echo_and_marker_lines_dropped(self):
+        """Both the echoed display command and its output are removed"""
+        log = (
+            f'. cd "/work"\n'
+            f'. display "{START}"\n'
+            f'{START}\n'
+            f'. display 1+1\n'
+            f'2\n'
+            f'. display "{END}"\n'
+            f'{END}\n'
+        )
+        assert server._slice_user_output(log, False) == (". display 1+1\n2\n", False)
+
+    def test_trailing_end_of_do_file_dropped(self):
+        """Stata's closing 'end of do-file' line after the end marker is not user output"""
+        log = f'{START}\n. display 1\n1\n. display "{END}"\n{END}\n\nend of do-file\n'
+        assert server._slice_user_output(log, False) == (". display 1\n1\n", False)
+
+    def test_empty_body(self):
+        """A selection without output yields nothing"""
+        log = f'. display "{START}"\n{START}\n. display "{END}"\n{END}\n'
+        assert server._slice_user_output(log, False) == ("", False)
+        assert server._slice_user_output("", False) == ("", False)
+
+    def test_state_carried_across_chunks(self):
+        """Output split across reads is kept up to the end marker"""
+        text, inside = server._slice_user_output(f'{START}\n. display 1\n', False)
+        assert (text, inside) == (". display 1\n", True)
+        text, inside = server._slice_user_output(f'1\n. display "{END}"\n{END}\n', inside)
+        assert (text, inside) == ("1\n", False)
+
+    def test_prefix_alone_is_ordinary_output(self):
+        """A line that only contains the marker prefix is kept"""
+        line = f"{server._SELECTION_MARKER_PREFIX}other\n"
+        assert server._slice_user_output(line, True) == (line, True)
+
+
+# =============================================================================
+# Graph conditional requests
+# =============================================================================
+
+def _request(**headers):
+    """Build a bare Request carrying the given headers"""
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return server.Request({"type": "http", "headers": raw})
+
+
+class TestGraphNotModified:
+    """Tests for _graph_not_modified"""
+
+    MTIME = 1_700_000_000.5
+    ETAG = '"abc123"'
+
+    def test_matching_etag(self):
+        """If-None-Match equal to the current ETag means not modified"""
+        assert server._graph_not_modified(_request(if_none_match=self.ETAG), self.ETAG, self.MTIME)
+
+    def test_etag_takes_precedence_over_if_modified_since(self):
+        """A stale ETag wins over a date that alone would give 304"""
+        request = _request(
+            if_none_match='"stale"',
+            if_modified_since="Fri, 01 Jan 2100 00:00:00 GMT",
+        )
+        assert not server._graph_not_modified(request, self.ETAG, self.MTIME)
+
+    def test_if_modified_since_without_etag(self):
+        """Without If-None-Match the date is compared to the file mtime"""
+        newer = server.formatdate(self.MTIME + 60, usegmt=True)
+        older = server.formatdate(self.MTIME - 60, usegmt=True)
+        assert server._graph_not_modified(_request(if_modified_since=newer), self.ETAG, self.MTIME)
+        assert not server._graph_not_modified(_request(if_modified_since=older), self.ETAG, self.MTIME)
+
+    def test_invalid_or_missing_headers(self):
+        """Unparseable or absent conditional headers never give 304"""
+        assert not server._graph_not_modified(_request(if_modified_since="not a date"), self.ETAG, self.MTIME)
+        assert not server._graph_not_modified(_request(), self.ETAG, self.MTIME)
+
+
+class TestGetGraph:
+    """Tests for the /graphs endpoint path checks"""
+
+    def _client(self, tmp_path, monkeypatch):
+        from fastapi.testclient import TestClient
+        graphs = tmp_path / "graphs"
+        graphs.mkdir()
+        monkeypatch.setattr(server, "extension_path", str(tmp_path))
+        return TestClient(server.app), graphs
+
+    def test_graph_served(self, tmp_path, monkeypatch):
+        """A plain graph name is served from the graphs directory"""
+        client, graphs = self._client(tmp_path, monkeypatch)
+        (graphs / "graph1.png").write_bytes(b"png")
+        response = client.get("/graphs/graph1")
+        assert response.status_code == 200
+        assert response.content == b"png"
+
+    @pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="needs POSIX symlinks")
+    def test_symlink_out_of_graphs_dir_rejected(self, tmp_path, monkeypatch):
+        """A link inside the graphs directory cannot expose a file outside it"""
+        client, graphs = self._client(tmp_path, monkeypatch)
+        secret = tmp_path / "secret.png"
+        secret.write_bytes(b"secret")
+        os.symlink(secret, graphs / "leak.png")
+        response = client.get("/graphs/leak.png")
+        assert response.status_code == 400
+
+    def test_traversal_name_rejected(self, tmp_path, monkeypatch):
+        """Names with separators or ".." are rejected before any path is built"""
+        client, _ = self._client(tmp_path, monkeypatch)
+        assert client.get("/graphs/..%5Csecret.png").status_code == 400
+
+
+# =============================================================================
+# Log tailing and SSE framing
+# =============================================================================
+
+class TestLogTail:
+    """Tests for _LogTail"""
+
+    def test_incremental_reads(self, tmp_path):
+        """Each read returns only the text appended since the previous one"""
+        log = tmp_path / "run.log"
+        log.write_text("first\n")
+        tail = server._LogTail(str(log))
+        try:
+            assert tail.read() == "first\n"
+            assert tail.read() == ""
+            with open(log, "a") as f:
+                f.write("second\n")
+            assert tail.read() == "second\n"
+        finally:
+            tail.close()
+
+    def test_truncated_log_read_from_start(self, tmp_path):
+        """A log truncated by 'log using ..., replace' is read again from the beginning"""
+        log = tmp_path / "run.log"
+        log.write_text("a long first run\n")
+        tail = server._LogTail(str(log))
+        try:
+            tail.read()
+            log.write_text("new\n")
+            assert tail.read() == "new\n"
+        finally:
+            tail.close()
+
+    def test_rotated_log_read_from_start(self, tmp_path):
+        """A log replaced by a different file is read from its beginning"""
+        log = tmp_path / "run.log"
+        log.write_text("old\n")
+        tail = server._LogTail(str(log))
+        try:
+            tail.read()
+            rotated = tmp_path / "run.log.new"
+            rotated.write_text("rotated log contents\n")
+            os.replace(rotated, log)
+            assert tail.read() == "rotated log contents\n"
+        finally:
+            tail.close()
+
+    def test_bounded_reads_and_split_characters(self, tmp_path):
+        """max_read caps each read without breaking multi-byte characters"""
+        log = tmp_path / "run.log"
+        log.write_bytes("é1é2".encode("utf-8"))
+        tail = server._LogTail(str(log), max_read=1)
+        try:
+            chunks = []
+            while True:
+                chunks.append(tail.read())
+                if not tail.pending:
+                    break
+            assert "".join(chunks) == "é1é2"
+            assert chunks[0] == ""  # Only half of 'é' read so far
+        finally:
+            tail.close()
+
+    def test_missing_file(self, tmp_path):
+        """A log that does not exist yet reads as empty"""
+        tail = server._LogTail(str(tmp_path / "missing.log"))
+        assert tail.read() == ""
+        assert not tail.got_data
+
+
+class TestSseEvent:
+    """Tests for _sse_event"""
+
+    def test_multi_line_framing(self):
+        """Each line gets its own data: field and the event ends with a blank line"""
+        assert server._sse_event(["one", "two"]) == "data: one\ndata: two\n\n"
+
+    def test_empty_lines_skipped(self):
+        """Empty lines are dropped and an event with no lines is not sent"""
+        assert server._sse_event(["", "x", ""]) == "data: x\n\n"
+        assert server._sse_event([]) == ""
+        assert server._sse_event(iter([""])) == ""
+
+
+# =============================================================================
+# Startup port check
+# =============================================================================
+
+class TestPortHasListener:
+    """Tests for _port_has_listener"""
+
+    def test_listening_port(self):
+        """A port with a listener on the bind host is reported as in use"""
+        import socket
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(1)
+            port = listener.getsockname()[1]
+            assert server._port_has_listener("127.0.0.1", port)
+
+    def test_free_port(self):
+        """A port nobody listens on is free, even right after it was used"""
+        import socket
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        assert not server._port_has_listener("127.0.0.1", port)
+
+    def test_bound_but_not_listening(self):
+        """A bind conflict without a listener does not count as a running server"""
+        import socket
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as holder:
+            holder.bind(("127.0.0.1", 0))
+            port = holder.getsockname()[1]
+            assert not server._port_has_listener("127.0.0.1", port)
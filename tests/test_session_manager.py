@@ -457,6 +457,90 @@ class TestSessionCleanup(unittest.TestCase):
         finally:
             manager.stop()
 
+    @skip_if_no_stata
+    def test_snapshot(self):
+        """Test that snapshot matches list_sessions and get_stats"""
+        manager = SessionManager(
+            stata_path=STATA_PATH,
+            stata_edition=STATA_EDITION,
+            max_sessions=4,
+            enabled=True
+        )
+
+        try:
+            manager.start()
+
+            snapshot = manager.snapshot()
+
+            self.assertEqual(snapshot['sessions'], manager.list_sessions())
+            self.assertEqual(snapshot['stats'], manager.get_stats())
+            self.assertEqual(snapshot['stats']['available_slots'], 3)
+
+        finally:
+            manager.stop()
+
+    def test_pre_warm_discards_sessions_after_stop(self):
+        """Test that a warm session finishing after stop() is destroyed, not pooled"""
+        manager = SessionManager(
+            stata_path=STATA_PATH,
+            stata_edition=STATA_EDITION,
+            max_sessions=4,
+            enabled=False  # Don't actually start workers
+        )
+        created = []
+        destroyed = []
+
+        def create_then_stop(session_id, is_default=False):
+            created.append(session_id)
+            manager._shutdown = True  # stop() arrives while Stata is booting
+            return True
+
+        manager._create_session_internal = create_then_stop
+        manager.destroy_session = lambda session_id, force=False: destroyed.append(session_id) or (True, "")
+
+        self.assertEqual(manager.pre_warm(2), 0)
+        self.assertEqual(manager._warm_pool, [])
+        self.assertTrue(created)
+        self.assertEqual(sorted(destroyed), sorted(created))
+
+    def test_pre_warm_skipped_after_stop(self):
+        """Test that pre_warm spawns nothing once the manager is shutting down"""
+        manager = SessionManager(
+            stata_path=STATA_PATH,
+            stata_edition=STATA_EDITION,
+            max_sessions=4,
+            enabled=False  # Don't actually start workers
+        )
+        spawned = []
+        manager._create_session_internal = lambda session_id, is_default=False: spawned.append(session_id) or True
+        manager._shutdown = True
+
+        self.assertEqual(manager.pre_warm(2), 0)
+        self.assertEqual(spawned, [])
+
+    @skip_if_no_stata
+    def test_pre_warm(self):
+        """Test that pre-warmed sessions are handed out by create_session"""
+        manager = SessionManager(
+            stata_path=STATA_PATH,
+            stata_edition=STATA_EDITION,
+            max_sessions=4,
+            enabled=True
+        )
+
+        try:
+            manager.start()
+
+            self.assertEqual(manager.pre_warm(2), 2)
+            self.assertEqual(manager.available_slots, 1)
+
+            result = manager.create_session()
+            self.assertTrue(result['success'])
+            self.assertEqual(manager.available_slots, 1)
+
+        finally:
+            manager.stop()
+
     @skip_if_no_stata
     def test_available_slots(self):
         """Test available slots tracking"""